@@ -0,0 +1,50 @@
+import importlib
+import sys
+
+# A single entry point for the amms tools, e.g. "amms.py ingest trips.json".
+# Only the module of the chosen command is imported, and the tools load numpy
+# and pandas lazily, so a command starts without paying for the others.
+
+# Commands and their (module, main function, description)
+COMMANDS = {
+    'ingest': ('readtrips', 'main', 'Aggregate MDS trip data into a Metrics PBF file'),
+    'suppress': ('readtrips', 'suppressMain', 'Write suppressed flows of a PBF file'),
+    'stats': ('demostats', 'main', 'Print statistics of a PBF file'),
+    'csv': ('pbftocsv', 'main', 'Convert a PBF file into CSV or Parquet files'),
+    'json': ('pbftojson', 'main', 'Convert a PBF file into JSON'),
+    'query': ('pbfquery', 'main', 'Read some periods, zones or fields of a PBF file'),
+    'serve': ('ammsd', 'main', 'Run the aggregation service'),
+    'replay': ('replay', 'main', 'Replay MDS files to the aggregation service'),
+    'cache': ('partials', 'main', 'Inspect or prune the cache of partial aggregates'),
+    'rollup': ('rollup', 'main', 'Roll a PBF file up into coarser periods or zones'),
+}
+
+def usage():
+    lines = ["usage: amms.py COMMAND [ARGS ...]", "", "commands:"]
+    for command, (_, _, description) in COMMANDS.items():
+        lines.append("  {:<10}{}".format(command, description))
+    lines.append("")
+    lines.append("Run amms.py COMMAND -h for the arguments of a command.")
+    return "\n".join(lines)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if argv else 2
+    if argv[0] not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        print("\namms.py: error: unknown command {}".format(argv[0]), file=sys.stderr)
+        return 2
+    (module_name, function_name, _) = COMMANDS[argv[0]]
+    module = importlib.import_module(module_name)
+    # The program name in usage and errors is that of the command
+    program = sys.argv[0]
+    sys.argv[0] = "amms.py {}".format(argv[0])
+    try:
+        return getattr(module, function_name)(argv[1:])
+    finally:
+        sys.argv[0] = program
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import decoders
+import functools
+import google.protobuf.json_format as json_format
+import json
+import logging
+import os
+import readtrips
+import signal
+import sys
+import threading
+import time
+
+# A long-running aggregation service. MDS trips and vehicle status changes are
+# sent to it as line-delimited JSON over a Unix or localhost TCP socket and
+# added to an aggregate kept in memory, with the same periods and zones as
+# readtrips. Lines that are JSON objects with a "command" key are requests,
+# each answered with one line of JSON:
+#
+#   {"command": "totals"}      record counts, time range and trips by period
+#   {"command": "snapshot", "privacy_level": 5}
+#                              the aggregate as Metrics JSON, suppressed if a
+#                              privacy level is given. With "output_filename"
+#                              it is written as a PBF file of that name in
+#                              --snapshot_dir instead.
+#   {"command": "checkpoint"}  writes the checkpoint now
+#   {"command": "shutdown"}    writes the checkpoint and stops the service
+#
+# The aggregate is checkpointed to a PBF file, with its vehicle state sidecar,
+# every --checkpoint_interval seconds if it has changed. Files are written to
+# a temporary file and renamed, so readers never see a partial checkpoint.
+
+HOST = '127.0.0.1'
+# Longest line accepted, which must hold a trip with its whole route
+LINE_LIMIT = 1 << 24
+COMMANDS = ('totals', 'snapshot', 'checkpoint', 'shutdown')
+
+def recordKind(record):
+    # MDS trips have a route and vehicle status changes an event type
+    if 'route' in record:
+        return 'trips'
+    if 'event_type' in record:
+        return 'changes'
+    return None
+
+class Aggregator:
+    # Adds the records and answers the commands sent to the service
+    def __init__(self, accumulator, checkpoint_filename=None, keep_state=False,
+            decoder='auto', snapshot_dir=None):
+        self.accumulator = accumulator
+        self.checkpoint_filename = checkpoint_filename
+        self.keep_state = keep_state
+        self.snapshot_dir = snapshot_dir
+        self.loads = decoders.getLoads(decoder)
+        # Lines that are not JSON objects, records or commands
+        self.bad_lines = 0
+        self.changed = False
+        self.checkpoints = 0
+        self.stopping = False
+
+    def handleLine(self, line):
+        # Adds a record or runs a command. Returns the response to a command
+        # and None otherwise.
+        if not line.strip():
+            return None
+        try:
+            record = self.loads(line)
+        except ValueError:
+            self.bad_lines += 1
+            return None
+        if not isinstance(record, dict):
+            self.bad_lines += 1
+            return None
+        if 'command' in record:
+            try:
+                return self.command(record)
+            except (KeyError, TypeError, ValueError, OSError) as e:
+                return {'error': str(e)}
+        kind = recordKind(record)
+        if kind is None:
+            self.bad_lines += 1
+            return None
+        try:
+            if kind == 'trips':
+                self.accumulator.addTrip(record)
+            else:
+                self.accumulator.addChange(record)
+        except decoders.RECORD_ERRORS:
+            self.accumulator.bad_records[kind] += 1
+            return None
+        self.changed = True
+        return None
+
+    def command(self, request):
+        command = request['command']
+        if command == 'totals':
+            return self.totals()
+        if command == 'snapshot':
+            return self.snapshot(request.get('privacy_level'), request.get('output_filename'))
+        if command == 'checkpoint':
+            return {'checkpoint': self.checkpoint(force=True)}
+        if command == 'shutdown':
+            self.stopping = True
+            return {'checkpoint': self.checkpoint()}
+        raise ValueError("Unknown command {}, expected one of {}".format(
+            command, ", ".join(COMMANDS)))
+
+    def totals(self):
+        accumulator = self.accumulator
+        return {
+            'trips': accumulator.trip_count,
+            'changes': accumulator.change_count,
+            'bad_records': dict(accumulator.bad_records, lines=self.bad_lines),
+            'start_time': accumulator.earliest_time if accumulator.latest_time else 0,
+            'end_time': accumulator.latest_time,
+            'zones': len(accumulator.geo_ids),
+            'total_trips': dict([(str(period), count)
+                for period, count in sorted(accumulator.total_trips.items())]),
+            'checkpoints': self.checkpoints,
+        }
+
+    def metrics(self, privacy_level=None):
+        metrics = self.accumulator.toMetrics()
+        if privacy_level:
+            return readtrips.suppress(metrics, int(privacy_level))
+        return metrics
+
+    def snapshotFilename(self, output_filename):
+        # Any client may ask for a snapshot, so snapshots are only written to
+        # plain filenames in the snapshot directory
+        if not self.snapshot_dir:
+            raise ValueError("Snapshots are only written to files with --snapshot_dir")
+        if (not isinstance(output_filename, str) or output_filename in ('.', '..')
+                or os.path.basename(output_filename) != output_filename):
+            raise ValueError("Snapshot filename {} must not have a directory".format(
+                output_filename))
+        return os.path.join(self.snapshot_dir, output_filename)
+
+    def snapshot(self, privacy_level=None, output_filename=None):
+        if output_filename:
+            filename = self.snapshotFilename(output_filename)
+            readtrips.writeAtomically({filename:
+                functools.partial(readtrips.outputFile, self.metrics(privacy_level))})
+            return {'output_filename': filename}
+        return {'metrics': json_format.MessageToDict(self.metrics(privacy_level))}
+
+    def checkpoint(self, force=False):
+        # Writes the aggregate to the checkpoint file if it has changed since
+        # the last checkpoint. Returns the filename written, if any.
+        if not self.checkpoint_filename or not (self.changed or force):
+            return None
+        start = time.monotonic()
+        writers = {}
+        if self.keep_state:
+            writers[readtrips.vehicleStateFilename(self.checkpoint_filename)] = \
+                functools.partial(readtrips.saveVehicleState, self.accumulator)
+        writers[self.checkpoint_filename] = functools.partial(readtrips.outputFile,
+            self.accumulator.toMetrics())
+        readtrips.writeAtomically(writers)
+        # Only cleared once written, so that a failed checkpoint is retried
+        self.changed = False
+        self.checkpoints += 1
+        logging.debug("Checkpointed {} trips and {} changes in {:.2f}s".format(
+            self.accumulator.trip_count, self.accumulator.change_count,
+            time.monotonic() - start))
+        return self.checkpoint_filename
+
+async def handleClient(aggregator, stop, reader, writer):
+    try:
+        while not stop.is_set():
+            try:
+                line = await reader.readline()
+            except ValueError:
+                logging.warning("Closing connection with a line over {} bytes".format(LINE_LIMIT))
+                break
+            if not line:
+                break
+            response = aggregator.handleLine(line)
+            if response is not None:
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+            if aggregator.stopping:
+                stop.set()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def checkpointEvery(aggregator, interval):
+    # A checkpoint that cannot be written is tried again after the next
+    # interval, as the aggregate is still marked as changed
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            aggregator.checkpoint()
+        except OSError as e:
+            logging.warning("Could not write checkpoint {}: {}".format(
+                aggregator.checkpoint_filename, e))
+
+async def startServer(client, unix_socket=None, host=HOST, port=0):
+    if unix_socket:
+        return await asyncio.start_unix_server(client, unix_socket, limit=LINE_LIMIT)
+    return await asyncio.start_server(client, host, port, limit=LINE_LIMIT)
+
+async def connect(unix_socket=None, host=HOST, port=0):
+    # Returns the (reader, writer) of a connection to the service
+    if unix_socket:
+        return await asyncio.open_unix_connection(unix_socket, limit=LINE_LIMIT)
+    return await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+
+async def serve(aggregator, unix_socket=None, host=HOST, port=0, checkpoint_interval=60,
+        ready=None):
+    # Runs the service until a shutdown command or SIGINT or SIGTERM, then
+    # writes a final checkpoint. ready, if given, is called with the server
+    # once it is listening.
+    stop = asyncio.Event()
+    server = await startServer(functools.partial(handleClient, aggregator, stop),
+        unix_socket, host, port)
+    loop = asyncio.get_running_loop()
+    signals = []
+    # Signal handlers may only be installed from the main thread
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+            signals.append(signum)
+    checkpoints = None
+    if aggregator.checkpoint_filename and checkpoint_interval > 0:
+        checkpoints = asyncio.ensure_future(checkpointEvery(aggregator, checkpoint_interval))
+    logging.debug("Listening on {}".format(", ".join(
+        str(sock.getsockname()) for sock in server.sockets)))
+    if ready:
+        ready(server)
+    try:
+        await stop.wait()
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+        if checkpoints:
+            checkpoints.cancel()
+        server.close()
+        await server.wait_closed()
+        if unix_socket and os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        aggregator.checkpoint()
+
+def getAggregator(args, zoning, vehicle_sets):
+    # Resumes from the checkpoint if asked to and it exists
+    if args.resume and os.path.exists(args.checkpoint_filename):
+        logging.debug("Resuming from {}".format(args.checkpoint_filename))
+        state_filename = readtrips.vehicleStateFilename(args.checkpoint_filename)
+        vehicle_state = readtrips.loadVehicleState(state_filename) \
+            if os.path.exists(state_filename) else None
+        accumulator = readtrips.accumulatorFromMetrics(
+            readtrips.metricsFromPBF(args.checkpoint_filename), args.accuracy, vehicle_state,
+            zoning)
+    else:
+        accumulator = readtrips.MetricsAccumulator(args.period, args.cycle_length,
+            args.accuracy, zoning=zoning, vehicle_sets=vehicle_sets)
+    return Aggregator(accumulator, args.checkpoint_filename, args.keep_state, args.json_decoder,
+        args.snapshot_dir)
+
+def addAddressArguments(parser):
+    parser.add_argument(
+        '-u', '--unix_socket',
+        help='Unix socket path. A localhost TCP port is used if not given.')
+    parser.add_argument(
+        '-H', '--host',
+        default=HOST,
+        help='Host to listen on or connect to. Localhost by default.')
+    parser.add_argument(
+        '-P', '--port',
+        default=8642,
+        type=int,
+        help='TCP port to listen on or connect to')
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        description='Aggregate MDS trips and vehicle changes sent over a socket, '
+                    'keeping the Metrics in memory')
+    addAddressArguments(parser)
+    parser.add_argument(
+        '-o', '--checkpoint_filename',
+        default="output.pbf",
+        help='Checkpoint PBF filename')
+    parser.add_argument(
+        '-sd', '--snapshot_dir',
+        help='Directory that snapshots requested with an output_filename are '
+             'written to. Snapshots are only returned as JSON if not given.')
+    parser.add_argument(
+        '-ci', '--checkpoint_interval',
+        default=60,
+        type=float,
+        help='Seconds between checkpoints. 0 only checkpoints on request and '
+             'at shutdown.')
+    parser.add_argument(
+        '-r', '--resume',
+        action='store_true',
+        default=False,
+        help='Continue from the checkpoint and its vehicle state, if they exist')
+    parser.add_argument(
+        '-ks', '--keep_state',
+        action='store_true',
+        default=False,
+        help='Write the vehicle state sidecar with each checkpoint, so that '
+             'distinct vehicle counts are kept on --resume')
+    parser.add_argument(
+        '-per', '--period',
+        default=3600,
+        type=int,
+        help='Time period in seconds. Hour by default.')
+    parser.add_argument(
+        '-c', '--cycle_length',
+        default=168,
+        type=int,
+        help='The number of periods in a cycle')
+    parser.add_argument(
+        '-a', '--accuracy',
+        default=3,
+        type=int,
+        help='Decimal digits of GPS accuracy used for zones')
+    parser.add_argument(
+        '-z', '--zones',
+        default='grid',
+        choices=['grid', 'square', 'hex', 'geojson'],
+        help='Zoning backend, as for readtrips')
+    parser.add_argument(
+        '-zf', '--zone_file',
+        help='GeoJSON file of Polygon or MultiPolygon zones')
+    parser.add_argument(
+        '-zp', '--zone_property',
+        help='Feature property used to name GeoJSON zones')
+    parser.add_argument(
+        '-zl', '--zone_level',
+        default=8,
+        type=int,
+        help='Level of the square or hex grid')
+    parser.add_argument(
+        '-av', '--approximate_vehicles',
+        type=int,
+        metavar='PRECISION',
+        help='Estimate distinct vehicle counts with HyperLogLog sketches of '
+             '2**PRECISION registers')
+    parser.add_argument(
+        '-jd', '--json_decoder',
+        default='auto',
+        choices=decoders.DECODERS,
+        help='JSON library used to decode records')
+    return parser
+
+def main(argv=None):
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    parser = getParser()
+    args = parser.parse_args(argv)
+    if args.zones == 'geojson' and not args.zone_file:
+        parser.error("--zones geojson requires --zone_file")
+    if args.approximate_vehicles is not None:
+        if not 4 <= args.approximate_vehicles <= 16:
+            parser.error("--approximate_vehicles must be between 4 and 16")
+        if args.resume or args.keep_state:
+            parser.error("--approximate_vehicles cannot be used with --resume or --keep_state")
+    if args.snapshot_dir and not os.path.isdir(args.snapshot_dir):
+        parser.error("No directory {}".format(args.snapshot_dir))
+    aggregator = getAggregator(args, readtrips.getZoning(args), readtrips.getVehicleSets(args))
+    asyncio.run(serve(aggregator, args.unix_socket, args.host, args.port,
+        args.checkpoint_interval))
+    logging.debug("Stopped after {} trips and {} changes".format(
+        aggregator.accumulator.trip_count, aggregator.accumulator.change_count))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import instrument
+import json
+import logging
+
+# Decoding of line-delimited MDS trips and vehicle status changes. Lines are
+# parsed with orjson when it is installed, which is several times faster than
+# the json module, and only the fields that readtrips aggregates are extracted.
+# Records may optionally be checked against a schema of those fields, either
+# all of them or a sample, and bad records are counted and skipped.
+
+DECODERS = ('auto', 'json', 'orjson')
+
+# Errors raised by records that are malformed or missing fields. JSON decoding
+# errors are ValueErrors for both json and orjson.
+RECORD_ERRORS = (KeyError, IndexError, TypeError, ValueError)
+
+POINT_SCHEMA = {
+    'type': 'object',
+    'required': ['geometry'],
+    'properties': {
+        'geometry': {
+            'type': 'object',
+            'required': ['coordinates'],
+            'properties': {
+                'coordinates': {
+                    'type': 'array',
+                    'minItems': 2,
+                    'items': {'type': 'number'},
+                },
+            },
+        },
+    },
+}
+
+# The fields of an MDS trip used by readtrips
+TRIP_SCHEMA = {
+    'type': 'object',
+    'required': ['vehicle_id', 'trip_duration', 'trip_distance', 'start_time', 'route'],
+    'properties': {
+        'vehicle_id': {'type': 'string'},
+        'trip_duration': {'type': 'number'},
+        'trip_distance': {'type': 'number'},
+        'start_time': {'type': 'number'},
+        'route': {
+            'type': 'object',
+            'required': ['features'],
+            'properties': {
+                'features': {
+                    'type': 'array',
+                    'items': {
+                        'allOf': [POINT_SCHEMA, {
+                            'required': ['properties'],
+                            'properties': {
+                                'properties': {
+                                    'type': 'object',
+                                    'required': ['timestamp'],
+                                    'properties': {'timestamp': {'type': 'number'}},
+                                },
+                            },
+                        }],
+                    },
+                },
+            },
+        },
+    },
+}
+
+# The fields of an MDS vehicle status change used by readtrips
+CHANGE_SCHEMA = {
+    'type': 'object',
+    'required': ['vehicle_id', 'event_time', 'event_type', 'event_location'],
+    'properties': {
+        'vehicle_id': {'type': 'string'},
+        'event_time': {'type': 'number'},
+        'event_type': {'type': 'string'},
+        'event_location': POINT_SCHEMA,
+    },
+}
+
+SCHEMAS = {'trips': TRIP_SCHEMA, 'changes': CHANGE_SCHEMA}
+
+def getLoads(decoder='auto'):
+    # Returns the function used to parse JSON lines
+    if decoder not in DECODERS:
+        raise ValueError("Unknown JSON decoder {}".format(decoder))
+    if decoder != 'json':
+        try:
+            import orjson
+            return orjson.loads
+        except ImportError:
+            if decoder == 'orjson':
+                raise ImportError("The orjson decoder requires the orjson package")
+    return json.loads
+
+def tripFields(trip):
+    # Returns (start_time, trip_duration, trip_distance, coordinates,
+    # timestamps) of a trip, with a coordinate pair and timestamp per route
+    # point
+    features = trip['route']['features']
+    return (trip['start_time'], float(trip['trip_duration']), float(trip['trip_distance']),
+        [route_point['geometry']['coordinates'] for route_point in features],
+        [route_point['properties']['timestamp'] for route_point in features])
+
+def changeFields(change):
+    # Returns (event_time, vehicle_id, event_type, coordinates) of a change
+    (lat, long) = map(float, change['event_location']['geometry']['coordinates'])
+    return (change['event_time'], change['vehicle_id'], change['event_type'], (lat, long))
+
+class RecordDecoder:
+    # Decodes the lines of a trips or changes file into records. When
+    # validate_every is n, every nth record is checked against the schema of
+    # its kind, so that validation costs a fraction of decoding. Lines that
+    # cannot be decoded and records that fail validation are counted in
+    # bad_records and skipped.
+    def __init__(self, kind, decoder='auto', validate_every=0):
+        self.kind = kind
+        self.loads = getLoads(decoder)
+        if instrument.detailed():
+            self.loads = instrument.timed('decode', self.loads)
+        self.validate_every = validate_every
+        self.validator = None
+        if validate_every:
+            import jsonschema
+            self.validator = jsonschema.Draft7Validator(SCHEMAS[kind])
+        self.records = 0
+        self.bad_records = 0
+
+    def decode(self, line):
+        # Returns the record of a line, or None if it is blank or bad
+        if not line.strip():
+            return None
+        self.records += 1
+        try:
+            record = self.loads(line)
+        except ValueError as e:
+            self.badRecord(e)
+            return None
+        if self.validator and self.records % self.validate_every == 0:
+            error = next(self.validator.iter_errors(record), None)
+            if error is not None:
+                self.badRecord(error.message)
+                return None
+        return record
+
+    def decodeAll(self, lines):
+        for line in lines:
+            record = self.decode(line)
+            if record is not None:
+                yield record
+
+    def badRecord(self, error):
+        self.bad_records += 1
+        if self.bad_records == 1:
+            logging.debug("Bad record {} of {}: {}".format(self.records, self.kind, error))
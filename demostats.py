@@ -1,22 +1,31 @@
-from pb.amms_pb2 import Metrics
 from datetime import datetime as dt
 import argparse
-import google.protobuf.json_format as json_format
+import heapq
+import json
+import math
+import packed
 import readtrips
 import sys
+import zones
 
 def getspark(series, hi, lo):
     sparkchars = "▁▂▃▄▅▆▇█"
     c = (len(sparkchars)-1)/float(hi-lo) if hi != lo else len(sparkchars)/2
     return "".join(list(map(lambda x: sparkchars[round((x-lo)*c)], series)))
 
-def sparkline(title, cycle, numerator, denominator=None, units="", precision=0):
-    if not numerator:
-        return
+def seriesPeriods(metrics):
+    # The periods of a cycle, or those from the start to the end time of an
+    # absolute series, which has a cycle length of 0
+    if metrics.cycle_length or not metrics.period_seconds:
+        return range(0, metrics.cycle_length)
+    return range(metrics.start_time // metrics.period_seconds,
+        -(-metrics.end_time // metrics.period_seconds))
+
+def getSeries(periods, numerator, denominator=None):
     series = []
-    for k in range(0, cycle):
+    for k in periods:
         if denominator:
-            if k in numerator and denominator[k]:
+            if k in numerator and denominator.get(k):
                 series.append(float(numerator[k])/denominator[k])
             else:
                 series.append(0)
@@ -25,42 +34,158 @@ def sparkline(title, cycle, numerator, denominator=None, units="", precision=0):
                 series.append(numerator[k])
             else:
                 series.append(0)
+    return series
+
+def sparkline(title, periods, numerator, denominator=None, units="", precision=0):
+    if not numerator or not periods:
+        return
+    series = getSeries(periods, numerator, denominator)
     sumval, hi, ave, lo = sum(series), max(series), sum(series)/len(series), min(series)
     spark = getspark(series, hi, lo)
     print("{title:<18} Min: {min:>6.{precision}f} {units:3} Ave: {ave:>6.{precision}f} {units:3} Max: {max:>6.{precision}f} {units:3} Sum: {sum:>6.{precision}f}".format(
         sum=sumval, title=title, max=hi, ave=ave, min=lo, units=units, precision=precision))
     print("{spark}".format(spark=spark))
 
+class TopN:
+    # Keeps the n largest counts seen in a bounded heap. Ties keep the order
+    # in which counts were added, as a stable sort would.
+    def __init__(self, n, reverse=True):
+        self.n = n
+        self.sign = 1 if reverse else -1
+        self.heap = []
+        self.index = 0
+
+    def add(self, key, count):
+        self.index -= 1
+        entry = (self.sign * count, self.index, key, count)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def items(self):
+        return [(key, count) for _, _, key, count in sorted(self.heap, reverse=True)]
+
 def top_n(values, n=5, reverse=True):
-    zone_volume = {}
-    for hour in values:
-        for geo_id in values[hour].data:
-            zone_volume[(hour, geo_id)] = values[hour].data[geo_id]
-    l = list(zone_volume.items())
-    s = sorted(zone_volume.items(), key = lambda x: x[1], reverse=reverse)
-    return s[:n]
+    top = TopN(n, reverse)
+    for hour, counts in values.items():
+        for geo_id, count in counts.data.items():
+            top.add((hour, geo_id), count)
+    return top.items()
 
 def getTotalByPeriod(metrics, field_name):
     output_series = []
     field = getattr(metrics, field_name)
-    for period in field:
+    for period, values in field.items():
         tally = 0
-        for pickup in field[period].data:
-            v = field[period].data[pickup]
+        for v in values.data.values():
             if hasattr(v, "data"):
-                for dropoff in v.data:
-                    tally += v.data[dropoff]
+                tally += sum(v.data.values())
             else:
                 tally += v
         output_series.append((period, tally))
     return dict(output_series)
 
-def printSparkLines(metrics):
+# Period fields that are summed over zones for the report
+TOTAL_FIELDS = ('trip_volumes', 'flows', 'availability', 'on_street')
+
+class Report:
+    # Computes everything demostats prints in one pass over each field of
+    # metrics, and keeps it so that the printed and JSON reports share it
+    def __init__(self, metrics, top=10):
+        self.metrics = metrics
+        self.totals = {}
+        for field_name in TOTAL_FIELDS:
+            if field_name != 'trip_volumes':
+                self.totals[field_name] = getTotalByPeriod(metrics, field_name)
+        # Trip volume totals are tallied along with the top volumes
+        totals = {}
+        top_trip_volumes = TopN(top)
+        for period, counts in metrics.trip_volumes.items():
+            tally = 0
+            for geo_id, count in counts.data.items():
+                tally += count
+                top_trip_volumes.add((period, geo_id), count)
+            totals[period] = tally
+        self.totals['trip_volumes'] = totals
+        self.top_trip_volumes = top_trip_volumes.items()
+        self.total_trip_volume = sum(self.totals['trip_volumes'].values())
+        self.total_flows = sum(self.totals['flows'].values())
+        self.sweeps = {}
+
+    def suppressionSweep(self, privacy_levels):
+        key = tuple(privacy_levels)
+        if key not in self.sweeps:
+            self.sweeps[key] = readtrips.suppressionSweep(self.metrics, privacy_levels)
+        return self.sweeps[key]
+
+    def suppressionStats(self, privacy_levels):
+        # (privacy level, volume suppressed, % volume, flows suppressed, % flows)
+        sweep = self.suppressionSweep(privacy_levels)
+        stats = []
+        for privacy_level in privacy_levels:
+            (volume_suppressed, flows_suppressed) = sweep[privacy_level]
+            total_trip_volume, total_flows = self.total_trip_volume, self.total_flows
+            percent_volume_suppressed = 100*(float(volume_suppressed)/total_trip_volume) if total_trip_volume else 0
+            percent_flows_suppressed = 100*(float(flows_suppressed)/total_flows) if total_flows else 0
+            stats.append((privacy_level, volume_suppressed, percent_volume_suppressed,
+                flows_suppressed, percent_flows_suppressed))
+        return stats
+
+    def sparkLines(self):
+        # (title, numerator, denominator, units, precision) of each sparkline
+        metrics = self.metrics
+        return [
+            ("Trips by period", metrics.total_trips, None, "", 0),
+            ("Average distance", metrics.total_distance, metrics.total_trips, "M", 0),
+            ("Average duration", metrics.total_duration, metrics.total_trips, "s", 0),
+            ("Average speed", metrics.total_distance, metrics.total_duration, "M/s", 2),
+            ("Trip Volume", self.totals['trip_volumes'], None, "", 0),
+            ("Flows", self.totals['flows'], None, "", 0),
+            ("Availability", self.totals['availability'], None, "", 0),
+            ("On Street", self.totals['on_street'], None, "", 0),
+        ]
+
+    def toJSON(self, privacy_levels):
+        metrics = self.metrics
+        top_trip_volumes = []
+        centers = zones.zoneCenters(metrics)
+        for (hour, geo_id), count in self.top_trip_volumes:
+            if metrics.geo_ids[geo_id]:
+                # Zones without coordinates, such as the outside zone, have
+                # null coordinates, as JSON has no NaN
+                lat, long = [None if math.isnan(value) else value for value in centers[geo_id]]
+                top_trip_volumes.append({'period': hour, 'zone': metrics.geo_ids[geo_id],
+                    'lat': lat, 'long': long, 'count': count})
+        return {
+            'total_trips': sum(metrics.total_trips.values()),
+            'start_time': metrics.start_time,
+            'end_time': metrics.end_time,
+            'period_seconds': metrics.period_seconds,
+            'cycle_length': metrics.cycle_length,
+            'privacy_level': metrics.privacy_level,
+            'trip_volume_suppressed': metrics.trip_volume_suppressed,
+            'total_trip_volume': self.total_trip_volume,
+            'flows_suppressed': metrics.flows_suppressed,
+            'total_flows': self.total_flows,
+            'series': dict([(title.lower().replace(' ', '_'),
+                    getSeries(seriesPeriods(metrics), numerator, denominator))
+                for title, numerator, denominator, _, _ in self.sparkLines() if numerator]),
+            'top_trip_volumes': top_trip_volumes,
+            'privacy_suppression': [{
+                    'privacy_level': privacy_level,
+                    'volume_suppressed': volume_suppressed,
+                    'percent_volume_suppressed': percent_volume_suppressed,
+                    'flows_suppressed': flows_suppressed,
+                    'percent_flows_suppressed': percent_flows_suppressed,
+                } for (privacy_level, volume_suppressed, percent_volume_suppressed,
+                    flows_suppressed, percent_flows_suppressed)
+                in self.suppressionStats(privacy_levels)],
+        }
+
+def printSparkLines(metrics, report=None):
+    report = report or Report(metrics)
     daily_trips = sum(metrics.total_trips.values())
-    trip_volume_by_period = getTotalByPeriod(metrics, 'trip_volumes')
-    flows_by_period = getTotalByPeriod(metrics, 'flows')
-    available_by_period = getTotalByPeriod(metrics, 'availability')
-    on_street_by_period = getTotalByPeriod(metrics, 'on_street')
 
     print("Total trips: {}".format(daily_trips))
     print("Start: {}".format(dt.fromtimestamp(metrics.start_time)))
@@ -68,68 +193,65 @@ def printSparkLines(metrics):
     print("Period: {} seconds".format(metrics.period_seconds))
     print("Cycle length: {}".format(metrics.cycle_length))
 
-    trip_volume_by_period = getTotalByPeriod(metrics, 'trip_volumes')
-    total_trip_volume = sum(trip_volume_by_period.values())
-    flows_by_period = getTotalByPeriod(metrics, 'flows')
-    total_flows = sum(flows_by_period.values())
     print("Privacy: {}".format(metrics.privacy_level))
-    print("Volume Suppressed: {}\tTotal Volume: {}".format(metrics.trip_volume_suppressed, total_trip_volume))
-    print("Flow Suppressed: {}\tTotal Flows: {}".format(metrics.flows_suppressed, total_flows))
-    sparkline("Trips by period", metrics.cycle_length, metrics.total_trips)
-    sparkline("Average distance", metrics.cycle_length, metrics.total_distance, metrics.total_trips, units="M")
-    sparkline("Average duration", metrics.cycle_length, metrics.total_duration, metrics.total_trips, units="s")
-    sparkline("Average speed", metrics.cycle_length, metrics.total_distance, metrics.total_duration, units="M/s", precision=2)
-    sparkline("Trip Volume", metrics.cycle_length, trip_volume_by_period)
-    sparkline("Flows", metrics.cycle_length, flows_by_period)
-    sparkline("Availability", metrics.cycle_length, available_by_period)
-    sparkline("On Street", metrics.cycle_length, on_street_by_period)
-
-def printTopTripVolumes(metrics):
+    print("Volume Suppressed: {}\tTotal Volume: {}".format(metrics.trip_volume_suppressed, report.total_trip_volume))
+    print("Flow Suppressed: {}\tTotal Flows: {}".format(metrics.flows_suppressed, report.total_flows))
+    for title, numerator, denominator, units, precision in report.sparkLines():
+        sparkline(title, seriesPeriods(metrics), numerator, denominator, units=units, precision=precision)
+
+def printTopTripVolumes(metrics, report=None):
+    report = report or Report(metrics)
     print("Top Trip Volumes")
-    print("{:<10}{:<10}{:<10}{:<10}".format("Period", "Lat", "Long", "Count"))
-    top_vol = top_n(metrics.trip_volumes, 10)
-    for (hour, geo_id), count in top_vol:
+    print("{:<10}{:<20}{:<10}".format("Period", "Zone", "Count"))
+    for (hour, geo_id), count in report.top_trip_volumes:
         if metrics.geo_ids[geo_id]:
-            lat, long = metrics.geo_ids[geo_id].split(":")
-            print("{:<10}{:<10}{:<10}{:<10}".format(hour, lat, long, count))
+            print("{:<10}{:<20}{:<10}".format(hour, metrics.geo_ids[geo_id], count))
 
-def printPrivacySuppressionStats(metrics, privacy_levels):
+def printPrivacySuppressionStats(metrics, privacy_levels, report=None):
+    report = report or Report(metrics)
     print("Privacy Flow Suppression")
     print("{:>15}{:>15}{:>8}{:>15}{:>8}".format(
         "Privacy Level", "Supp. Volume", "%", "Supp. Flows", "%"))
-    trip_volume_by_period = getTotalByPeriod(metrics, 'trip_volumes')
-    total_trip_volume = sum(trip_volume_by_period.values())
-    flows_by_period = getTotalByPeriod(metrics, 'flows')
-    total_flows = sum(flows_by_period.values())
-    for privacy_level in privacy_levels:
-        suppressed = readtrips.suppress(metrics, privacy_level)
-        percent_volume_suppressed = 100*(float(suppressed.trip_volume_suppressed)/total_trip_volume) if total_trip_volume else 0
-        percent_flows_suppressed = 100*(float(suppressed.flows_suppressed)/total_flows) if total_flows else 0
-
-        print("{:>15}{:>15}{:>8.2f}{:>15}{:>8.2f}".format(
-            privacy_level,
-            suppressed.trip_volume_suppressed,
-            percent_volume_suppressed,
-            suppressed.flows_suppressed,
-            percent_flows_suppressed)
-        )
-
-def main():
+    for stats in report.suppressionStats(privacy_levels):
+        print("{:>15}{:>15}{:>8.2f}{:>15}{:>8.2f}".format(*stats))
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description='Aggregate MDS trip data into a Metrics protocol buffer')
     parser.add_argument(
         'input_filename',
         help='Input PBF filname'
     )
-    args = parser.parse_args()
-    metrics = Metrics()
-    with open(args.input_filename, 'rb') as pbfile:
-        metrics.ParseFromString(pbfile.read())
-    printSparkLines(metrics)
+    parser.add_argument(
+        '-p', '--privacy_levels',
+        nargs='+',
+        default=[1, 2, 3, 4, 5],
+        type=readtrips.privacyLevel,
+        help='Privacy levels to report suppression statistics for')
+    parser.add_argument(
+        '-mp', '--max_privacy',
+        type=readtrips.privacyLevel,
+        help='Report every privacy level from 1 to this level instead')
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        default=False,
+        help='Print the report as JSON')
+    args = parser.parse_args(argv)
+    metrics = packed.loadMetrics(args.input_filename)
+    if args.max_privacy is not None:
+        privacy_levels = list(range(1, args.max_privacy + 1))
+    else:
+        privacy_levels = args.privacy_levels
+    report = Report(metrics)
+    if args.json:
+        print(json.dumps(report.toJSON(privacy_levels), indent=2))
+        return
+    printSparkLines(metrics, report)
     print()
-    printTopTripVolumes(metrics)
+    printTopTripVolumes(metrics, report)
     print()
-    printPrivacySuppressionStats(metrics, [1, 2, 3, 4, 5])
+    printPrivacySuppressionStats(metrics, privacy_levels, report)
 
 if __name__ == "__main__":
     sys.exit(main())
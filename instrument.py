@@ -0,0 +1,132 @@
+import contextlib
+import functools
+import json
+import logging
+import time
+
+# Timers and counters for the stages of a run, such as reading, suppression
+# and writing, which are saved as JSON alongside the output. Stages may nest,
+# e.g. decode and zone_lookup are part of read. Timing every record would
+# slow the hot path down, so decode and zone_lookup are only timed when stats
+# are detailed, as with readtrips --profile.
+
+class Stats:
+    def __init__(self, detailed=False):
+        self.detailed = detailed
+        self.seconds = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+
+    def addTime(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def toJSON(self):
+        return {
+            'total_seconds': time.perf_counter() - self.start,
+            'stages': dict(self.seconds),
+            'counters': dict(self.counters),
+        }
+
+# The stats of the current run
+STATS = Stats()
+
+def reset(detailed=False):
+    global STATS
+    STATS = Stats(detailed)
+    return STATS
+
+def stage(name):
+    return STATS.stage(name)
+
+def count(name, value=1):
+    STATS.count(name, value)
+
+def detailed():
+    return STATS.detailed
+
+def timed(name, function):
+    # Wraps function so that its calls are timed as the stage name
+    @functools.wraps(function)
+    def timedFunction(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            STATS.addTime(name, time.perf_counter() - start)
+    return timedFunction
+
+def timer(name):
+    # Decorator timing every call of a function as the stage name
+    return functools.partial(timed, name)
+
+class TimedZones:
+    # Times the lookups of a zoning backend as zone_lookup
+    def __init__(self, backend):
+        self.backend = backend
+
+    def zone(self, lat, long):
+        start = time.perf_counter()
+        try:
+            return self.backend.zone(lat, long)
+        finally:
+            STATS.addTime('zone_lookup', time.perf_counter() - start)
+
+    def zones(self, coordinates):
+        start = time.perf_counter()
+        try:
+            return self.backend.zones(coordinates)
+        finally:
+            STATS.addTime('zone_lookup', time.perf_counter() - start)
+
+def statsFilename(output_filename):
+    return output_filename + ".stats.json"
+
+def saveStats(stats_filename, **fields):
+    # Writes the current stats, along with any other fields, as JSON
+    stats = dict(fields)
+    stats.update(STATS.toJSON())
+    logging.debug("Writing stats to {}".format(stats_filename))
+    with open(stats_filename, 'w') as f:
+        json.dump(stats, f, indent=2)
+    return stats
+
+@contextlib.contextmanager
+def profile(profile_filename, top=20):
+    # Profiles the block with cProfile and tracemalloc, logs the functions
+    # with the most cumulative time and the lines that allocated the most
+    # memory, and saves the cProfile stats to profile_filename for pstats or
+    # other viewers
+    import cProfile
+    import io
+    import pstats
+    import tracemalloc
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(profile_filename)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(top)
+        logging.debug("cProfile, saved to {}:\n{}".format(profile_filename, output.getvalue()))
+        allocations = "\n".join([str(statistic)
+            for statistic in snapshot.statistics('lineno')[:top]])
+        logging.debug("tracemalloc peak {:.1f} MB, top allocations:\n{}".format(
+            peak / 1024.0 / 1024.0, allocations))
+        count('traced_peak_bytes', peak)
@@ -0,0 +1,20 @@
+import importlib.util
+import sys
+
+# Heavy dependencies such as numpy and pandas take longer to import than the
+# tools take to process a small file. lazyImport returns a module that is only
+# loaded when one of its attributes is first used, so commands that never use
+# it do not pay for it.
+
+def lazyImport(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named {}".format(name))
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
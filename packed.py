@@ -0,0 +1,175 @@
+from pb.amms_pb2 import Metrics
+import instrument
+import lazy
+
+np = lazy.lazyImport('numpy')
+
+# Converts between the nested map encoding of Metrics counts and the packed
+# columnar encoding, see PackedCounts and PackedFlows in amms.proto.
+
+# Count maps and their packed equivalents
+PACKED_COUNTS = [
+    ('trip_volumes', 'packed_trip_volumes'),
+    ('pickups', 'packed_pickups'),
+    ('dropoffs', 'packed_dropoffs'),
+    ('availability', 'packed_availability'),
+    ('on_street', 'packed_on_street'),
+]
+
+def deltaEncode(values, segment_starts):
+    # Differences from the previous value, except at the start of a segment
+    # where the value itself is kept
+    deltas = np.diff(values, prepend=0)
+    deltas[segment_starts] = values[segment_starts]
+    return deltas
+
+def deltaDecode(deltas, segment_starts):
+    # Inverse of deltaEncode: a cumulative sum that restarts at each segment
+    totals = np.cumsum(deltas)
+    segment = np.cumsum(segment_starts) - 1
+    bases = (totals - deltas)[segment_starts]
+    return totals - bases[segment]
+
+def segmentStarts(*columns):
+    # Marks entries whose leading columns differ from the previous entry
+    starts = np.zeros(len(columns[0]), dtype=bool)
+    if len(starts):
+        starts[0] = True
+    for column in columns:
+        starts[1:] |= column[1:] != column[:-1]
+    return starts
+
+def countArrays(metrics, field_name):
+    # Returns (periods, geo_ids, counts) arrays of a count map, from whichever
+    # encoding metrics uses. Arrays from the packed encoding are sorted.
+    packed = dict(PACKED_COUNTS)[field_name]
+    if metrics.HasField(packed):
+        counts = getattr(metrics, packed)
+        period_deltas = np.array(counts.periods, dtype=np.int64)
+        periods = np.cumsum(period_deltas)
+        geo_ids = deltaDecode(np.array(counts.geo_ids, dtype=np.int64),
+            segmentStarts(periods))
+        return periods, geo_ids, np.array(counts.counts, dtype=np.int64)
+    field = getattr(metrics, field_name)
+    rows = [(period, geo_id, count)
+        for period in field for geo_id, count in field[period].data.items()]
+    return tuple(np.array(column, dtype=np.int64).reshape(-1)
+        for column in (zip(*rows) if rows else ([], [], [])))
+
+def flowArrays(metrics):
+    # Returns (periods, pickups, dropoffs, counts) arrays of the flows
+    if metrics.HasField('packed_flows'):
+        flows = metrics.packed_flows
+        periods = np.cumsum(np.array(flows.periods, dtype=np.int64))
+        pickups = deltaDecode(np.array(flows.pickups, dtype=np.int64),
+            segmentStarts(periods))
+        dropoffs = deltaDecode(np.array(flows.dropoffs, dtype=np.int64),
+            segmentStarts(periods, pickups))
+        return periods, pickups, dropoffs, np.array(flows.counts, dtype=np.int64)
+    rows = [(period, pickup, dropoff, count)
+        for period in metrics.flows
+        for pickup, dropoffs in metrics.flows[period].data.items()
+        for dropoff, count in dropoffs.data.items()]
+    return tuple(np.array(column, dtype=np.int64).reshape(-1)
+        for column in (zip(*rows) if rows else ([], [], [], [])))
+
+def isPacked(metrics):
+    return any(metrics.HasField(packed) for _, packed in PACKED_COUNTS) or \
+        metrics.HasField('packed_flows')
+
+def packCountArrays(packed_counts, periods, geo_ids, counts):
+    # Fills PackedCounts with the given columns, sorted by period and geo_id
+    order = np.lexsort((geo_ids, periods))
+    periods, geo_ids, counts = periods[order], geo_ids[order], counts[order]
+    packed_counts.periods.extend(np.diff(periods, prepend=0).tolist())
+    packed_counts.geo_ids.extend(deltaEncode(geo_ids, segmentStarts(periods)).tolist())
+    packed_counts.counts.extend(counts.tolist())
+
+def packFlowArrays(packed_flows, periods, pickups, dropoffs, counts):
+    # Fills PackedFlows with the given columns, sorted by period, pickup and
+    # dropoff
+    order = np.lexsort((dropoffs, pickups, periods))
+    periods, pickups, dropoffs, counts = (
+        periods[order], pickups[order], dropoffs[order], counts[order])
+    packed_flows.periods.extend(np.diff(periods, prepend=0).tolist())
+    packed_flows.pickups.extend(deltaEncode(pickups, segmentStarts(periods)).tolist())
+    packed_flows.dropoffs.extend(
+        deltaEncode(dropoffs, segmentStarts(periods, pickups)).tolist())
+    packed_flows.counts.extend(counts.tolist())
+
+def keyArrays(counts, width):
+    # Returns the columns of the tuple keys of a dict of counts and an array
+    # of the counts
+    keys = np.array(list(counts.keys()), dtype=np.int64).reshape(-1, width)
+    return tuple(keys.T) + (np.array(list(counts.values()), dtype=np.int64),)
+
+def packCountDict(packed_counts, counts):
+    # Fills PackedCounts from a dict of {(period, geo_id): count}
+    if counts:
+        packCountArrays(packed_counts, *keyArrays(counts, 2))
+
+def packFlowDict(packed_flows, flows):
+    # Fills PackedFlows from a dict of {(period, pickup, dropoff): count}
+    if flows:
+        packFlowArrays(packed_flows, *keyArrays(flows, 3))
+
+def unpackCountDict(metrics, field_name):
+    # Returns a count map of metrics as a dict of {(period, geo_id): count}
+    (periods, geo_ids, counts) = countArrays(metrics, field_name)
+    return dict(zip(zip(periods.tolist(), geo_ids.tolist()), counts.tolist()))
+
+def unpackFlowDict(metrics):
+    # Returns the flows of metrics as a dict of {(period, pickup, dropoff): count}
+    (periods, pickups, dropoffs, counts) = flowArrays(metrics)
+    return dict(zip(zip(periods.tolist(), pickups.tolist(), dropoffs.tolist()),
+        counts.tolist()))
+
+@instrument.timer('pack')
+def packMetrics(metrics):
+    # Returns a copy of metrics with the count maps in the packed encoding
+    output = Metrics()
+    output.CopyFrom(metrics)
+    for field_name, packed in PACKED_COUNTS:
+        (periods, geo_ids, counts) = countArrays(metrics, field_name)
+        output.ClearField(field_name)
+        output.ClearField(packed)
+        if len(counts):
+            packCountArrays(getattr(output, packed), periods, geo_ids, counts)
+    (periods, pickups, dropoffs, counts) = flowArrays(metrics)
+    output.ClearField('flows')
+    output.ClearField('packed_flows')
+    if len(counts):
+        packFlowArrays(output.packed_flows, periods, pickups, dropoffs, counts)
+    return output
+
+def unpackMetrics(metrics):
+    # Moves any packed counts of metrics into the count maps, in place
+    for field_name, packed in PACKED_COUNTS:
+        if not metrics.HasField(packed):
+            continue
+        (periods, geo_ids, counts) = countArrays(metrics, field_name)
+        field = getattr(metrics, field_name)
+        for period, geo_id, count in zip(periods.tolist(), geo_ids.tolist(), counts.tolist()):
+            field[period].data[geo_id] += count
+        metrics.ClearField(packed)
+    if metrics.HasField('packed_flows'):
+        (periods, pickups, dropoffs, counts) = flowArrays(metrics)
+        for period, pickup, dropoff, count in zip(
+                periods.tolist(), pickups.tolist(), dropoffs.tolist(), counts.tolist()):
+            metrics.flows[period].data[pickup].data[dropoff] += count
+        metrics.ClearField('packed_flows')
+    return metrics
+
+@instrument.timer('read_pbf')
+def readMetrics(input_filename):
+    # Reads a PBF file as it is encoded. Packed counts stay packed, so readers
+    # of countArrays and flowArrays skip building the nested maps.
+    with open(input_filename, 'rb') as pbfile:
+        metrics = Metrics()
+        metrics.ParseFromString(pbfile.read())
+    return metrics
+
+def loadMetrics(input_filename):
+    # Reads a PBF file in either the nested map or packed encoding, and
+    # returns it in the nested map encoding
+    return unpackMetrics(readMetrics(input_filename))
@@ -0,0 +1,178 @@
+import argparse
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+# An on-disk cache of the partial aggregates of input files, keyed by a hash
+# of each file's content and the settings it was aggregated with, so that
+# files that have not changed need not be parsed again. An entry is a set of
+# files named [key][suffix] and a [key].json file describing them, which is
+# written last so that only complete entries are found. Entries are evicted
+# least recently used first once the cache is over its size limit, using the
+# modification time of the description, which is updated on every use.
+
+CACHE_VERSION = 1
+DEFAULT_MAX_MB = 1024
+META_SUFFIX = '.json'
+HASH_CHUNK_BYTES = 1 << 20
+
+def fileDigest(filename):
+    # The SHA-256 of a file's content
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cacheKey(digest, settings):
+    # The key of the partial aggregate of a file with the given content digest
+    # and settings, which must be JSON serializable
+    key = json.dumps({'version': CACHE_VERSION, 'digest': digest, 'settings': settings},
+        sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+class PartialCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_MB << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key):
+        # Returns the description of a complete entry, marking it as used, or
+        # None if there is no such entry
+        meta_filename = self.filename(key, META_SUFFIX)
+        try:
+            with open(meta_filename) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not all(os.path.exists(self.filename(key, suffix)) for suffix in meta['files']):
+            return None
+        os.utime(meta_filename)
+        return meta
+
+    def put(self, key, writers, meta):
+        # Adds an entry. writers maps each suffix to a function writing that
+        # file of the entry to the filename it is given. Files are written
+        # under temporary names and renamed.
+        size = 0
+        for suffix, write in writers.items():
+            size += self.writeFile(self.filename(key, suffix), write)
+        meta = dict(meta, files=list(writers), size=size, created=time.time())
+        self.writeFile(self.filename(key, META_SUFFIX),
+            lambda filename: writeJSON(filename, meta))
+        return meta
+
+    def writeFile(self, filename, write):
+        temporary = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            write(temporary)
+            size = os.path.getsize(temporary)
+            os.replace(temporary, filename)
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+        return size
+
+    def remove(self, key):
+        meta_filename = self.filename(key, META_SUFFIX)
+        try:
+            with open(meta_filename) as f:
+                suffixes = json.load(f)['files']
+        except (OSError, ValueError, KeyError):
+            suffixes = []
+        for filename in [meta_filename] + [self.filename(key, suffix) for suffix in suffixes]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def entries(self):
+        # Returns the entries as dicts of their key, last use and description,
+        # most recently used first
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(META_SUFFIX):
+                continue
+            meta_filename = os.path.join(self.directory, name)
+            try:
+                with open(meta_filename) as f:
+                    meta = json.load(f)
+                last_used = os.path.getmtime(meta_filename)
+            except (OSError, ValueError):
+                continue
+            entries.append(dict(meta, key=name[:-len(META_SUFFIX)], last_used=last_used))
+        entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+        return entries
+
+    def prune(self, max_bytes=None):
+        # Removes the least recently used entries until the cache is no larger
+        # than max_bytes, its size limit by default. Returns the removed keys.
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum([entry.get('size', 0) for entry in entries])
+        removed = []
+        while entries and total > max_bytes:
+            entry = entries.pop()
+            self.remove(entry['key'])
+            total -= entry.get('size', 0)
+            removed.append(entry['key'])
+        if removed:
+            logging.debug("Evicted {} cached partial aggregates".format(len(removed)))
+        return removed
+
+def writeJSON(filename, value):
+    with open(filename, 'w') as f:
+        json.dump(value, f)
+
+def printEntries(cache):
+    entries = cache.entries()
+    print("{:<14}{:<9}{:>10}{:>10}{:>12}  {:<20}{}".format(
+        "Key", "Kind", "Records", "Bad", "Size", "Last used", "Source"))
+    for entry in entries:
+        print("{:<14}{:<9}{:>10}{:>10}{:>12}  {:<20}{}".format(
+            entry['key'][:12], entry.get('kind', ''),
+            entry.get('trips', 0) + entry.get('changes', 0),
+            sum(entry.get('bad_records', {}).values()), entry.get('size', 0),
+            dt.datetime.fromtimestamp(entry['last_used']).strftime("%Y-%m-%d %H:%M:%S"),
+            entry.get('source', '')))
+    print("{} entries, {} bytes".format(
+        len(entries), sum([entry.get('size', 0) for entry in entries])))
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        description='Inspect or prune a cache of partial aggregates, see readtrips --cache_dir')
+    parser.add_argument(
+        'command',
+        choices=['inspect', 'prune'],
+        help='inspect lists the entries, most recently used first. prune '
+             'removes the least recently used entries.')
+    parser.add_argument(
+        'cache_dir',
+        help='Cache directory')
+    parser.add_argument(
+        '-ms', '--max_size',
+        default=DEFAULT_MAX_MB,
+        type=float,
+        help='Size in MB to prune the cache to. 0 removes every entry.')
+    return parser
+
+def main(argv=None):
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    args = getParser().parse_args(argv)
+    if not os.path.isdir(args.cache_dir):
+        print("No cache at {}".format(args.cache_dir), file=sys.stderr)
+        return 1
+    cache = PartialCache(args.cache_dir)
+    if args.command == 'prune':
+        removed = cache.prune(int(args.max_size * (1 << 20)))
+        print("Removed {} entries".format(len(removed)))
+    printEntries(cache)
+
+if __name__ == "__main__":
+    sys.exit(main())
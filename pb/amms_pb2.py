@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: amms.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\namms.proto\"\xcc\x0f\n\x07Metrics\x12\x12\n\nstart_time\x18\x01 \x01(\x04\x12\x10\n\x08\x65nd_time\x18\x02 \x01(\x04\x12\x16\n\x0eperiod_seconds\x18\x03 \x01(\r\x12\x14\n\x0c\x63ycle_length\x18\x04 \x01(\r\x12%\n\x07geo_ids\x18\x05 \x03(\x0b\x32\x14.Metrics.GeoIdsEntry\x12-\n\x0btotal_trips\x18\x06 \x03(\x0b\x32\x18.Metrics.TotalTripsEntry\x12\x33\n\x0etotal_distance\x18\x07 \x03(\x0b\x32\x1b.Metrics.TotalDistanceEntry\x12\x33\n\x0etotal_duration\x18\x08 \x03(\x0b\x32\x1b.Metrics.TotalDurationEntry\x12/\n\x0ctrip_volumes\x18\t \x03(\x0b\x32\x19.Metrics.TripVolumesEntry\x12&\n\x07pickups\x18\n \x03(\x0b\x32\x15.Metrics.PickupsEntry\x12(\n\x08\x64ropoffs\x18\x0b \x03(\x0b\x32\x16.Metrics.DropoffsEntry\x12\x30\n\x0c\x61vailability\x18\x0c \x03(\x0b\x32\x1a.Metrics.AvailabilityEntry\x12)\n\ton_street\x18\r \x03(\x0b\x32\x16.Metrics.OnStreetEntry\x12\"\n\x05\x66lows\x18\x0e \x03(\x0b\x32\x13.Metrics.FlowsEntry\x12\x15\n\rprivacy_level\x18\x0f \x01(\r\x12\x1e\n\x16trip_volume_suppressed\x18\x10 \x01(\r\x12\x18\n\x10\x66lows_suppressed\x18\x11 \x01(\r\x12\x32\n\x13packed_trip_volumes\x18\x12 \x01(\x0b\x32\x15.Metrics.PackedCounts\x12-\n\x0epacked_pickups\x18\x13 \x01(\x0b\x32\x15.Metrics.PackedCounts\x12.\n\x0fpacked_dropoffs\x18\x14 \x01(\x0b\x32\x15.Metrics.PackedCounts\x12\x32\n\x13packed_availability\x18\x15 \x01(\x0b\x32\x15.Metrics.PackedCounts\x12/\n\x10packed_on_street\x18\x16 \x01(\x0b\x32\x15.Metrics.PackedCounts\x12*\n\x0cpacked_flows\x18\x17 \x01(\x0b\x32\x14.Metrics.PackedFlows\x12&\n\nzone_table\x18\x18 \x01(\x0b\x32\x12.Metrics.ZoneTable\x1a-\n\x0bGeoIdsEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\x1a\x31\n\x0fTotalTripsEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\r\n\x05value\x18\x02 \x01(\r:\x02\x38\x01\x1a\x34\n\x12TotalDistanceEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\r\n\x05value\x18\x02 \x01(\x02:\x02\x38\x01\x1a\x34\n\x12TotalDurationEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\r\n\x05value\x18\x02 \x01(\x02:\x02\x38\x01\x1a\x43\n\x10TripVolumesEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\x1e\n\x05value\x18\x02 \x01(\x0b\x32\x0f.Metrics.IntMap:\x02\x38\x01\x1a?\n\x0cPickupsEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\x1e\n\x05value\x18\x02 \x01(\x0b\x32\x0f.Metrics.IntMap:\x02\x38\x01\x1a@\n\rDropoffsEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\x1e\n\x05value\x18\x02 \x01(\x0b\x32\x0f.Metrics.IntMap:\x02\x38\x01\x1a\x44\n\x11\x41vailabilityEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\x1e\n\x05value\x18\x02 \x01(\x0b\x32\x0f.Metrics.IntMap:\x02\x38\x01\x1a@\n\rOnStreetEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\x1e\n\x05value\x18\x02 \x01(\x0b\x32\x0f.Metrics.IntMap:\x02\x38\x01\x1a?\n\nFlowsEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12 \n\x05value\x18\x02 \x01(\x0b\x32\x11.Metrics.Int2DMap:\x02\x38\x01\x1a@\n\x0cPackedCounts\x12\x0f\n\x07periods\x18\x01 \x03(\r\x12\x0f\n\x07geo_ids\x18\x02 \x03(\r\x12\x0e\n\x06\x63ounts\x18\x03 \x03(\r\x1aQ\n\x0bPackedFlows\x12\x0f\n\x07periods\x18\x01 \x03(\r\x12\x0f\n\x07pickups\x18\x02 \x03(\r\x12\x10\n\x08\x64ropoffs\x18\x03 \x03(\r\x12\x0e\n\x06\x63ounts\x18\x04 \x03(\r\x1a\x43\n\tZoneTable\x12\x0f\n\x07geo_ids\x18\x01 \x03(\r\x12\x11\n\tlatitudes\x18\x02 \x03(\x01\x12\x12\n\nlongitudes\x18\x03 \x03(\x01\x1as\n\x08Int2DMap\x12)\n\x04\x64\x61ta\x18\x01 \x03(\x0b\x32\x1b.Metrics.Int2DMap.DataEntry\x1a<\n\tDataEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\x1e\n\x05value\x18\x02 \x01(\x0b\x32\x0f.Metrics.IntMap:\x02\x38\x01\x1a^\n\x06IntMap\x12\'\n\x04\x64\x61ta\x18\x01 \x03(\x0b\x32\x19.Metrics.IntMap.DataEntry\x1a+\n\tDataEntry\x12\x0b\n\x03key\x18\x01 \x01(\r\x12\r\n\x05value\x18\x02 \x01(\r:\x02\x38\x01\x62\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'amms_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _METRICS_GEOIDSENTRY._options = None
+  _METRICS_GEOIDSENTRY._serialized_options = b'8\001'
+  _METRICS_TOTALTRIPSENTRY._options = None
+  _METRICS_TOTALTRIPSENTRY._serialized_options = b'8\001'
+  _METRICS_TOTALDISTANCEENTRY._options = None
+  _METRICS_TOTALDISTANCEENTRY._serialized_options = b'8\001'
+  _METRICS_TOTALDURATIONENTRY._options = None
+  _METRICS_TOTALDURATIONENTRY._serialized_options = b'8\001'
+  _METRICS_TRIPVOLUMESENTRY._options = None
+  _METRICS_TRIPVOLUMESENTRY._serialized_options = b'8\001'
+  _METRICS_PICKUPSENTRY._options = None
+  _METRICS_PICKUPSENTRY._serialized_options = b'8\001'
+  _METRICS_DROPOFFSENTRY._options = None
+  _METRICS_DROPOFFSENTRY._serialized_options = b'8\001'
+  _METRICS_AVAILABILITYENTRY._options = None
+  _METRICS_AVAILABILITYENTRY._serialized_options = b'8\001'
+  _METRICS_ONSTREETENTRY._options = None
+  _METRICS_ONSTREETENTRY._serialized_options = b'8\001'
+  _METRICS_FLOWSENTRY._options = None
+  _METRICS_FLOWSENTRY._serialized_options = b'8\001'
+  _METRICS_INT2DMAP_DATAENTRY._options = None
+  _METRICS_INT2DMAP_DATAENTRY._serialized_options = b'8\001'
+  _METRICS_INTMAP_DATAENTRY._options = None
+  _METRICS_INTMAP_DATAENTRY._serialized_options = b'8\001'
+  _METRICS._serialized_start=15
+  _METRICS._serialized_end=2011
+  _METRICS_GEOIDSENTRY._serialized_start=975
+  _METRICS_GEOIDSENTRY._serialized_end=1020
+  _METRICS_TOTALTRIPSENTRY._serialized_start=1022
+  _METRICS_TOTALTRIPSENTRY._serialized_end=1071
+  _METRICS_TOTALDISTANCEENTRY._serialized_start=1073
+  _METRICS_TOTALDISTANCEENTRY._serialized_end=1125
+  _METRICS_TOTALDURATIONENTRY._serialized_start=1127
+  _METRICS_TOTALDURATIONENTRY._serialized_end=1179
+  _METRICS_TRIPVOLUMESENTRY._serialized_start=1181
+  _METRICS_TRIPVOLUMESENTRY._serialized_end=1248
+  _METRICS_PICKUPSENTRY._serialized_start=1250
+  _METRICS_PICKUPSENTRY._serialized_end=1313
+  _METRICS_DROPOFFSENTRY._serialized_start=1315
+  _METRICS_DROPOFFSENTRY._serialized_end=1379
+  _METRICS_AVAILABILITYENTRY._serialized_start=1381
+  _METRICS_AVAILABILITYENTRY._serialized_end=1449
+  _METRICS_ONSTREETENTRY._serialized_start=1451
+  _METRICS_ONSTREETENTRY._serialized_end=1515
+  _METRICS_FLOWSENTRY._serialized_start=1517
+  _METRICS_FLOWSENTRY._serialized_end=1580
+  _METRICS_PACKEDCOUNTS._serialized_start=1582
+  _METRICS_PACKEDCOUNTS._serialized_end=1646
+  _METRICS_PACKEDFLOWS._serialized_start=1648
+  _METRICS_PACKEDFLOWS._serialized_end=1729
+  _METRICS_ZONETABLE._serialized_start=1731
+  _METRICS_ZONETABLE._serialized_end=1798
+  _METRICS_INT2DMAP._serialized_start=1800
+  _METRICS_INT2DMAP._serialized_end=1915
+  _METRICS_INT2DMAP_DATAENTRY._serialized_start=1855
+  _METRICS_INT2DMAP_DATAENTRY._serialized_end=1915
+  _METRICS_INTMAP._serialized_start=1917
+  _METRICS_INTMAP._serialized_end=2011
+  _METRICS_INTMAP_DATAENTRY._serialized_start=1968
+  _METRICS_INTMAP_DATAENTRY._serialized_end=2011
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,296 @@
+from pb.amms_pb2 import Metrics
+import argparse
+import google.protobuf.json_format as json_format
+import json
+import logging
+import mmap
+import os
+import packed
+import sys
+
+# Reads parts of a Metrics PBF file without parsing all of it. The top level
+# of the file is scanned once for the byte range of every field, and of every
+# map entry by its key, and the ranges are saved in a sidecar index next to
+# the file. Queries then parse only the ranges of the requested fields and
+# periods, since concatenated protobuf fields parse as one message.
+
+# Map fields keyed by period
+PERIOD_FIELDS = ('total_trips', 'total_distance', 'total_duration', 'trip_volumes',
+    'pickups', 'dropoffs', 'availability', 'on_street', 'flows')
+# Period fields which map periods to counts by zone
+ZONE_FIELDS = ('trip_volumes', 'pickups', 'dropoffs', 'availability', 'on_street')
+INDEX_VERSION = 1
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+FIELD_NAMES = dict([(field.number, field.name) for field in Metrics.DESCRIPTOR.fields])
+MAP_FIELDS = set(PERIOD_FIELDS + ('geo_ids',))
+PACKED_FIELDS = dict([(field_name, packed_name)
+    for field_name, packed_name in packed.PACKED_COUNTS + [('flows', 'packed_flows')]])
+
+def indexFilename(pbf_filename):
+    return pbf_filename + ".index.json"
+
+def readVarint(buffer, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+def skipField(buffer, position, wire_type):
+    if wire_type == WIRE_VARINT:
+        return readVarint(buffer, position)[1]
+    if wire_type == WIRE_FIXED64:
+        return position + 8
+    if wire_type == WIRE_LENGTH_DELIMITED:
+        (length, position) = readVarint(buffer, position)
+        return position + length
+    if wire_type == WIRE_FIXED32:
+        return position + 4
+    raise ValueError("Unsupported wire type {}".format(wire_type))
+
+def mapEntryKey(buffer, start, end):
+    # The uint32 key of a serialized map entry, which is 0 if it was omitted
+    position = start
+    while position < end:
+        (tag, position) = readVarint(buffer, position)
+        if tag >> 3 == 1 and tag & 7 == WIRE_VARINT:
+            return readVarint(buffer, position)[0]
+        position = skipField(buffer, position, tag & 7)
+    return 0
+
+def scanFields(buffer):
+    # Returns {field_name: ranges} for the top level fields of a serialized
+    # Metrics message, where ranges is {key: [[start, end], ...]} for map
+    # fields and [[start, end], ...] for other fields. Ranges include the tag.
+    fields = {}
+    position = 0
+    size = len(buffer)
+    while position < size:
+        start = position
+        (tag, position) = readVarint(buffer, position)
+        (number, wire_type) = (tag >> 3, tag & 7)
+        if wire_type == WIRE_LENGTH_DELIMITED:
+            (length, position) = readVarint(buffer, position)
+            (value_start, position) = (position, position + length)
+        else:
+            position = skipField(buffer, position, wire_type)
+        name = FIELD_NAMES.get(number)
+        if name is None:
+            continue
+        if name in MAP_FIELDS:
+            key = str(mapEntryKey(buffer, value_start, position))
+            fields.setdefault(name, {}).setdefault(key, []).append([start, position])
+        else:
+            fields.setdefault(name, []).append([start, position])
+    return fields
+
+def buildIndex(pbf_filename):
+    stat = os.stat(pbf_filename)
+    fields = {}
+    if stat.st_size:
+        with open(pbf_filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                fields = scanFields(buffer)
+    return {
+        'version': INDEX_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'fields': fields,
+    }
+
+def isCurrent(index, pbf_filename):
+    stat = os.stat(pbf_filename)
+    return (index.get('version'), index.get('size'), index.get('mtime_ns')) == (
+        INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+
+def loadIndex(pbf_filename):
+    # Loads the sidecar index of a PBF file, rebuilding and saving it if it is
+    # missing or older than the file
+    index_filename = indexFilename(pbf_filename)
+    if os.path.exists(index_filename):
+        with open(index_filename) as f:
+            index = json.load(f)
+        if isCurrent(index, pbf_filename):
+            return index
+    logging.debug("Indexing {}".format(pbf_filename))
+    index = buildIndex(pbf_filename)
+    try:
+        with open(index_filename, 'w') as f:
+            json.dump(index, f)
+    except OSError as e:
+        logging.debug("Could not save index {}: {}".format(index_filename, e))
+    return index
+
+class MetricsReader:
+    # Answers queries on one PBF file from its index and a memory map of it
+    def __init__(self, pbf_filename):
+        self.filename = pbf_filename
+        self.index = loadIndex(pbf_filename)
+        self.file = open(pbf_filename, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if self.index['size'] else b''
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, ranges):
+        return b''.join([self.buffer[start:end] for start, end in ranges])
+
+    def mapRanges(self, field_name, keys=None):
+        entries = self.index['fields'].get(field_name, {})
+        if keys is None:
+            return [r for ranges in entries.values() for r in ranges]
+        return [r for key in keys for r in entries.get(str(key), [])]
+
+    def geoIds(self, keys=None):
+        metrics = Metrics()
+        metrics.ParseFromString(self.read(self.mapRanges('geo_ids', keys)))
+        return metrics.geo_ids
+
+    def zoneIds(self, zones):
+        # Converts zone names or geo_ids to a set of geo_ids
+        zone_ids = set([zone for zone in zones if isinstance(zone, int)])
+        names = set([zone for zone in zones if not isinstance(zone, int)])
+        if names:
+            zone_ids.update([geo_id for geo_id, name in self.geoIds().items() if name in names])
+        return zone_ids
+
+    def query(self, fields=None, periods=None, zones=None):
+        # Returns a Metrics message with only the given period fields, periods
+        # and zones, along with the time range, period, cycle length and
+        # privacy fields. Flows are kept if either their pickup or dropoff is
+        # in zones. Packed fields are read whole and then filtered. geo_ids has
+        # every zone only if neither periods nor zones are given.
+        fields = list(fields) if fields is not None else list(PERIOD_FIELDS)
+        for field_name in fields:
+            if field_name not in PERIOD_FIELDS:
+                raise ValueError("Cannot query field {}".format(field_name))
+        period_keys = sorted(set(periods)) if periods is not None else None
+        ranges = []
+        for field_name, field_ranges in self.index['fields'].items():
+            if field_name not in MAP_FIELDS and field_name not in PACKED_FIELDS.values():
+                ranges.extend(field_ranges)
+        for field_name in fields:
+            ranges.extend(self.mapRanges(field_name, period_keys))
+            packed_name = PACKED_FIELDS.get(field_name)
+            if packed_name:
+                ranges.extend(self.index['fields'].get(packed_name, []))
+        metrics = Metrics()
+        metrics.ParseFromString(self.read(sorted(ranges)))
+        if packed.isPacked(metrics):
+            packed.unpackMetrics(metrics)
+            if period_keys is not None:
+                filterPeriods(metrics, fields, set(period_keys))
+        zone_ids = self.zoneIds(zones) if zones is not None else None
+        if zone_ids is not None:
+            filterZones(metrics, fields, zone_ids)
+        # Only the names of zones in the result are read for partial queries
+        partial = periods is not None or zones is not None
+        metrics.geo_ids.update(self.geoIds(
+            sorted(referencedZones(metrics, fields)) if partial else None))
+        return metrics
+
+def filterPeriods(metrics, fields, periods):
+    for field_name in fields:
+        field = getattr(metrics, field_name)
+        for period in [period for period in field if period not in periods]:
+            del field[period]
+
+def filterZones(metrics, fields, zone_ids):
+    for field_name in fields:
+        if field_name in ZONE_FIELDS:
+            for counts in getattr(metrics, field_name).values():
+                for geo_id in [geo_id for geo_id in counts.data if geo_id not in zone_ids]:
+                    del counts.data[geo_id]
+        elif field_name == 'flows':
+            for pickups in metrics.flows.values():
+                for pickup, dropoffs in list(pickups.data.items()):
+                    if pickup in zone_ids:
+                        continue
+                    for dropoff in [dropoff for dropoff in dropoffs.data if dropoff not in zone_ids]:
+                        del dropoffs.data[dropoff]
+                    if not dropoffs.data:
+                        del pickups.data[pickup]
+
+def referencedZones(metrics, fields):
+    zone_ids = set()
+    for field_name in fields:
+        if field_name in ZONE_FIELDS:
+            for counts in getattr(metrics, field_name).values():
+                zone_ids.update(counts.data)
+        elif field_name == 'flows':
+            for pickups in metrics.flows.values():
+                for pickup, dropoffs in pickups.data.items():
+                    zone_ids.add(pickup)
+                    zone_ids.update(dropoffs.data)
+    return zone_ids
+
+def query(metrics_path, fields=None, periods=None, zones=None):
+    # Reads the given fields, periods and zones of a PBF file. zones may be
+    # geo_ids or zone names.
+    with MetricsReader(metrics_path) as reader:
+        return reader.query(fields, periods, zones)
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        description='Read some periods, zones or fields of a PBF file as JSON')
+    parser.add_argument(
+        'input_filename',
+        help='Input PBF filename')
+    parser.add_argument(
+        '-f', '--fields',
+        nargs='+',
+        choices=PERIOD_FIELDS,
+        help='Fields to read. All by default.')
+    parser.add_argument(
+        '-per', '--periods',
+        nargs='+',
+        type=int,
+        help='Periods to read. All by default.')
+    parser.add_argument(
+        '-z', '--zones',
+        nargs='+',
+        help='Names of zones to read. All by default.')
+    parser.add_argument(
+        '-g', '--geo_ids',
+        nargs='+',
+        type=int,
+        help='geo_ids of zones to read, along with any --zones. All by default.')
+    parser.add_argument(
+        '--output_filename',
+        help='Output JSON filename. If not provided, output will be printed.')
+    return parser
+
+def main(argv=None):
+    args = getParser().parse_args(argv)
+    # Names and geo_ids are kept apart, as polygon zones may be named by numbers
+    zones = None
+    if args.zones is not None or args.geo_ids is not None:
+        zones = (args.zones or []) + (args.geo_ids or [])
+    metrics = query(args.input_filename, args.fields, args.periods, zones)
+    output = json_format.MessageToJson(metrics)
+    if args.output_filename:
+        with open(args.output_filename, 'w') as jsonfile:
+            jsonfile.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    sys.exit(main())
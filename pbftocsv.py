@@ -1,53 +1,102 @@
-from pb.amms_pb2 import Metrics
 from datetime import datetime as dt
 import argparse
+import lazy
 import logging
+import packed
 import sys
+import zones
+
+np = lazy.lazyImport('numpy')
+pd = lazy.lazyImport('pandas')
 
 # This will output CSV files suitable for using on kepler.gl
 
 log = logging.getLogger()
 
+# Rows are formatted and written this many at a time
+CHUNK_ROWS = 100000
+VOLUME_HEADER = "id, pickup_lat, pickup_long, value, start_time\n"
+FLOW_HEADER = "id, pickup_lat, pickup_long, dropoff_lat, dropoff_long, value, start_time\n"
+
+def mapUnique(function, values):
+    # Applies function once to each distinct value of an array and returns an
+    # array of the results for every value
+    (unique, inverse) = np.unique(values, return_inverse=True)
+    results = np.empty(len(unique), dtype=object)
+    results[:] = [function(value) for value in unique.tolist()]
+    return results[inverse]
+
+def periodStartTime(metrics, period):
+    # Periods of an absolute series, with a cycle length of 0, count from the
+    # epoch rather than from the start time
+    if not metrics.cycle_length:
+        return dt.fromtimestamp(metrics.period_seconds * period)
+    return dt.fromtimestamp(metrics.start_time + (metrics.period_seconds * period))
+
+def writeRows(openedfile, row_format, columns):
+    for start in range(0, len(columns[0]), CHUNK_ROWS):
+        chunk = [column[start:start + CHUNK_ROWS].tolist() for column in columns]
+        openedfile.write("".join([row_format.format(*row) for row in zip(*chunk)]))
+
 def outputVolumes(metrics, openedfile):
-    openedfile.write("id, pickup_lat, pickup_long, value, start_time\n")
-    for period in metrics.trip_volumes:
-        start_time = metrics.start_time + (metrics.period_seconds * period)
-        geo_ids = metrics.trip_volumes[period].data
-        for geo_id in geo_ids:
-            geo = metrics.geo_ids[geo_id]
-            long, lat = map(float, geo.split(':'))
-            val = geo_ids[geo_id]
-            openedfile.write("{},{},{},{},{}\n".format(
-                geo_id,
-                lat,
-                long,
-                val,
-                dt.fromtimestamp(start_time)))
+    openedfile.write(VOLUME_HEADER)
+    (periods, geo_ids, counts) = packed.countArrays(metrics, 'trip_volumes')
+    # Each zone is formatted once, as is each period's start time
+    centers = zones.zoneCenters(metrics)
+    formatted = mapUnique(lambda geo_id: "{},{}".format(*centers[geo_id]), geo_ids)
+    start_times = mapUnique(lambda period: str(periodStartTime(metrics, period)), periods)
+    writeRows(openedfile, "{},{},{},{}\n", [geo_ids, formatted, counts, start_times])
 
 def outputFlows(metrics, openedfile):
-    openedfile.write("id, pickup_lat, pickup_long, dropoff_lat, dropoff_long, value, start_time\n")
-    for period in metrics.flows:
-        start_time = metrics.start_time + (metrics.period_seconds * period)
-        pickups = metrics.flows[period].data
-        for pickup in pickups:
-            pickup_geo = metrics.geo_ids[pickup]
-            pickup_long, pickup_lat = map(float, pickup_geo.split(':'))
-            dropoffs = pickups[pickup].data
-            for dropoff in dropoffs:
-                dropoff_geo = metrics.geo_ids[dropoff]
-                dropoff_long, dropoff_lat = map(float, dropoff_geo.split(':'))
-                val = dropoffs[dropoff]
-                openedfile.write("{}->{},{},{},{},{},{},{}\n".format(
-                    pickup,
-                    dropoff,
-                    pickup_lat,
-                    pickup_long,
-                    dropoff_lat,
-                    dropoff_long,
-                    val,
-                    dt.fromtimestamp(start_time)))
-
-def main():
+    openedfile.write(FLOW_HEADER)
+    (periods, pickups, dropoffs, counts) = packed.flowArrays(metrics)
+    centers = zones.zoneCenters(metrics)
+    formatZone = lambda geo_id: "{},{}".format(*centers[geo_id])
+    start_times = mapUnique(lambda period: str(periodStartTime(metrics, period)), periods)
+    writeRows(openedfile, "{}->{},{},{},{},{}\n", [pickups, dropoffs,
+        mapUnique(formatZone, pickups), mapUnique(formatZone, dropoffs), counts, start_times])
+
+def coordinateColumns(centers, geo_ids):
+    coordinates = mapUnique(lambda geo_id: centers[geo_id], geo_ids)
+    return ([coordinate[0] for coordinate in coordinates],
+        [coordinate[1] for coordinate in coordinates])
+
+def volumeFrame(metrics):
+    # The volume CSV columns with numeric coordinates and start times
+    (periods, geo_ids, counts) = packed.countArrays(metrics, 'trip_volumes')
+    (lats, longs) = coordinateColumns(zones.zoneCenters(metrics), geo_ids)
+    return pd.DataFrame({
+        'id': geo_ids,
+        'pickup_lat': np.array(lats, dtype=float),
+        'pickup_long': np.array(longs, dtype=float),
+        'value': counts,
+        'start_time': pd.to_datetime(mapUnique(
+            lambda period: periodStartTime(metrics, period), periods)),
+    })
+
+def flowFrame(metrics):
+    (periods, pickups, dropoffs, counts) = packed.flowArrays(metrics)
+    centers = zones.zoneCenters(metrics)
+    (pickup_lats, pickup_longs) = coordinateColumns(centers, pickups)
+    (dropoff_lats, dropoff_longs) = coordinateColumns(centers, dropoffs)
+    return pd.DataFrame({
+        'id': pd.Series(pickups).astype(str) + "->" + pd.Series(dropoffs).astype(str),
+        'pickup_lat': np.array(pickup_lats, dtype=float),
+        'pickup_long': np.array(pickup_longs, dtype=float),
+        'dropoff_lat': np.array(dropoff_lats, dtype=float),
+        'dropoff_long': np.array(dropoff_longs, dtype=float),
+        'value': counts,
+        'start_time': pd.to_datetime(mapUnique(
+            lambda period: periodStartTime(metrics, period), periods)),
+    })
+
+def outputParquet(frame, filename):
+    try:
+        frame.to_parquet(filename, index=False)
+    except ImportError:
+        raise ImportError("Writing {} requires the pyarrow or fastparquet package".format(filename))
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description='Convert PBF file into a CSV file')
     parser.add_argument(
@@ -72,22 +121,39 @@ def main():
         default=True,
         help='Output a volume CSV file'
     )
-    args = parser.parse_args()
-    metrics = Metrics()
-    with open(args.input, 'rb') as pbfile:
-        metrics.ParseFromString(pbfile.read())
+    parser.add_argument(
+        '-pq',
+        '--parquet',
+        action='store_true',
+        default=False,
+        help='Output Parquet files [output]-{flow,volume}.parquet instead of '
+             'CSV. Requires pyarrow or fastparquet.'
+    )
+    args = parser.parse_args(argv)
+    # Counts are only read as arrays, so packed counts are not unpacked
+    metrics = packed.readMetrics(args.input)
 
     if args.volume:
-        outfilename = "{}-volume.csv".format(args.output)
-        log.info("Outputting {}".format(outfilename))
-        with open(outfilename, 'w') as volumecsv:
-            outputVolumes(metrics, volumecsv)
+        if args.parquet:
+            outfilename = "{}-volume.parquet".format(args.output)
+            log.info("Outputting {}".format(outfilename))
+            outputParquet(volumeFrame(metrics), outfilename)
+        else:
+            outfilename = "{}-volume.csv".format(args.output)
+            log.info("Outputting {}".format(outfilename))
+            with open(outfilename, 'w') as volumecsv:
+                outputVolumes(metrics, volumecsv)
 
     if args.flow:
-        outfilename = "{}-flow.csv".format(args.output)
-        log.info("Outputting {}".format(outfilename))
-        with open(outfilename, 'w') as flowcsv:
-            outputFlows(metrics, flowcsv)
+        if args.parquet:
+            outfilename = "{}-flow.parquet".format(args.output)
+            log.info("Outputting {}".format(outfilename))
+            outputParquet(flowFrame(metrics), outfilename)
+        else:
+            outfilename = "{}-flow.csv".format(args.output)
+            log.info("Outputting {}".format(outfilename))
+            with open(outfilename, 'w') as flowcsv:
+                outputFlows(metrics, flowcsv)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,11 +1,111 @@
-from pb.amms_pb2 import Metrics
+from google.protobuf.descriptor import FieldDescriptor
 import argparse
-import google.protobuf.json_format as json_format
+import contextlib
+import json
+import math
+import packed
+import pbfquery
+import struct
 import sys
 
+# Writes a Metrics PBF file as JSON in the format of json_format.MessageToJson,
+# with camelCase field names, or as NDJSON. The output is written field by
+# field, and entry by entry within map fields, such as each period of the
+# counts, so the whole document is never built in memory as a single string.
+
+INT64_TYPES = (FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64)
+FLOAT_TYPES = (FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE)
+
+def isMap(field):
+    return (field.type == FieldDescriptor.TYPE_MESSAGE and
+        field.message_type.GetOptions().map_entry)
+
+def shortestFloat(value):
+    # The shortest decimal that rounds to the same 32-bit float, as used by
+    # json_format for float fields
+    precision = 6
+    rounded = float('{0:.{1}g}'.format(value, precision))
+    while struct.unpack('f', struct.pack('f', rounded))[0] != value:
+        precision += 1
+        rounded = float('{0:.{1}g}'.format(value, precision))
+    return rounded
+
+def scalarJSON(field, value):
+    # Converts a field value following the proto3 JSON mapping
+    if field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        return messageJSON(value)
+    if field.cpp_type in INT64_TYPES:
+        return str(value)
+    if field.cpp_type in FLOAT_TYPES:
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        if math.isnan(value):
+            return 'NaN'
+        if field.cpp_type == FieldDescriptor.CPPTYPE_FLOAT:
+            return shortestFloat(value)
+    return value
+
+def fieldJSON(field, value):
+    if isMap(field):
+        value_field = field.message_type.fields_by_name['value']
+        return dict([(str(key), scalarJSON(value_field, value[key])) for key in value])
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        return [scalarJSON(field, each) for each in value]
+    return scalarJSON(field, value)
+
+def messageJSON(message):
+    return dict([(field.json_name, fieldJSON(field, value))
+        for field, value in message.ListFields()])
+
+def writeJSON(metrics, output, indent=2):
+    # Writes metrics as json.dumps(MessageToDict(metrics), indent=indent)
+    # would, or compactly if indent is None
+    key_separator = ': ' if indent is not None else ':'
+    def newline(level):
+        return '\n' + ' ' * (indent * level) if indent is not None else ''
+    def dumps(value, level):
+        text = json.dumps(value, indent=indent, separators=(',', key_separator))
+        return text.replace('\n', newline(level)) if indent is not None else text
+    fields = metrics.ListFields()
+    if not fields:
+        output.write('{}')
+        return
+    output.write('{')
+    for i, (field, value) in enumerate(fields):
+        output.write((',' if i else '') + newline(1) + json.dumps(field.json_name) + key_separator)
+        if not isMap(field):
+            output.write(dumps(fieldJSON(field, value), 1))
+            continue
+        value_field = field.message_type.fields_by_name['value']
+        output.write('{')
+        for j, key in enumerate(value):
+            output.write((',' if j else '') + newline(2) + json.dumps(str(key)) + key_separator +
+                dumps(scalarJSON(value_field, value[key]), 2))
+        output.write(newline(1) + '}')
+    output.write(newline(0) + '}')
+
+def writeNDJSON(metrics, output):
+    # Writes one compact JSON object per line: the first holds the fields
+    # that are not maps, and each of the others a single entry of a map
+    # field, e.g. one period of trip volumes or one zone of geo_ids. Every
+    # line is itself a Metrics message in JSON, so parsing and merging the
+    # lines gives back metrics.
+    dumps = lambda value: json.dumps(value, separators=(',', ':'))
+    header = {}
+    for field, value in metrics.ListFields():
+        if not isMap(field):
+            header[field.json_name] = fieldJSON(field, value)
+    output.write(dumps(header) + '\n')
+    for field, value in metrics.ListFields():
+        if not isMap(field):
+            continue
+        value_field = field.message_type.fields_by_name['value']
+        for key in value:
+            output.write(dumps({field.json_name: {str(key): scalarJSON(value_field, value[key])}}) + '\n')
+
 def getParser():
     parser = argparse.ArgumentParser(
-        description='Aggregate MDS trip data into a TripMetrics protocol buffer')
+        description='Convert a Metrics protocol buffer into JSON')
     parser.add_argument(
         'input_filename',
         help='Input PBF filname'
@@ -13,20 +113,50 @@ def getParser():
     parser.add_argument(
         '--output_filename',
         help='Output JSON filename. If not provided, output will be printed.')
+    parser.add_argument(
+        '-f', '--fields',
+        nargs='+',
+        choices=pbfquery.PERIOD_FIELDS,
+        metavar='FIELD',
+        help='Period fields to write, e.g. trip_volumes or flows, along with '
+             'geo_ids and the fields that are not maps. All by default.')
+    parser.add_argument(
+        '-per', '--periods',
+        nargs='+',
+        type=int,
+        help='Periods to write. All by default.')
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        default=False,
+        help='Write JSON without indentation or spaces')
+    parser.add_argument(
+        '--ndjson',
+        action='store_true',
+        default=False,
+        help='Write newline-delimited JSON, with the fields that are not maps '
+             'on the first line and then one map entry, e.g. a period of a '
+             'count field, per line')
     return parser
 
-def main():
+def main(argv=None):
     parser = getParser()
-    args = parser.parse_args()
-    metrics = Metrics()
-    with open(args.input_filename, 'rb') as pbfile:
-        metrics.ParseFromString(pbfile.read())
-    json = json_format.MessageToJson(metrics)
-    if args.output_filename:
-        with open(args.output_filename, 'w') as jsonfile:
-            jsonfile.write(json)
+    args = parser.parse_args(argv)
+    if args.fields is not None or args.periods is not None:
+        metrics = pbfquery.query(args.input_filename, args.fields, args.periods)
     else:
-        print(json)
+        metrics = packed.loadMetrics(args.input_filename)
+    with contextlib.ExitStack() as stack:
+        if args.output_filename:
+            output = stack.enter_context(open(args.output_filename, 'w'))
+        else:
+            output = sys.stdout
+        if args.ndjson:
+            writeNDJSON(metrics, output)
+        else:
+            writeJSON(metrics, output, None if args.compact else 2)
+            if not args.output_filename:
+                output.write('\n')
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,259 +1,1338 @@
+from google.protobuf.message import DecodeError
 from pb.amms_pb2 import Metrics
 
 import argparse
+import contextlib
 import datetime as dt
+import decoders
+import functools
+import gzip
+import heapq
+import instrument
 import json
-import jsonschema
 import logging
-import pandas as pd
+import multiprocessing
+import os
+import packed
+import partials
+import pbfquery
+import resource
+import struct
 import sys
+import time
+import vehicles
+import zones
 
 log = logging.getLogger()
 
 def getPeriod(seconds, period, cycle_length):
     # This will bucket seconds into whatever time period is specified, e.g.
     # 3600 seconds will be hourly. It will then aggregate based on a cycle
-    # length, e.g. hours of the week.
+    # length, e.g. hours of the week. A cycle length of 0 does not fold
+    # periods, which are then counted from the epoch, e.g. hours since 1970.
+    if not cycle_length:
+        return int(seconds/period)
     return int(seconds/period) % cycle_length
 
 def latLongToZone(geo_ids, lat, long, gpsaccuracy, inverse_geo_ids):
-    coordformat = "{lat:03.{gpsaccuracy}f}:{long:03.{gpsaccuracy}f}".format(
-        lat=lat, long=long, gpsaccuracy=gpsaccuracy)
-    coordinates = coordformat.format(lat, long)
-    if coordinates not in inverse_geo_ids:
-        geo_id_count = len(geo_ids)
-        inverse_geo_ids[coordinates] = geo_id_count
-        geo_ids[geo_id_count] = coordinates
-    return inverse_geo_ids[coordinates]
+    # Assigns a single point to a zone. GridZones gives identical results
+    # without formatting a string for every point.
+    coordinates = zones.zoneName(lat, long, gpsaccuracy)
+    return zones.addZone(geo_ids, inverse_geo_ids, coordinates)
 
-def metricsFromPBF(input_filename, period=None, cycle_length=None, gpsaccuracy=None):
-    with open(input_filename, 'rb') as pbfile:
+def toFloat32(value):
+    # Metrics stores distance and duration as 32-bit floats, which are rounded
+    # on every update of the protobuf map. Accumulators round the same way so
+    # that their totals are identical.
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+class MetricsAccumulator:
+    # Accumulates trips and vehicle changes in plain dictionaries keyed by
+    # (period, geo_id) and (period, pickup, dropoff) tuples and builds the
+    # Metrics protobuf in a single pass with toMetrics(). Dictionaries keep
+    # insertion order, so the output serializes exactly as if the counts had
+    # been written into the protobuf maps as they were read.
+    def __init__(self, period, cycle_length, gpsaccuracy, geo_ids=None, zoning=None,
+            vehicle_sets=None):
+        self.period_seconds = period
+        self.cycle_length = cycle_length
+        self.gpsaccuracy = gpsaccuracy
+        # We'll need to keep track of the earliest and latest times seen
+        self.earliest_time = sys.maxsize
+        self.latest_time = 0
+        self.trip_count = 0
+        self.change_count = 0
+        self.route_points = 0
+        # Records skipped because they could not be decoded or aggregated
+        self.bad_records = {'trips': 0, 'changes': 0}
+        self.geo_ids = dict(geo_ids) if geo_ids else {}
+        self.inverse_geo_ids = dict([(x[1], x[0]) for x in self.geo_ids.items()])
+        # zoning creates the zoning backend from the geo_ids maps. Zones are
+        # rounded-decimal grid cells by default.
+        if zoning is None:
+            zoning = functools.partial(zones.GridZones, gpsaccuracy)
+        self.zones = zoning(self.geo_ids, self.inverse_geo_ids)
+        self.zone_center = zones.backendCenter(self.zones)
+        if instrument.detailed():
+            self.zones = instrument.TimedZones(self.zones)
+        self.total_trips = {}
+        self.total_distance = {}
+        self.total_duration = {}
+        self.trip_volumes = {}
+        self.pickups = {}
+        self.dropoffs = {}
+        self.flows = {}
+        # Distinct vehicles by (period, geo_id). vehicle_sets creates them from
+        # a shared index of vehicle IDs and counts exactly by default.
+        if vehicle_sets is None:
+            vehicle_sets = vehicles.VehicleSets
+        vehicle_index = vehicles.VehicleIndex()
+        self.availability = vehicle_sets(vehicle_index)
+        self.on_street = vehicle_sets(vehicle_index)
+
+    def addTrip(self, trip):
+        self.addTripFields(*decoders.tripFields(trip))
+
+    def addTripFields(self, start_time, duration, distance, coordinates, timestamps):
+        # Zones and periods are found before any counts are updated, so a
+        # record that fails part way leaves the counts unchanged
+        period_seconds, cycle_length = self.period_seconds, self.cycle_length
+        start_period = getPeriod(start_time, period_seconds, cycle_length)
+        periods = [getPeriod(timestamp, period_seconds, cycle_length) for timestamp in timestamps]
+        earliest_time = min(timestamps + [start_time, self.earliest_time])
+        latest_time = max(timestamps + [start_time, self.latest_time])
+        geo_ids = self.zones.zones(coordinates)
+        self.trip_count += 1
+        self.route_points += len(timestamps)
+        self.earliest_time = earliest_time
+        self.latest_time = latest_time
+        self.total_trips[start_period] = self.total_trips.get(start_period, 0) + 1
+        self.total_duration[start_period] = toFloat32(
+            self.total_duration.get(start_period, 0.0) + duration)
+        self.total_distance[start_period] = toFloat32(
+            self.total_distance.get(start_period, 0.0) + distance)
+        trip_volumes = self.trip_volumes
+        for key in zip(periods, geo_ids):
+            trip_volumes[key] = trip_volumes.get(key, 0) + 1
+        if not geo_ids:
+            return
+        # The first entry in the geometry is assumed to be the pickup and the
+        # last entry the dropoff
+        pickup = geo_ids[0]
+        dropoff = geo_ids[-1]
+        key = (start_period, pickup)
+        self.pickups[key] = self.pickups.get(key, 0) + 1
+        key = (periods[-1], dropoff)
+        self.dropoffs[key] = self.dropoffs.get(key, 0) + 1
+        # Flows will be indexed by their start period
+        key = (start_period, pickup, dropoff)
+        self.flows[key] = self.flows.get(key, 0) + 1
+
+    def addChange(self, change):
+        self.addChangeFields(*decoders.changeFields(change))
+
+    def addChangeFields(self, timestamp, vehicle_id, event_type, coordinates):
+        event_period = getPeriod(timestamp, self.period_seconds, self.cycle_length)
+        earliest_time = min(timestamp, self.earliest_time)
+        latest_time = max(timestamp, self.latest_time)
+        geo_id = self.zones.zone(*coordinates)
+        self.change_count += 1
+        self.earliest_time = earliest_time
+        self.latest_time = latest_time
+        key = (event_period, geo_id)
+        self.on_street.add(key, vehicle_id)
+        if event_type == "available":
+            self.availability.add(key, vehicle_id)
+
+    def merge(self, other):
+        # Folds another partial aggregate into this one. Zones from other are
+        # remapped onto this aggregate's geo_ids, counts are summed and the
+        # distinct vehicle sets are unioned so on_street and availability
+        # remain counts of distinct vehicles. Merging partials in input order
+        # assigns the same geo_ids as reading the inputs sequentially.
+        if (self.period_seconds, self.cycle_length, self.gpsaccuracy) != (
+                other.period_seconds, other.cycle_length, other.gpsaccuracy):
+            raise ValueError("Cannot merge aggregates with different periods, cycle lengths or accuracy")
+        remap = {}
+        for geo_id, coordinates in other.geo_ids.items():
+            remap[geo_id] = zones.addZone(self.geo_ids, self.inverse_geo_ids, coordinates)
+        self.earliest_time = min(self.earliest_time, other.earliest_time)
+        self.latest_time = max(self.latest_time, other.latest_time)
+        self.trip_count += other.trip_count
+        self.change_count += other.change_count
+        self.route_points += other.route_points
+        for kind, count in other.bad_records.items():
+            self.bad_records[kind] = self.bad_records.get(kind, 0) + count
+        for period, count in other.total_trips.items():
+            self.total_trips[period] = self.total_trips.get(period, 0) + count
+        for totals, other_totals in (
+                (self.total_duration, other.total_duration),
+                (self.total_distance, other.total_distance)):
+            for period, total in other_totals.items():
+                totals[period] = toFloat32(totals.get(period, 0.0) + total)
+        for counts, other_counts in (
+                (self.trip_volumes, other.trip_volumes),
+                (self.pickups, other.pickups),
+                (self.dropoffs, other.dropoffs)):
+            for (period, geo_id), count in other_counts.items():
+                key = (period, remap[geo_id])
+                counts[key] = counts.get(key, 0) + count
+        for (period, pickup, dropoff), count in other.flows.items():
+            key = (period, remap[pickup], remap[dropoff])
+            self.flows[key] = self.flows.get(key, 0) + count
+        remap_key = lambda key: (key[0], remap[key[1]])
+        self.availability.merge(other.availability, remap_key)
+        self.on_street.merge(other.on_street, remap_key)
+        return self
+
+    @instrument.timer('to_metrics')
+    def toMetrics(self, metrics=None):
+        # Counts are added to those already in metrics, if it is given, while
+        # the distinct vehicle counts replace any existing ones.
+        add = metrics is not None
+        if metrics is None:
+            metrics = Metrics()
+            metrics.period_seconds = self.period_seconds
+            metrics.cycle_length = self.cycle_length
+        metrics.start_time = self.earliest_time
+        metrics.end_time = self.latest_time
+        for geo_id, coordinates in self.geo_ids.items():
+            metrics.geo_ids[geo_id] = coordinates
+        for field, totals in (
+                (metrics.total_trips, self.total_trips),
+                (metrics.total_duration, self.total_duration),
+                (metrics.total_distance, self.total_distance)):
+            for period, total in totals.items():
+                field[period] = field[period] + total if add else total
+        for field, counts in (
+                (metrics.trip_volumes, self.trip_volumes),
+                (metrics.pickups, self.pickups),
+                (metrics.dropoffs, self.dropoffs)):
+            periods = {}
+            for (period, geo_id), count in counts.items():
+                if period not in periods:
+                    periods[period] = field[period].data
+                data = periods[period]
+                data[geo_id] = data[geo_id] + count if add else count
+        pickups = {}
+        for (period, pickup, dropoff), count in self.flows.items():
+            if (period, pickup) not in pickups:
+                pickups[(period, pickup)] = metrics.flows[period].data[pickup].data
+            data = pickups[(period, pickup)]
+            data[dropoff] = data[dropoff] + count if add else count
+        for field, vehicle_sets in (
+                (metrics.availability, self.availability),
+                (metrics.on_street, self.on_street)):
+            periods = {}
+            for (period, geo_id), count in vehicle_sets.counts():
+                if period not in periods:
+                    periods[period] = field[period].data
+                periods[period][geo_id] = count
+        zones.fillZoneTable(metrics, self.zone_center)
+        return metrics
+
+class SharedZones:
+    # A zoning backend shared by accumulators that are fed the same records,
+    # which looks each route or location up only once for all of them. The
+    # last lookup is recognized by the identity of its arguments.
+    def __init__(self, backend):
+        self.backend = backend
+        self.coordinates = None
+        self.geo_ids = None
+        self.location = (None, None)
+        self.geo_id = None
+
+    def zones(self, coordinates):
+        if coordinates is not self.coordinates:
+            self.geo_ids = self.backend.zones(coordinates)
+            self.coordinates = coordinates
+        return self.geo_ids
+
+    def zone(self, lat, long):
+        if lat is not self.location[0] or long is not self.location[1]:
+            self.geo_id = self.backend.zone(lat, long)
+            self.location = (lat, long)
+        return self.geo_id
+
+class MultiAccumulator:
+    # Fans each trip and vehicle change out to a MetricsAccumulator per
+    # (period, cycle_length, gpsaccuracy) configuration, so that several
+    # aggregates are built from a single read of the input. Records are
+    # decoded and their route points extracted once. zonings maps each
+    # accuracy to its zoning, and accumulators with the same accuracy share
+    # their zones, so routes are looked up once per accuracy. A record that
+    # cannot be aggregated fails in the first accumulator, before any are
+    # updated, as the configurations only differ in how times and coordinates
+    # are rounded.
+    def __init__(self, configs, zonings, vehicle_sets=None):
+        self.accumulators = []
+        self.bad_records = {'trips': 0, 'changes': 0}
+        leaders = {}
+        for period, cycle_length, gpsaccuracy in configs:
+            accumulator = MetricsAccumulator(period, cycle_length, gpsaccuracy,
+                zoning=zonings[gpsaccuracy], vehicle_sets=vehicle_sets)
+            leader = leaders.setdefault(gpsaccuracy, accumulator)
+            if leader is accumulator:
+                accumulator.zones = SharedZones(accumulator.zones)
+            else:
+                accumulator.geo_ids = leader.geo_ids
+                accumulator.inverse_geo_ids = leader.inverse_geo_ids
+                accumulator.zones = leader.zones
+            self.accumulators.append(accumulator)
+
+    def addTrip(self, trip):
+        fields = decoders.tripFields(trip)
+        for accumulator in self.accumulators:
+            accumulator.addTripFields(*fields)
+
+    def addChange(self, change):
+        fields = decoders.changeFields(change)
+        for accumulator in self.accumulators:
+            accumulator.addChangeFields(*fields)
+
+class PeriodCounts:
+    # The counts of a single period of a WindowAccumulator, keyed by geo_id
+    # and by (pickup, dropoff) for flows
+    def __init__(self, period, vehicle_sets, vehicle_index):
+        self.period = period
+        self.total_trips = 0
+        self.total_distance = 0.0
+        self.total_duration = 0.0
+        self.trip_volumes = {}
+        self.pickups = {}
+        self.dropoffs = {}
+        self.flows = {}
+        self.availability = vehicle_sets(vehicle_index)
+        self.on_street = vehicle_sets(vehicle_index)
+
+class WindowAccumulator:
+    # Accumulates trips and vehicle changes into periods counted from the
+    # epoch, keeping only the latest window_length periods. Periods are kept
+    # in a ring buffer of PeriodCounts indexed by period modulo window_length,
+    # so a new period replaces the one window_length periods before it in
+    # constant time. The window ends at the latest trip start or change
+    # period seen. Records in periods that have left the window are counted
+    # in late_records and skipped, so inputs should be in time order. Route
+    # points after the end of the window, of trips still in progress, are
+    # held in pending until the window reaches their periods.
+    #
+    # Whenever the window moves past a period that is one before a multiple of
+    # window_step, emit is called with the Metrics of the window ending at
+    # that period, which toMetrics builds from the ring without reading any
+    # input again. Records arrive in time order and trips only count points
+    # from their start onwards, so no record still to come can change a
+    # window that has been passed. The Metrics have a cycle length of 0, and
+    # start_time and end_time are the bounds of the window.
+    def __init__(self, period, window_length, gpsaccuracy, zoning=None, vehicle_sets=None,
+            window_step=1, emit=None):
+        if window_length < 1 or window_step < 1:
+            raise ValueError("Window length and step must be at least one period")
+        self.period_seconds = period
+        self.window_length = window_length
+        self.window_step = window_step
+        self.gpsaccuracy = gpsaccuracy
+        self.emit = emit
+        self.trip_count = 0
+        self.change_count = 0
+        self.route_points = 0
+        self.bad_records = {'trips': 0, 'changes': 0}
+        self.late_records = {'trips': 0, 'changes': 0}
+        self.windows = 0
+        self.geo_ids = {}
+        self.inverse_geo_ids = {}
+        if zoning is None:
+            zoning = functools.partial(zones.GridZones, gpsaccuracy)
+        self.zones = zoning(self.geo_ids, self.inverse_geo_ids)
+        self.zone_center = zones.backendCenter(self.zones)
+        if instrument.detailed():
+            self.zones = instrument.TimedZones(self.zones)
+        self.vehicle_sets = vehicle_sets or vehicles.VehicleSets
+        self.vehicle_index = vehicles.VehicleIndex()
+        self.slots = [None] * window_length
+        self.pending = {}
+        self.latest_period = None
+
+    def isLate(self, period):
+        return self.latest_period is not None and \
+            period <= self.latest_period - self.window_length
+
+    def counts(self, period):
+        # Returns the PeriodCounts of a period, or None if it has left the
+        # window
+        if self.isLate(period):
+            return None
+        if period > self.latest_period:
+            if period not in self.pending:
+                self.pending[period] = PeriodCounts(period, self.vehicle_sets, self.vehicle_index)
+            return self.pending[period]
+        index = period % self.window_length
+        counts = self.slots[index]
+        if counts is None or counts.period != period:
+            # Replaces the counts of a period that has left the window
+            counts = self.slots[index] = PeriodCounts(
+                period, self.vehicle_sets, self.vehicle_index)
+        return counts
+
+    def place(self, end):
+        # Moves the pending periods up to end into the ring
+        for period in sorted([period for period in self.pending if period <= end]):
+            self.slots[period % self.window_length] = self.pending.pop(period)
+
+    def advance(self, period):
+        # Moves the window on to end at the period of a new record, emitting
+        # the windows that end before it and hold any counts
+        if self.latest_period is None:
+            self.latest_period = period
+            return
+        if period <= self.latest_period:
+            return
+        if self.emit:
+            occupied = [counts.period for counts in self.slots if counts is not None] + \
+                [pending for pending in self.pending if pending < period]
+            ends = set()
+            for start in occupied:
+                ends.update(range(max(start, self.latest_period),
+                    min(start + self.window_length, period)))
+            for end in sorted(ends):
+                if (end + 1) % self.window_step == 0:
+                    self.place(end)
+                    self.emitWindow(end)
+        self.place(period)
+        self.latest_period = period
+
+    def emitWindow(self, end=None):
+        self.windows += 1
+        self.emit(self.toMetrics(end))
+
+    def addTrip(self, trip):
+        self.addTripFields(*decoders.tripFields(trip))
+
+    def addTripFields(self, start_time, duration, distance, coordinates, timestamps):
+        period_seconds = self.period_seconds
+        start_period = getPeriod(start_time, period_seconds, 0)
+        if self.isLate(start_period):
+            self.late_records['trips'] += 1
+            return
+        self.advance(start_period)
+        periods = [getPeriod(timestamp, period_seconds, 0) for timestamp in timestamps]
+        geo_ids = self.zones.zones(coordinates)
+        self.trip_count += 1
+        self.route_points += len(timestamps)
+        start = self.counts(start_period)
+        start.total_trips += 1
+        start.total_duration = toFloat32(start.total_duration + duration)
+        start.total_distance = toFloat32(start.total_distance + distance)
+        for period, geo_id in zip(periods, geo_ids):
+            counts = self.counts(period)
+            if counts is not None:
+                counts.trip_volumes[geo_id] = counts.trip_volumes.get(geo_id, 0) + 1
+        if not geo_ids:
+            return
+        pickup = geo_ids[0]
+        dropoff = geo_ids[-1]
+        start.pickups[pickup] = start.pickups.get(pickup, 0) + 1
+        key = (pickup, dropoff)
+        start.flows[key] = start.flows.get(key, 0) + 1
+        end = self.counts(periods[-1])
+        if end is not None:
+            end.dropoffs[dropoff] = end.dropoffs.get(dropoff, 0) + 1
+
+    def addChange(self, change):
+        self.addChangeFields(*decoders.changeFields(change))
+
+    def addChangeFields(self, timestamp, vehicle_id, event_type, coordinates):
+        period = getPeriod(timestamp, self.period_seconds, 0)
+        if self.isLate(period):
+            self.late_records['changes'] += 1
+            return
+        self.advance(period)
+        geo_id = self.zones.zone(*coordinates)
+        self.change_count += 1
+        counts = self.counts(period)
+        counts.on_street.add(geo_id, vehicle_id)
+        if event_type == "available":
+            counts.availability.add(geo_id, vehicle_id)
+
+    @instrument.timer('to_metrics')
+    def toMetrics(self, end=None):
+        # The Metrics of the window ending at period end, the latest period by
+        # default. geo_ids only has the zones in the window, but a zone has
+        # the same geo_id in every window.
         metrics = Metrics()
-        metrics.ParseFromString(pbfile.read())
+        metrics.period_seconds = self.period_seconds
+        metrics.cycle_length = 0
+        end = self.latest_period if end is None else end
+        if end is None:
+            return metrics
+        first = end - self.window_length + 1
+        metrics.start_time = max(first, 0) * self.period_seconds
+        metrics.end_time = (end + 1) * self.period_seconds
+        window = sorted([counts for counts in self.slots
+            if counts is not None and first <= counts.period <= end],
+            key=lambda counts: counts.period)
+        referenced = set()
+        for counts in window:
+            period = counts.period
+            if counts.total_trips:
+                metrics.total_trips[period] = counts.total_trips
+                metrics.total_duration[period] = counts.total_duration
+                metrics.total_distance[period] = counts.total_distance
+            for field, data in (
+                    (metrics.trip_volumes, counts.trip_volumes),
+                    (metrics.pickups, counts.pickups),
+                    (metrics.dropoffs, counts.dropoffs)):
+                if data:
+                    field[period].data.update(data)
+                    referenced.update(data)
+            for (pickup, dropoff), count in counts.flows.items():
+                metrics.flows[period].data[pickup].data[dropoff] = count
+                # The dropoff may be counted in a period after the window
+                referenced.add(dropoff)
+            for field, vehicle_sets in (
+                    (metrics.availability, counts.availability),
+                    (metrics.on_street, counts.on_street)):
+                for geo_id, count in vehicle_sets.counts():
+                    field[period].data[geo_id] = count
+                    referenced.add(geo_id)
+        for geo_id in sorted(referenced):
+            metrics.geo_ids[geo_id] = self.geo_ids[geo_id]
+        zones.fillZoneTable(metrics, self.zone_center)
         return metrics
 
-def metricsFromJSON(input_filename, period, cycle_length, gpsaccuracy):
-    metrics = Metrics()
-    metrics.period_seconds = period
-    metrics.cycle_length = cycle_length
-    # We'll need to keep track of the earliest and latest times seen
-    earliest_time = sys.maxsize
-    latest_time = 0
-
-    count = 0
-    inverse_geo_ids = {}
-    with open(input_filename) as f:
-        for trip in map(json.loads, f.readlines()):
-            count += 1
-            timestamp = trip['start_time']
-            earliest_time = min(timestamp, earliest_time)
-            latest_time = max(timestamp, latest_time)
-            start_period = getPeriod(timestamp, metrics.period_seconds, metrics.cycle_length)
-            duration = float(trip['trip_duration'])
-            distance = float(trip['trip_distance'])
-            metrics.total_trips[start_period] += 1
-            metrics.total_duration[start_period] += duration
-            metrics.total_distance[start_period] += distance
-            pickup = None
-            dropoff = None
-            for route_point in trip['route']['features']:
-                timestamp = route_point['properties']['timestamp']
-                period = getPeriod(timestamp, metrics.period_seconds, metrics.cycle_length)
-                earliest_time = min(timestamp, earliest_time)
-                latest_time = max(timestamp, latest_time)
-                (lat, long) = map(float, route_point['geometry']['coordinates'])
-                geo_id = latLongToZone(metrics.geo_ids, lat, long, gpsaccuracy, inverse_geo_ids)
-                metrics.trip_volumes[period].data[geo_id] += 1
-                if pickup == None:
-                    # The first entry in the geometry is assumed to be the pickup)
-                    pickup = geo_id
-                # The lat entry in the geometry is assumed to be the dropoff
-                end_period = period
-                dropoff = geo_id
-            metrics.pickups[start_period].data[pickup] += 1
-            metrics.dropoffs[end_period].data[dropoff] += 1
-            # Flows will be indexed by their start period
-            metrics.flows[start_period].data[pickup].data[dropoff] += 1
-    metrics.start_time = earliest_time
-    metrics.end_time = latest_time
-    logging.debug("Read {} trips. Start {}, end {}".format(count, earliest_time, latest_time))
-    return metrics
+JSON_SUFFIXES = ('.json', '.jsonl', '.ndjson')
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+# Byte-range shards smaller than this are not worth a worker process
+MIN_SHARD_BYTES = 1 << 20
+
+def isJSONInput(filename):
+    # Line-delimited JSON may be read from stdin ('-') or from a file that is
+    # optionally gzip or zstd compressed, e.g. trips.json.gz
+    if filename == '-':
+        return True
+    for suffix in COMPRESSED_SUFFIXES:
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    return filename.endswith(JSON_SUFFIXES)
+
+def openInput(filename):
+    # Returns a text file object suitable for a with statement. Lines are read
+    # lazily so that only one record is held in memory at a time.
+    if filename == '-':
+        return contextlib.nullcontext(sys.stdin)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading {} requires the zstandard package".format(filename))
+        return zstandard.open(filename, 'rt')
+    return open(filename)
+
+def addRecords(accumulator, kind, lines, decoding=None):
+    # Decodes the 'trips' or 'changes' in lines and adds them to accumulator.
+    # decoding creates the RecordDecoder for a kind of record. Bad records are
+    # counted and skipped rather than stopping the run. Returns the number of
+    # bad records.
+    decoder = (decoding or decoders.RecordDecoder)(kind)
+    add = accumulator.addTrip if kind == 'trips' else accumulator.addChange
+    for record in decoder.decodeAll(lines):
+        try:
+            add(record)
+        except decoders.RECORD_ERRORS as e:
+            decoder.badRecord(e)
+    accumulator.bad_records[kind] += decoder.bad_records
+    return decoder.bad_records
+
+def recordTime(kind, record):
+    # The time used to merge records, 0 if it is missing or not a number so
+    # that the record is counted as bad or late when it is added
+    timestamp = record.get('start_time' if kind == 'trips' else 'event_time')
+    return timestamp if isinstance(timestamp, (int, float)) else 0
 
-def parseChanges(metrics, changes_filename, period, cycle_length, gpsaccuracy):
+def timedRecords(kind, decoder, lines):
+    for record in decoder.decodeAll(lines):
+        yield recordTime(kind, record), kind, decoder, record
+
+def addTimeOrderedRecords(accumulator, trips_filenames, changes_filenames, decoding=None):
+    # Adds the records of every file to accumulator in time order, merging the
+    # files on the assumption that each of them is in time order, as a
+    # WindowAccumulator expects. Returns the number of bad records by kind.
+    decoding = decoding or decoders.RecordDecoder
+    file_decoders = []
+    with contextlib.ExitStack() as stack:
+        streams = []
+        for kind, filenames in (('trips', trips_filenames), ('changes', changes_filenames)):
+            for filename in filenames:
+                decoder = decoding(kind)
+                file_decoders.append((kind, decoder))
+                streams.append(timedRecords(kind, decoder, stack.enter_context(openInput(filename))))
+        for _, kind, decoder, record in heapq.merge(*streams, key=lambda entry: entry[0]):
+            try:
+                if kind == 'trips':
+                    accumulator.addTrip(record)
+                else:
+                    accumulator.addChange(record)
+            except decoders.RECORD_ERRORS as e:
+                decoder.badRecord(e)
+    bad_records = {'trips': 0, 'changes': 0}
+    for kind, decoder in file_decoders:
+        bad_records[kind] += decoder.bad_records
+        accumulator.bad_records[kind] += decoder.bad_records
+    return bad_records
+
+def windowFilename(window_prefix, metrics):
+    # [prefix]-[first period].pbf for the window of metrics
+    return "{}-{}.pbf".format(window_prefix, metrics.start_time // metrics.period_seconds)
+
+def logThroughput(kind, count, start, earliest_time, latest_time):
+    elapsed = time.monotonic() - start
+    rate = count / elapsed if elapsed > 0 else 0
+    logging.debug("Read {} {} in {:.2f}s ({:.0f} records/sec). Start {}, end {}".format(
+        count, kind, elapsed, rate, earliest_time, latest_time))
+
+def countRecords(trips=0, changes=0, route_points=0, bad_records=0):
+    # Adds to the record counters of the run's stats
+    instrument.count('trips', trips)
+    instrument.count('changes', changes)
+    instrument.count('route_points', route_points)
+    instrument.count('bad_records', bad_records)
+
+def logBadRecords(kind, count):
+    if count:
+        logging.warning("Skipped {} bad {}".format(count, kind))
+
+def peakMemoryMB():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return maxrss / 1024.0
+
+def metricsFromPBF(input_filename, period=None, cycle_length=None, gpsaccuracy=None):
+    # Packed counts are unpacked into the nested maps
+    return packed.loadMetrics(input_filename)
+
+def metricsFromJSON(input_filename, period, cycle_length, gpsaccuracy, zoning=None,
+        decoding=None):
+    accumulator = MetricsAccumulator(period, cycle_length, gpsaccuracy, zoning=zoning)
+    start = time.monotonic()
+    with openInput(input_filename) as f:
+        bad_records = addRecords(accumulator, 'trips', f, decoding)
+    logThroughput("trips", accumulator.trip_count, start,
+        accumulator.earliest_time, accumulator.latest_time)
+    logBadRecords("trips", bad_records)
+    countRecords(trips=accumulator.trip_count, route_points=accumulator.route_points,
+        bad_records=bad_records)
+    return accumulator.toMetrics()
+
+def getAccumulator(metrics, period, cycle_length, gpsaccuracy, zoning=None,
+        vehicle_sets=None):
     if not metrics:
-        metrics = Metrics()
-        metrics.period_seconds = period
-        metrics.cycle_length = cycle_length
-        earliest_time = sys.maxsize
-        latest_time = 0
+        return MetricsAccumulator(period, cycle_length, gpsaccuracy, zoning=zoning,
+            vehicle_sets=vehicle_sets)
+    # Continue from the existing zones and time range
+    accumulator = MetricsAccumulator(
+        metrics.period_seconds, metrics.cycle_length, gpsaccuracy,
+        geo_ids=metrics.geo_ids, zoning=zoning, vehicle_sets=vehicle_sets)
+    accumulator.earliest_time = metrics.start_time
+    accumulator.latest_time = metrics.end_time
+    return accumulator
+
+def parseChanges(metrics, changes_filename, period, cycle_length, gpsaccuracy, zoning=None,
+        vehicle_sets=None, decoding=None):
+    accumulator = getAccumulator(metrics, period, cycle_length, gpsaccuracy, zoning,
+        vehicle_sets)
+    start = time.monotonic()
+    with openInput(changes_filename) as f:
+        bad_records = addRecords(accumulator, 'changes', f, decoding)
+    logThroughput("vehicle changes", accumulator.change_count, start,
+        accumulator.earliest_time, accumulator.latest_time)
+    logBadRecords("vehicle changes", bad_records)
+    countRecords(changes=accumulator.change_count, bad_records=bad_records)
+    return accumulator.toMetrics(metrics if metrics else None)
+
+def metricsFromWindow(trips_filenames, changes_filenames, period, window_length, gpsaccuracy,
+        zoning=None, vehicle_sets=None, decoding=None, window_step=1, emit=None):
+    # Returns the Metrics of the latest window, calling emit with each window
+    # on the way, see WindowAccumulator
+    accumulator = WindowAccumulator(period, window_length, gpsaccuracy, zoning, vehicle_sets,
+        window_step, emit)
+    start = time.monotonic()
+    bad_records = addTimeOrderedRecords(accumulator, trips_filenames, changes_filenames,
+        decoding)
+    logging.debug("Read {} trips and {} vehicle changes in {:.2f}s, emitting {} windows".format(
+        accumulator.trip_count, accumulator.change_count, time.monotonic() - start,
+        accumulator.windows))
+    logBadRecords("trips", bad_records['trips'])
+    logBadRecords("vehicle changes", bad_records['changes'])
+    countRecords(accumulator.trip_count, accumulator.change_count, accumulator.route_points,
+        sum(bad_records.values()))
+    instrument.count('late_records', sum(accumulator.late_records.values()))
+    for kind, count in accumulator.late_records.items():
+        if count:
+            logging.warning("Skipped {} {} older than the window".format(
+                count, "trips" if kind == 'trips' else "vehicle changes"))
+    return accumulator.toMetrics()
+
+def metricsFromConfigs(trips_filenames, changes_filenames, configs, zonings,
+        vehicle_sets=None, decoding=None):
+    # Returns the Metrics of each (period, cycle_length, gpsaccuracy) config,
+    # reading the inputs once. zonings maps each accuracy to its zoning.
+    accumulator = MultiAccumulator(configs, zonings, vehicle_sets)
+    start = time.monotonic()
+    for kind, filenames in (('trips', trips_filenames), ('changes', changes_filenames)):
+        for filename in filenames:
+            logging.debug("Reading {}".format(filename))
+            with openInput(filename) as f:
+                addRecords(accumulator, kind, f, decoding)
+    first = accumulator.accumulators[0]
+    logThroughput("trips and vehicle changes", first.trip_count + first.change_count, start,
+        first.earliest_time, first.latest_time)
+    logBadRecords("trips", accumulator.bad_records['trips'])
+    logBadRecords("vehicle changes", accumulator.bad_records['changes'])
+    countRecords(first.trip_count, first.change_count, first.route_points,
+        sum(accumulator.bad_records.values()))
+    return [each.toMetrics() for each in accumulator.accumulators]
+
+def splitByteRanges(filename, shards, min_shard_bytes=MIN_SHARD_BYTES):
+    # Splits a file into at most the given number of (start, end) byte ranges.
+    # Ranges need not fall on line boundaries; see readLineRange.
+    size = os.path.getsize(filename)
+    shard_bytes = max(-(-size // max(shards, 1)), min_shard_bytes, 1)
+    return [(start, min(start + shard_bytes, size)) for start in range(0, size, shard_bytes)]
+
+def readLineRange(filename, start, end):
+    # Yields every line that starts within [start, end). A line straddling
+    # start belongs to the previous range.
+    with open(filename, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+def isSplittable(filename):
+    return filename != '-' and not filename.endswith(COMPRESSED_SUFFIXES)
+
+def aggregateShard(shard):
+    # Builds the partial aggregate of one shard in a worker process
+    (kind, filename, byte_range, period, cycle_length, gpsaccuracy, zoning, vehicle_sets,
+        decoding) = shard
+    accumulator = MetricsAccumulator(period, cycle_length, gpsaccuracy, zoning=zoning,
+        vehicle_sets=vehicle_sets)
+    if byte_range:
+        addRecords(accumulator, kind, readLineRange(filename, *byte_range), decoding)
+    else:
+        with openInput(filename) as f:
+            addRecords(accumulator, kind, f, decoding)
+    return accumulator
+
+def getShards(trips_filenames, changes_filenames, period, cycle_length, gpsaccuracy,
+        jobs, min_shard_bytes=MIN_SHARD_BYTES, zoning=None, vehicle_sets=None,
+        decoding=None):
+    shards = []
+    for kind, filenames in (('trips', trips_filenames), ('changes', changes_filenames)):
+        for filename in filenames:
+            if isSplittable(filename):
+                byte_ranges = splitByteRanges(filename, jobs, min_shard_bytes)
+            else:
+                byte_ranges = [None]
+            for byte_range in byte_ranges:
+                shards.append((kind, filename, byte_range, period, cycle_length,
+                    gpsaccuracy, zoning, vehicle_sets, decoding))
+    return shards
+
+def aggregateShards(accumulator, trips_filenames, changes_filenames, jobs,
+        min_shard_bytes=MIN_SHARD_BYTES, zoning=None, vehicle_sets=None, decoding=None):
+    # Aggregates trip and change files, split into byte ranges where possible,
+    # across a pool of worker processes and merges the partial aggregates into
+    # accumulator. Partials are merged in input order, so the result matches
+    # reading the files one after another, apart from float rounding of the
+    # distance and duration totals.
+    shards = getShards(trips_filenames, changes_filenames or [],
+        accumulator.period_seconds, accumulator.cycle_length, accumulator.gpsaccuracy,
+        jobs, min_shard_bytes, zoning, vehicle_sets, decoding)
+    logging.debug("Aggregating {} shards with {} jobs".format(len(shards), jobs))
+    start = time.monotonic()
+    trip_count, change_count = accumulator.trip_count, accumulator.change_count
+    route_points = accumulator.route_points
+    bad_records = dict(accumulator.bad_records)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            # Workers read /dev/null as stdin, so standard input is read here
+            # while the workers read the files
+            partials = pool.imap(aggregateShard, [shard for shard in shards if shard[1] != '-'])
+            for shard in shards:
+                accumulator.merge(aggregateShard(shard) if shard[1] == '-' else next(partials))
     else:
-        earliest_time = metrics.start_time
-        latest_time = metrics.end_time
-    count = 0
-    availability_map = {}
-    onstreet_map = {}
-    inverse_geo_ids = dict([(x[1], x[0]) for x in metrics.geo_ids.items()])
-    with open(changes_filename) as f:
-        for change in map(json.loads, f.readlines()):
-            count += 1
-            timestamp = change['event_time']
-            event_period = getPeriod(timestamp, metrics.period_seconds, metrics.cycle_length)
-            earliest_time = min(timestamp, earliest_time)
-            latest_time = max(timestamp, latest_time)
-            vehicle_id = change['vehicle_id']
-            event_type = change['event_type']
-            (lat, long) = map(float, change['event_location']['geometry']['coordinates'])
-            geo_id = latLongToZone(
-                metrics.geo_ids,
-                lat,
-                long,
-                gpsaccuracy,
-                inverse_geo_ids)
-
-            if event_period not in onstreet_map:
-                onstreet_map[event_period] = {}
-            if geo_id not in onstreet_map[event_period]:
-                onstreet_map[event_period][geo_id] = {}
-            if vehicle_id not in onstreet_map[event_period][geo_id]:
-                onstreet_map[event_period][geo_id][vehicle_id] = 0
-            onstreet_map[event_period][geo_id][vehicle_id] += 1
-
-            if event_type == "available":
-                if event_period not in availability_map:
-                    availability_map[event_period] = {}
-                if geo_id not in availability_map[event_period]:
-                    availability_map[event_period][geo_id] = {}
-                if vehicle_id not in availability_map[event_period][geo_id]:
-                    availability_map[event_period][geo_id][vehicle_id] = 0
-                availability_map[event_period][geo_id][vehicle_id] += 1
-    for period in availability_map:
-        for geo_id in availability_map[period]:
-            metrics.availability[period].data[geo_id] = len(availability_map[period][geo_id])
-    for period in onstreet_map:
-        for geo_id in onstreet_map[period]:
-            metrics.on_street[period].data[geo_id] = len(onstreet_map[period][geo_id])
-    logging.debug("Read {} vehicle changes. Start {}, end {}".format(count, earliest_time, latest_time))
-    metrics.start_time = earliest_time
-    metrics.end_time = latest_time
+        for partial in map(aggregateShard, shards):
+            accumulator.merge(partial)
+    logThroughput("trips and vehicle changes",
+        accumulator.trip_count - trip_count + accumulator.change_count - change_count,
+        start, accumulator.earliest_time, accumulator.latest_time)
+    logBadRecords("trips", accumulator.bad_records['trips'] - bad_records['trips'])
+    logBadRecords("vehicle changes", accumulator.bad_records['changes'] - bad_records['changes'])
+    countRecords(accumulator.trip_count - trip_count, accumulator.change_count - change_count,
+        accumulator.route_points - route_points,
+        sum(accumulator.bad_records.values()) - sum(bad_records.values()))
+    return accumulator
+
+def metricsFromShards(trips_filenames, changes_filenames, period, cycle_length,
+        gpsaccuracy, jobs, metrics=None, min_shard_bytes=MIN_SHARD_BYTES, zoning=None,
+        vehicle_sets=None, decoding=None):
+    # If metrics is given, the new data is added to it
+    accumulator = getAccumulator(metrics, period, cycle_length, gpsaccuracy, zoning,
+        vehicle_sets)
+    aggregateShards(accumulator, trips_filenames, changes_filenames, jobs,
+        min_shard_bytes, zoning, vehicle_sets, decoding)
+    return accumulator.toMetrics(metrics)
+
+def vehicleStateFilename(pbf_filename):
+    # The sidecar holding the distinct vehicle sets of an aggregate
+    return pbf_filename + ".vehicles.json.gz"
+
+def saveVehicleState(accumulator, state_filename):
+    logging.debug("Writing vehicle state to {}".format(state_filename))
+    state = {
+        'period_seconds': accumulator.period_seconds,
+        'cycle_length': accumulator.cycle_length,
+        'availability': [[period, geo_id, sorted(vehicle_ids)]
+            for (period, geo_id), vehicle_ids in accumulator.availability.items()],
+        'on_street': [[period, geo_id, sorted(vehicle_ids)]
+            for (period, geo_id), vehicle_ids in accumulator.on_street.items()],
+    }
+    with gzip.open(state_filename, 'wt') as f:
+        json.dump(state, f)
+
+def loadVehicleState(state_filename):
+    logging.debug("Reading vehicle state from {}".format(state_filename))
+    with gzip.open(state_filename, 'rt') as f:
+        state = json.load(f)
+    for field in ('availability', 'on_street'):
+        state[field] = dict([((period, geo_id), set(vehicle_ids))
+            for period, geo_id, vehicle_ids in state[field]])
+    return state
+
+def checkGridAccuracy(accumulator):
+    # New grid zones must be rounded to the accuracy of the existing ones, or
+    # the same places would be counted in cells of two sizes
+    backend = getattr(accumulator.zones, 'backend', accumulator.zones)
+    if not isinstance(backend, zones.GridZones):
+        return
+    for name in accumulator.geo_ids.values():
+        accuracy = zones.nameAccuracy(name)
+        if accuracy is not None and accuracy != backend.gpsaccuracy:
+            raise ValueError("The aggregate has zones at an accuracy of {}, not {}".format(
+                accuracy, backend.gpsaccuracy))
+
+def accumulatorFromMetrics(metrics, gpsaccuracy, vehicle_state=None, zoning=None):
+    # Loads an existing aggregate so that new trips and changes can be folded
+    # into it. Counts are summable, but on_street and availability are counts
+    # of distinct vehicles, so those need the vehicle sets saved alongside the
+    # aggregate with saveVehicleState.
+    if metrics.privacy_level:
+        raise ValueError("Cannot add to a suppressed aggregate")
+    if (metrics.on_street or metrics.availability) and vehicle_state is None:
+        raise ValueError("Adding to an aggregate with vehicle counts requires its vehicle state")
+    if vehicle_state and (vehicle_state['period_seconds'], vehicle_state['cycle_length']) != (
+            metrics.period_seconds, metrics.cycle_length):
+        raise ValueError("Vehicle state does not match the period and cycle length of the aggregate")
+    accumulator = getAccumulator(metrics, None, None, gpsaccuracy, zoning)
+    checkGridAccuracy(accumulator)
+    accumulator.total_trips.update(metrics.total_trips)
+    accumulator.total_duration.update(metrics.total_duration)
+    accumulator.total_distance.update(metrics.total_distance)
+    for counts, field in (
+            (accumulator.trip_volumes, metrics.trip_volumes),
+            (accumulator.pickups, metrics.pickups),
+            (accumulator.dropoffs, metrics.dropoffs)):
+        for period in field:
+            for geo_id, count in field[period].data.items():
+                counts[(period, geo_id)] = count
+    for period in metrics.flows:
+        for pickup, dropoffs in metrics.flows[period].data.items():
+            for dropoff, count in dropoffs.data.items():
+                accumulator.flows[(period, pickup, dropoff)] = count
+    if vehicle_state:
+        for vehicle_sets, field in (
+                (accumulator.availability, 'availability'),
+                (accumulator.on_street, 'on_street')):
+            for key, vehicle_ids in vehicle_state[field].items():
+                vehicle_sets.addAll(key, sorted(vehicle_ids))
+    return accumulator
+
+def addZoneDictionary(accumulator, dictionary):
+    # Adds the zones of a zone dictionary to an accumulator in place, where
+    # its zoning backend sees them, so that they keep their geo_ids. The
+    # accumulator's zones, such as those of an aggregate being added to, must
+    # agree with the dictionary.
+    for geo_id, name in dictionary.items():
+        if (accumulator.geo_ids.get(geo_id, name) != name
+                or accumulator.inverse_geo_ids.get(name, geo_id) != geo_id):
+            raise ValueError("Zone {} does not have geo_id {} of the zone dictionary".format(
+                name, geo_id))
+        accumulator.geo_ids[geo_id] = name
+        accumulator.inverse_geo_ids[name] = geo_id
+
+def pruneZones(metrics):
+    # Removes the zones that no counts refer to, in place, such as the other
+    # zones of a zone dictionary
+    referenced = pbfquery.referencedZones(metrics, pbfquery.ZONE_FIELDS + ('flows',))
+    centers = zones.zoneCenters(metrics)
+    for geo_id in [geo_id for geo_id in metrics.geo_ids if geo_id not in referenced]:
+        del metrics.geo_ids[geo_id]
+    named_centers = dict([(metrics.geo_ids[geo_id], centers[geo_id]) for geo_id in metrics.geo_ids])
+    zones.fillZoneTable(metrics, named_centers.get)
+    return metrics
+
+def cacheSettings(args):
+    # The settings other than the period, cycle length and accuracy that a
+    # partial aggregate depends on, see aggregateCached
+    settings = {'zones': args.zones, 'validate_every': args.validate_every}
+    if args.zones in ('square', 'hex'):
+        settings['zone_level'] = args.zone_level
+    if args.zones == 'geojson':
+        settings['zone_file'] = partials.fileDigest(args.zone_file)
+        settings['zone_property'] = args.zone_property
+    return settings
+
+@instrument.timer('cache')
+def partialKey(filename, kind, accumulator, settings):
+    return partials.cacheKey(partials.fileDigest(filename), dict(settings, kind=kind,
+        period=accumulator.period_seconds, cycle_length=accumulator.cycle_length,
+        accuracy=accumulator.gpsaccuracy))
+
+def partialToMetrics(partial):
+    # The Metrics of a partial aggregate with the counts in the packed
+    # encoding, built straight from its dicts, which is much faster to write
+    # and read than the nested maps. The distinct vehicle counts are left out
+    # as they are rebuilt from the vehicle state.
+    metrics = Metrics()
+    metrics.period_seconds = partial.period_seconds
+    metrics.cycle_length = partial.cycle_length
+    metrics.start_time = partial.earliest_time
+    metrics.end_time = partial.latest_time
+    for geo_id, coordinates in partial.geo_ids.items():
+        metrics.geo_ids[geo_id] = coordinates
+    metrics.total_trips.update(partial.total_trips)
+    metrics.total_duration.update(partial.total_duration)
+    metrics.total_distance.update(partial.total_distance)
+    for field_name in ('trip_volumes', 'pickups', 'dropoffs'):
+        packed.packCountDict(getattr(metrics, 'packed_' + field_name),
+            getattr(partial, field_name))
+    packed.packFlowDict(metrics.packed_flows, partial.flows)
     return metrics
 
+def sortCounts(partial):
+    # Puts the count dicts of a partial aggregate in the order of the packed
+    # encoding, sorted by key, as partialFromMetrics returns them
+    for field_name in ('trip_volumes', 'pickups', 'dropoffs', 'flows'):
+        setattr(partial, field_name, dict(sorted(getattr(partial, field_name).items())))
+
+def partialFromMetrics(metrics, vehicle_state, gpsaccuracy, zoning=None):
+    # Inverse of partialToMetrics
+    if (vehicle_state['period_seconds'], vehicle_state['cycle_length']) != (
+            metrics.period_seconds, metrics.cycle_length):
+        raise ValueError("Vehicle state does not match the period and cycle length of the aggregate")
+    partial = getAccumulator(metrics, None, None, gpsaccuracy, zoning)
+    partial.total_trips.update(metrics.total_trips)
+    partial.total_duration.update(metrics.total_duration)
+    partial.total_distance.update(metrics.total_distance)
+    for field_name in ('trip_volumes', 'pickups', 'dropoffs'):
+        setattr(partial, field_name, packed.unpackCountDict(metrics, field_name))
+    partial.flows = packed.unpackFlowDict(metrics)
+    for vehicle_sets, field in (
+            (partial.availability, 'availability'),
+            (partial.on_street, 'on_street')):
+        for key, vehicle_ids in vehicle_state[field].items():
+            vehicle_sets.addAll(key, sorted(vehicle_ids))
+    return partial
+
+@instrument.timer('cache')
+def storePartial(cache, key, partial, kind, filename):
+    # A partial aggregate is cached as its Metrics and vehicle state, along
+    # with the record counts that Metrics does not hold
+    metrics = partialToMetrics(partial)
+    cache.put(key, {
+            '.pbf': functools.partial(outputFile, metrics),
+            '.vehicles.json.gz': functools.partial(saveVehicleState, partial),
+        }, {
+            'kind': kind,
+            'source': os.path.abspath(filename),
+            'trips': partial.trip_count,
+            'changes': partial.change_count,
+            'route_points': partial.route_points,
+            'bad_records': partial.bad_records,
+        })
+
+@instrument.timer('cache')
+def loadPartial(cache, key, gpsaccuracy, zoning=None):
+    # Returns the cached partial aggregate with the given key, or None
+    meta = cache.get(key)
+    if meta is None:
+        return None
+    try:
+        metrics = Metrics()
+        with open(cache.filename(key, '.pbf'), 'rb') as f:
+            metrics.ParseFromString(f.read())
+        partial = partialFromMetrics(metrics,
+            loadVehicleState(cache.filename(key, '.vehicles.json.gz')), gpsaccuracy, zoning)
+        partial.trip_count = meta['trips']
+        partial.change_count = meta['changes']
+        partial.route_points = meta['route_points']
+        partial.bad_records = dict(meta['bad_records'])
+    except (OSError, ValueError, KeyError, DecodeError) as e:
+        logging.warning("Discarding unreadable cache entry {}: {}".format(key, e))
+        cache.remove(key)
+        return None
+    return partial
+
+def aggregateCached(accumulator, trips_filenames, changes_filenames, jobs, cache, settings,
+        zoning=None, vehicle_sets=None, decoding=None):
+    # Like aggregateShards, except that the partial aggregate of each input
+    # file is loaded from cache if a file with the same content has been read
+    # with the same settings, and is otherwise read and added to the cache.
+    # The counts of partials that were read are sorted by key, as those loaded
+    # from the cache are, so that the output of cold and warm runs is
+    # byte-identical. The counts match a run without the cache, but the
+    # serialized key order can differ from that of aggregateShards, which
+    # keeps the order in which records were read.
+    # The least recently used partials are evicted once the cache is full.
+    for kind, filenames in (('trips', trips_filenames), ('changes', changes_filenames or [])):
+        for filename in filenames:
+            key = None if filename == '-' else partialKey(filename, kind, accumulator, settings)
+            partial = loadPartial(cache, key, accumulator.gpsaccuracy, zoning) if key else None
+            if partial is not None:
+                logging.debug("Loaded {} {} from the cache".format(filename, kind))
+                instrument.count('cache_hits')
+            else:
+                instrument.count('cache_misses')
+                partial = MetricsAccumulator(accumulator.period_seconds,
+                    accumulator.cycle_length, accumulator.gpsaccuracy, zoning=zoning,
+                    vehicle_sets=vehicle_sets)
+                aggregateShards(partial, [filename] if kind == 'trips' else [],
+                    [filename] if kind == 'changes' else [], jobs, zoning=zoning,
+                    vehicle_sets=vehicle_sets, decoding=decoding)
+                if key:
+                    storePartial(cache, key, partial, kind, filename)
+                    sortCounts(partial)
+            accumulator.merge(partial)
+    cache.prune()
+    return accumulator
+
+@instrument.timer('write')
 def outputFile(metrics, output_filename):
     logging.debug("Writing to {}".format(output_filename))
     with open(output_filename, "wb") as output:
         output.write(metrics.SerializeToString())
+        instrument.count('bytes_written', output.tell())
+
+def writeAtomically(writers):
+    # writers maps each filename to a function writing that file to the
+    # filename it is given. All of the files are written to temporary names
+    # next to them before any is renamed, so a failed write leaves the
+    # existing files as they were, and files written together, such as an
+    # aggregate and its vehicle state, are replaced together.
+    temporaries = dict([(filename, "{}.{}.tmp".format(filename, os.getpid()))
+        for filename in writers])
+    try:
+        for filename, write in writers.items():
+            write(temporaries[filename])
+        for filename, temporary in temporaries.items():
+            os.replace(temporary, filename)
+    finally:
+        for temporary in temporaries.values():
+            if os.path.exists(temporary):
+                os.unlink(temporary)
 
-def decompose(degree, source_graph, dest_graph, degrees):
-    if degree not in degrees:
-        degrees[degree] = []
-    to_remove = []
-    for source in source_graph:
-        out_degree = len(source_graph[source])
-        if out_degree <= degree:
-            degrees[degree].append(source)
-            to_remove.append(source)
-            # Delete this node and its edges
-            for dest in source_graph[source]:
-                dest_graph[dest].remove(source)
-    removed = len(to_remove)
-    for source in to_remove:
-        del source_graph[source]
+def outputSuppressedFile(metrics, privacy_level, output_filename, peeled_flows=None):
+    logging.debug("Writing to {}".format(output_filename))
+    with open(output_filename, "wb") as output:
+        writeSuppressed(metrics, privacy_level, output, peeled_flows)
+        instrument.count('bytes_written', output.tell())
+
+def peel(degree, source_degrees, source_buckets, source_graph, dest_degrees, dest_buckets):
+    # Removes every remaining source node with at most the given degree and
+    # the edges to its destinations. Degrees of the other source nodes do not
+    # change while their side is peeled, so this removes the same nodes as
+    # checking each of them in turn. Returns the removed nodes.
+    removed = []
+    for bucket in source_buckets[:degree + 1]:
+        removed.extend(bucket)
+        bucket.clear()
+    for source in removed:
+        del source_degrees[source]
+        for dest in source_graph[source]:
+            dest_degree = dest_degrees.get(dest)
+            if dest_degree is not None:
+                dest_buckets[dest_degree].discard(dest)
+                dest_buckets[dest_degree - 1].add(dest)
+                dest_degrees[dest] = dest_degree - 1
     return removed
 
-def graphToEdgeSet(graph, reverse=False):
-    edges = []
-    for source in graph:
-        for dest in graph[source]:
-            if reverse:
-                edges.append((dest, source))
-            else:
-                edges.append((source, dest))
-    return set(edges)
+def degreeBuckets(graph):
+    # Bucket queue of the nodes of an adjacency list by their degree
+    degrees = dict([(node, len(edges)) for node, edges in graph.items()])
+    buckets = [set() for _ in range(max(degrees.values(), default=0) + 1)]
+    for node, degree in degrees.items():
+        buckets[degree].add(node)
+    return degrees, buckets
 
-# To apply l-diversity, we want to take a graph of trip flows and remove any
-# nodes with less than l in- or out-edges. This the trip flow graph based on
-# the in- and out-degrees and iteratively filters out all <l degree nodes.
-def decomposeTrips(pickups, privacy_level):
-    # Set up edge adjacency lists
+def peelFlows(pickups, privacy_level):
+    # Set up edge adjacency lists. Pickups and dropoffs are distinct nodes, even
+    # if they are the same zone.
     outbound = {}
     inbound = {}
     for pickup in pickups:
-        dropoffs = pickups[pickup].data
-        if pickup not in outbound:
-            outbound[pickup] = []
-        for dropoff in dropoffs:
-            if dropoff not in outbound[pickup]:
-                outbound[pickup].append(dropoff)
+        outbound[pickup] = list(pickups[pickup].data)
+        for dropoff in outbound[pickup]:
             if dropoff not in inbound:
                 inbound[dropoff] = []
-            if pickup not in inbound[dropoff]:
-                inbound[dropoff].append(pickup)
-    out_degrees = {}
-    in_degrees = {}
-    degree, out_removed, in_removed = 1, 0, 0
-    # This implements the k-coreness algorithm from Matula & Beck '83.
-    # It effectively removes all the nodes of a given degree and stores them in
-    # the {ont, in}_degrees map. That map is the decomposition of the graph.
+            inbound[dropoff].append(pickup)
+    out_degrees, out_buckets = degreeBuckets(outbound)
+    in_degrees, in_buckets = degreeBuckets(inbound)
+    # This implements the k-coreness algorithm from Matula & Beck '83 with
+    # bucket queues, so each period takes O(V+E) time. At each degree it
+    # removes all the pickups and then all the dropoffs of that degree or less
+    # and records the degree at which each node was removed.
+    out_levels = {}
+    in_levels = {}
     for degree in range(1, privacy_level):
-        out_removed = decompose(degree, outbound, inbound, out_degrees)
-        in_removed = decompose(degree, inbound, outbound, in_degrees)
+        out_removed = peel(degree, out_degrees, out_buckets, outbound, in_degrees, in_buckets)
+        in_removed = peel(degree, in_degrees, in_buckets, inbound, out_degrees, out_buckets)
+        for pickup in out_removed:
+            out_levels[pickup] = degree
+        for dropoff in in_removed:
+            in_levels[dropoff] = degree
         # If nothing is removed, there are no nodes left with the given degree
         # or higher.
-        if out_removed == 0 and in_removed == 0:
+        if not out_removed and not in_removed:
             break
-        degree += 1
-    # Check that all the edges are consistent in outbound and inbound graphs
-    outedges = graphToEdgeSet(outbound)
-    inedges = graphToEdgeSet(inbound, reverse=True)
-    assert not outedges.symmetric_difference(inedges)
-    return outedges
-
-def suppress(metrics, privacy_level):
+    return outbound, out_levels, in_levels
+
+def survivingFlows(peeled, privacy_level):
+    # Peeling at a lower privacy level is a prefix of peeling at a higher one,
+    # so a node survives privacy level l if it was not removed below degree l.
+    (outbound, out_levels, in_levels) = peeled
+    return set([(pickup, dropoff)
+        for pickup in outbound if out_levels.get(pickup, privacy_level) >= privacy_level
+        for dropoff in outbound[pickup] if in_levels.get(dropoff, privacy_level) >= privacy_level])
+
+# To apply l-diversity, we want to take a graph of trip flows and remove any
+# nodes with less than l in- or out-edges. This the trip flow graph based on
+# the in- and out-degrees and iteratively filters out all <l degree nodes.
+def decomposeTrips(pickups, privacy_level):
+    return survivingFlows(peelFlows(pickups, privacy_level), privacy_level)
+
+@instrument.timer('peel')
+def peelAllFlows(metrics, privacy_levels):
+    # Peels each period's flow graph once for all of the given privacy levels
+    max_level = max(privacy_levels)
+    return dict([(period, peelFlows(metrics.flows[period].data, max_level))
+        for period in metrics.flows])
+
+# Fields that suppression filters or sets. All others are copied unchanged.
+SUPPRESSED_FIELDS = ('trip_volumes', 'flows')
+SUPPRESSION_FIELDS = ('privacy_level', 'trip_volume_suppressed', 'flows_suppressed')
+
+def checkUnpacked(metrics):
+    # Suppression reads the nested maps, and would copy packed counts
+    # through unsuppressed
+    if packed.isPacked(metrics):
+        raise ValueError("Suppression requires counts in the nested map encoding, "
+            "see packed.unpackMetrics")
+
+def copyFields(metrics, output, field_names):
+    for name in field_names:
+        value = getattr(metrics, name)
+        if hasattr(value, 'MergeFrom'):
+            getattr(output, name).MergeFrom(value)
+        else:
+            setattr(output, name, value)
+
+def unsuppressedFieldNames(first=0, last=sys.maxsize):
+    # Names of the copied fields with field numbers in [first, last)
+    return [field.name for field in Metrics.DESCRIPTOR.fields
+        if first <= field.number < last
+        and field.name not in SUPPRESSED_FIELDS + SUPPRESSION_FIELDS]
+
+def suppressVolumes(metrics, period, privacy_level, output):
+    # Enforce k-anonymity of a period's trip volumes. Returns the count of
+    # trips that were suppressed.
+    volume_suppressed = 0
+    geo_ids = metrics.trip_volumes[period].data
+    for geo_id, count in geo_ids.items():
+        if count >= privacy_level:
+            output.trip_volumes[period].data[geo_id] = count
+        else:
+            volume_suppressed += count
+    return volume_suppressed
+
+def suppressFlows(metrics, period, privacy_level, output, peeled_flows=None):
+    # Enforce l-diversity of a period's flows. Returns the total and
+    # unsuppressed count of flows.
+    total_flows = 0
+    unsuppressed_flows = 0
+    pickups = metrics.flows[period].data
+    for pickup in pickups:
+        total_flows += sum(pickups[pickup].data.values())
+    if peeled_flows is None:
+        trips = decomposeTrips(pickups, privacy_level)
+    else:
+        trips = survivingFlows(peeled_flows[period], privacy_level)
+    # Copy over flow data from the suppressed pickup/dropoff pairs
+    for (pickup, dropoff) in trips:
+        count = pickups[pickup].data[dropoff]
+        output.flows[period].data[pickup].data[dropoff] = count
+        unsuppressed_flows += count
+    return total_flows, unsuppressed_flows
+
+@instrument.timer('suppress')
+def suppress(metrics, privacy_level, peeled_flows=None):
+    # peeled_flows may be shared between privacy levels, see peelAllFlows.
+    # Only the fields that are not suppressed are copied from metrics.
+    checkUnpacked(metrics)
     logging.debug("Suppressing flows with l-diversity of {}".format(privacy_level))
     suppressed_metrics = Metrics()
-    suppressed_metrics.MergeFrom(metrics)
+    copyFields(metrics, suppressed_metrics, unsuppressedFieldNames())
     suppressed_metrics.privacy_level = privacy_level
-    suppressed_metrics.trip_volume_suppressed = 0
-    suppressed_metrics.flows_suppressed = 0
-    suppressed_metrics.ClearField("trip_volumes")
-    suppressed_metrics.ClearField("flows")
-
-    # Enforce k-anonymity of trip volumes
+    volume_suppressed = 0
     for period in metrics.trip_volumes:
-        geo_ids = metrics.trip_volumes[period].data
-        for geo_id in geo_ids:
-            count = metrics.trip_volumes[period].data[geo_id]
-            if count >= suppressed_metrics.privacy_level:
-                suppressed_metrics.trip_volumes[period].data[geo_id] = count
-            else:
-                suppressed_metrics.trip_volume_suppressed += count
+        volume_suppressed += suppressVolumes(metrics, period, privacy_level, suppressed_metrics)
+    total_flows = 0
+    unsuppressed_flows = 0
+    for period in metrics.flows:
+        (total, unsuppressed) = suppressFlows(
+            metrics, period, privacy_level, suppressed_metrics, peeled_flows)
+        total_flows += total
+        unsuppressed_flows += unsuppressed
+    suppressed_metrics.trip_volume_suppressed = volume_suppressed
+    suppressed_metrics.flows_suppressed = total_flows - unsuppressed_flows
+    return suppressed_metrics
 
-    # Enforce l-diversity of flows
+def writeSuppressed(metrics, privacy_level, output, peeled_flows=None):
+    # Writes the serialized suppressed Metrics to a binary file one period at
+    # a time, so the whole suppressed message is never held in memory. Fields
+    # are serialized in field number order and map entries are independent,
+    # so concatenating the serialized parts gives the same bytes as
+    # suppress(metrics, privacy_level).SerializeToString(). Building the parts
+    # is timed as suppress and serializing and writing them as write, as when
+    # the suppressed Metrics is built and then written.
+    checkUnpacked(metrics)
+    logging.debug("Suppressing flows with l-diversity of {}".format(privacy_level))
+    writePart = instrument.timed('write', lambda part: output.write(part.SerializeToString()))
+    volumes_number = Metrics.DESCRIPTOR.fields_by_name['trip_volumes'].number
+    flows_number = Metrics.DESCRIPTOR.fields_by_name['flows'].number
+    part = Metrics()
+    with instrument.stage('suppress'):
+        copyFields(metrics, part, unsuppressedFieldNames(last=volumes_number))
+    writePart(part)
+    volume_suppressed = 0
+    for period in metrics.trip_volumes:
+        part = Metrics()
+        with instrument.stage('suppress'):
+            volume_suppressed += suppressVolumes(metrics, period, privacy_level, part)
+        writePart(part)
+    part = Metrics()
+    with instrument.stage('suppress'):
+        copyFields(metrics, part, unsuppressedFieldNames(volumes_number, flows_number))
+    writePart(part)
     total_flows = 0
     unsuppressed_flows = 0
     for period in metrics.flows:
+        part = Metrics()
+        with instrument.stage('suppress'):
+            (total, unsuppressed) = suppressFlows(metrics, period, privacy_level, part, peeled_flows)
+        total_flows += total
+        unsuppressed_flows += unsuppressed
+        writePart(part)
+    part = Metrics()
+    with instrument.stage('suppress'):
+        copyFields(metrics, part, unsuppressedFieldNames(first=flows_number))
+    part.privacy_level = privacy_level
+    part.trip_volume_suppressed = volume_suppressed
+    part.flows_suppressed = total_flows - unsuppressed_flows
+    writePart(part)
+
+def suppressionSweep(metrics, privacy_levels):
+    # Computes the suppressed trip volume and flows of every privacy level in
+    # one pass, without building the suppressed Metrics. Volume counts and the
+    # level at which each flow is removed are tallied in histograms capped at
+    # the highest privacy level. Returns a dict of privacy level to
+    # (trip_volume_suppressed, flows_suppressed).
+    checkUnpacked(metrics)
+    max_level = max(privacy_levels)
+    volume_by_count = [0] * (max_level + 1)
+    for period in metrics.trip_volumes:
+        for count in metrics.trip_volumes[period].data.values():
+            volume_by_count[min(count, max_level)] += count
+    flows_by_level = [0] * (max_level + 1)
+    for period, peeled in peelAllFlows(metrics, privacy_levels).items():
+        (outbound, out_levels, in_levels) = peeled
         pickups = metrics.flows[period].data
-        for pickup in pickups:
-            for dropoff in pickups[pickup].data:
-                total_flows += pickups[pickup].data[dropoff]
+        for pickup in outbound:
+            pickup_level = out_levels.get(pickup, max_level)
+            dropoffs = pickups[pickup].data
+            for dropoff, count in dropoffs.items():
+                flows_by_level[min(pickup_level, in_levels.get(dropoff, max_level))] += count
+    sweep = {}
+    for privacy_level in privacy_levels:
+        sweep[privacy_level] = (
+            sum(volume_by_count[:privacy_level]),
+            sum(flows_by_level[:privacy_level]))
+    return sweep
 
-        trips = decomposeTrips(pickups, privacy_level)
-        # Copy over flow data from the suppressed pickup/dropoff pairs
-        for (pickup, dropoff) in trips:
-            suppressed_metrics.flows[period].data[pickup].data[dropoff] = pickups[pickup].data[dropoff]
-            unsuppressed_flows += pickups[pickup].data[dropoff]
-    suppressed_metrics.flows_suppressed = total_flows - unsuppressed_flows
-    return suppressed_metrics
+def mapCells(metrics):
+    # The number of entries in the count maps and flows of metrics
+    cells = 0
+    for field in (metrics.trip_volumes, metrics.pickups, metrics.dropoffs,
+            metrics.availability, metrics.on_street):
+        cells += sum([len(counts.data) for counts in field.values()])
+    for pickups in metrics.flows.values():
+        cells += sum([len(dropoffs.data) for dropoffs in pickups.data.values()])
+    return cells
+
+def profileFilename(output_filename):
+    return output_filename + ".prof"
+
+def saveRunStats(args):
+    # Writes the stats of a run next to its output, see instrument
+    stats = instrument.STATS
+    records = stats.counters.get('trips', 0) + stats.counters.get('changes', 0)
+    read_seconds = stats.seconds.get('read', 0)
+    return instrument.saveStats(instrument.statsFilename(args.output_filename),
+        output_filename=args.output_filename,
+        inputs=list(args.input_trips) + list(args.changes_filename or []),
+        records_per_second=records / read_seconds if read_seconds else 0,
+        peak_memory_mb=peakMemoryMB())
+
+def privacyLevel(value):
+    # argparse type for privacy levels, which must be at least 1 for
+    # suppression to be meaningful
+    level = int(value)
+    if level < 1:
+        raise argparse.ArgumentTypeError("privacy level must be at least 1, got {}".format(value))
+    return level
 
 def getParser():
     parser = argparse.ArgumentParser(
         description='Aggregate MDS trip data into a Metrics protocol buffer')
     parser.add_argument(
         'input_trips',
-        help='Input trips filname. Must end with .json or .pbf'
+        nargs='*',
+        help='Input trips filnames. Must end with .json or .pbf. JSON may be '
+             'gzip or zstd compressed (.json.gz, .json.zst) or read from '
+             'stdin with -. Only a single PBF file may be given.'
     )
     parser.add_argument(
         '-cf', '--changes_filename',
-        help='Input file with vehicle changes. Must end with .json')
+        action='append',
+        help='Input file with vehicle changes. Must end with .json, '
+             '.json.gz or .json.zst. May be given more than once.')
     parser.add_argument(
         '-per', '--period',
         default=3600,
@@ -266,7 +1345,8 @@ def getParser():
         type=int,
         help='The number of periods in a cycle. If provided, periods '
              'will be aggregated on a cycle, e.g. the same hour of a day will '
-             'be tallied.'
+             'be tallied. 0 counts periods from the epoch instead, for an '
+             'absolute time series.'
     )
     parser.add_argument(
         '-o', '--output_filename',
@@ -288,30 +1368,379 @@ def getParser():
         help='Decimal digits of GPS accuracy used for zones')
     parser.add_argument(
         '-p', '--privacy',
-        default=5,
+        default=[5],
+        nargs='+',
+        type=privacyLevel,
+        help='k-anonymity or l-diversity for suppressed output. Several '
+             'levels may be given to write a suppressed file for each.')
+    parser.add_argument(
+        '-j', '--jobs',
+        default=1,
         type=int,
-        help='k-anonymity or l-diversity for suppressed output')
+        help='Number of worker processes. Uncompressed JSON inputs are split '
+             'into byte ranges that are aggregated in parallel.')
+    parser.add_argument(
+        '-pk', '--packed',
+        action='store_true',
+        default=False,
+        help='Write counts in the packed columnar encoding, which is smaller '
+             'and faster to parse')
+    parser.add_argument(
+        '-inc', '--incremental',
+        help='Existing PBF aggregate to add the input trips and changes to. '
+             'Its vehicle state sidecar, [pbf].vehicles.json.gz, is required '
+             'if it has availability or on street counts.')
+    parser.add_argument(
+        '-ks', '--keep_state',
+        action='store_true',
+        default=False,
+        help='Write the vehicle state sidecar next to the output so that it '
+             'can be updated later with --incremental')
+    parser.add_argument(
+        '-z', '--zones',
+        default='grid',
+        choices=['grid', 'square', 'hex', 'geojson'],
+        help='Zoning backend. grid rounds coordinates to --accuracy digits, '
+             'square and hex are hierarchical grids at --zone_level and '
+             'geojson uses the polygons in --zone_file.')
+    parser.add_argument(
+        '-zf', '--zone_file',
+        help='GeoJSON file of Polygon or MultiPolygon zones')
+    parser.add_argument(
+        '-zp', '--zone_property',
+        help='Feature property used to name GeoJSON zones. Features are '
+             'numbered in file order by default.')
+    parser.add_argument(
+        '-zl', '--zone_level',
+        default=8,
+        type=int,
+        help='Level of the square or hex grid. Cells are 1 degree at level 0 '
+             'and halve in size at each level.')
+    parser.add_argument(
+        '-av', '--approximate_vehicles',
+        type=int,
+        metavar='PRECISION',
+        help='Estimate availability and on street vehicle counts with '
+             'HyperLogLog sketches of 2**PRECISION registers, from 4 to 16, '
+             'rather than keeping the set of vehicles in every zone')
+    parser.add_argument(
+        '-w', '--window',
+        type=int,
+        metavar='PERIODS',
+        help='Aggregate a sliding window of this many periods, counted from '
+             'the epoch, instead of a cycle. Inputs are merged in time order '
+             'and records older than the window are skipped. The output is the '
+             'latest window.')
+    parser.add_argument(
+        '-ws', '--window_step',
+        default=1,
+        type=int,
+        metavar='PERIODS',
+        help='Write the window every this many periods as it slides, to '
+             '[window_prefix]-[first period].pbf')
+    parser.add_argument(
+        '-wp', '--window_prefix',
+        help='Output filename prefix for the windows written as the window '
+             'slides. Only the latest window is written if not given.')
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        help='Also time JSON decoding and zone lookups, log cProfile and '
+             'tracemalloc summaries and save the cProfile stats to '
+             '[output].prof. Stage times and counters are always written to '
+             '[output].stats.json.')
+    parser.add_argument(
+        '-jd', '--json_decoder',
+        default='auto',
+        choices=decoders.DECODERS,
+        help='JSON library used to decode input. auto uses orjson if it is '
+             'installed and the json module otherwise.')
+    parser.add_argument(
+        '-ve', '--validate_every',
+        default=0,
+        type=int,
+        metavar='N',
+        help='Validate every Nth input record against the schema of the MDS '
+             'fields that are aggregated, skipping invalid records. 1 '
+             'validates every record and 0, the default, none.')
+    parser.add_argument(
+        '-cd', '--cache_dir',
+        help='Directory caching the partial aggregate of each input file, '
+             'keyed by its content and the period, cycle length, accuracy and '
+             'zones, so that unchanged inputs are not read again. See '
+             'partials.py to inspect or prune it.')
+    parser.add_argument(
+        '-cs', '--cache_size',
+        default=partials.DEFAULT_MAX_MB,
+        type=float,
+        metavar='MB',
+        help='Size of the cache beyond which the least recently used partial '
+             'aggregates are evicted')
+    parser.add_argument(
+        '-cfg', '--configs',
+        nargs='+',
+        metavar='PERIOD:CYCLE_LENGTH:ACCURACY',
+        help='Aggregate the input once into each of these configurations, '
+             'e.g. :24: :168:, where an empty field is taken from --period, '
+             '--cycle_length or --accuracy. Each writes '
+             '[output]-[period]-[cycle_length]-[accuracy].pbf and suppressed '
+             'files with [prefix]-[period]-[cycle_length]-[accuracy] as their '
+             'prefix.')
+    parser.add_argument(
+        '-zd', '--zone_dictionary',
+        help='JSON file of the geo_ids of zones, which is read at startup and '
+             'extended with new zones, so that a zone has the same geo_id in '
+             'every output. Outputs only list the zones they count. Created '
+             'if it does not exist.')
+    return parser
+
+def getZoning(args, accuracy=None):
+    # Returns a function creating the zoning backend selected by args, with
+    # the given accuracy rather than args.accuracy for grid zones
+    if args.zones == 'square':
+        return functools.partial(zones.SquareGridZones, args.zone_level)
+    if args.zones == 'hex':
+        return functools.partial(zones.HexGridZones, args.zone_level)
+    if args.zones == 'geojson':
+        index = zones.loadPolygonIndex(args.zone_file, args.zone_property)
+        return functools.partial(zones.PolygonZones, index)
+    return functools.partial(zones.GridZones,
+        args.accuracy if accuracy is None else accuracy)
+
+def getVehicleSets(args):
+    # Returns a function creating the distinct vehicle counters selected by args
+    if args.approximate_vehicles is None:
+        return vehicles.VehicleSets
+    return functools.partial(vehicles.ApproximateVehicleSets,
+        precision=args.approximate_vehicles)
+
+def getSuppressParser():
+    parser = argparse.ArgumentParser(
+        description='Write suppressed flows of an existing Metrics PBF file')
+    parser.add_argument(
+        'input_filename',
+        help='Input PBF filename, in either encoding')
+    parser.add_argument(
+        '-sp', '--suppress_prefix',
+        default="suppress",
+        help='Output filename prefix for suppressed flows. [prefix]-[k].pbf')
+    parser.add_argument(
+        '-p', '--privacy',
+        default=[5],
+        nargs='+',
+        type=privacyLevel,
+        help='k-anonymity or l-diversity for suppressed output. Several '
+             'levels may be given to write a suppressed file for each.')
+    parser.add_argument(
+        '-pk', '--packed',
+        action='store_true',
+        default=False,
+        help='Write counts in the packed columnar encoding')
     return parser
 
-def main():
+def outputSuppressedFiles(metrics, privacy_levels, suppress_prefix, pack=False):
+    # Writes [prefix]-[k].pbf for each privacy level k
+    peeled_flows = peelAllFlows(metrics, privacy_levels)
+    for privacy_level in privacy_levels:
+        suppressed_filename = "{}-{}.pbf".format(suppress_prefix, privacy_level)
+        if pack:
+            outputFile(packed.packMetrics(suppress(metrics, privacy_level, peeled_flows)),
+                suppressed_filename)
+        else:
+            outputSuppressedFile(metrics, privacy_level, suppressed_filename, peeled_flows)
+
+def suppressMain(argv=None):
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    args = getSuppressParser().parse_args(argv)
+    logging.debug("Reading {}".format(args.input_filename))
+    metrics = metricsFromPBF(args.input_filename)
+    outputSuppressedFiles(metrics, args.privacy, args.suppress_prefix, args.packed)
+
+def main(argv=None):
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
     parser = getParser()
-    args = parser.parse_args()
-
-    if args.input_trips.endswith('pbf'):
-        parsingFunction = metricsFromPBF
-    elif args.input_trips.endswith('json'):
-        parsingFunction = metricsFromJSON
-
-    logging.debug("Reading {}".format(args.input_trips))
-    metrics = parsingFunction(args.input_trips, args.period, args.cycle_length, args.accuracy)
-    if args.changes_filename:
-        metrics = parseChanges(metrics, args.changes_filename, args.period, args.cycle_length, args.accuracy)
-    outputFile(metrics, args.output_filename)
+    args = parser.parse_args(argv)
+    if args.zones == 'geojson' and not args.zone_file:
+        parser.error("--zones geojson requires --zone_file")
+    zoning = getZoning(args)
+    if args.approximate_vehicles is not None:
+        if not 4 <= args.approximate_vehicles <= 16:
+            parser.error("--approximate_vehicles must be between 4 and 16")
+        if args.incremental or args.keep_state or args.cache_dir:
+            parser.error("--approximate_vehicles cannot be used with --incremental, --keep_state or --cache_dir")
+    vehicle_sets = getVehicleSets(args)
+    if args.validate_every < 0:
+        parser.error("--validate_every must not be negative")
+    decoding = functools.partial(decoders.RecordDecoder, decoder=args.json_decoder,
+        validate_every=args.validate_every)
+
+    instrument.reset(detailed=args.profile)
+    with contextlib.ExitStack() as stack:
+        if args.profile:
+            stack.enter_context(instrument.profile(profileFilename(args.output_filename)))
+        if args.configs:
+            ingestConfigs(parser, args, vehicle_sets, decoding)
+        else:
+            ingest(parser, args, zoning, vehicle_sets, decoding)
+    saveRunStats(args)
+    logging.debug("Peak memory {:.1f} MB".format(peakMemoryMB()))
+
+def ingest(parser, args, zoning, vehicle_sets, decoding):
+    # Aggregates the inputs given by args and writes the outputs
+    changes_filenames = args.changes_filename or []
+    if not args.input_trips and not (args.incremental and changes_filenames):
+        parser.error("No input trips given")
+    if any(filename.endswith('pbf') for filename in args.input_trips):
+        if len(args.input_trips) > 1 or args.incremental or args.keep_state:
+            parser.error("Only a single PBF input may be given, without --incremental or --keep_state")
+        logging.debug("Reading {}".format(args.input_trips[0]))
+        metrics = metricsFromPBF(args.input_trips[0])
+        trips_filenames = []
+    else:
+        for filename in args.input_trips:
+            if not isJSONInput(filename):
+                parser.error("Unrecognized input format: {}".format(filename))
+        metrics = None
+        trips_filenames = args.input_trips
+
+    if args.window is not None:
+        if args.window < 1 or args.window_step < 1:
+            parser.error("--window and --window_step must be at least 1")
+        if (metrics is not None or args.incremental or args.keep_state or args.cache_dir
+                or args.zone_dictionary):
+            parser.error("--window cannot be used with a PBF input, --incremental, --keep_state, "
+                "--cache_dir or --zone_dictionary")
+
+    dictionary = None
+    if args.zone_dictionary:
+        try:
+            dictionary = zones.loadZoneDictionary(args.zone_dictionary)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error("Cannot read the zone dictionary: {}".format(e))
+        logging.debug("Loaded {} zones from {}".format(len(dictionary), args.zone_dictionary))
+
+    cache = None
+    if args.cache_dir:
+        cache = partials.PartialCache(args.cache_dir, int(args.cache_size * (1 << 20)))
+        settings = cacheSettings(args)
+    accumulator = None
+    base_zones = len(metrics.geo_ids) if metrics else 0
+    with instrument.stage('read'):
+        if args.window is not None:
+            emit = None
+            if args.window_prefix:
+                emit = lambda window: outputFile(packed.packMetrics(window) if args.packed else window,
+                    windowFilename(args.window_prefix, window))
+            metrics = metricsFromWindow(trips_filenames, changes_filenames, args.period,
+                args.window, args.accuracy, zoning, vehicle_sets, decoding, args.window_step, emit)
+        elif args.incremental:
+            logging.debug("Adding to {}".format(args.incremental))
+            state_filename = vehicleStateFilename(args.incremental)
+            vehicle_state = loadVehicleState(state_filename) if os.path.exists(state_filename) else None
+            accumulator = accumulatorFromMetrics(
+                metricsFromPBF(args.incremental), args.accuracy, vehicle_state, zoning)
+            base_zones = len(accumulator.geo_ids)
+            if dictionary is not None:
+                addZoneDictionary(accumulator, dictionary)
+            if cache:
+                aggregateCached(accumulator, trips_filenames, changes_filenames, args.jobs,
+                    cache, settings, zoning=zoning, decoding=decoding)
+            else:
+                aggregateShards(accumulator, trips_filenames, changes_filenames, args.jobs,
+                    zoning=zoning, decoding=decoding)
+            metrics = accumulator.toMetrics()
+        elif (args.keep_state or args.jobs > 1 or len(trips_filenames) > 1
+                or len(changes_filenames) > 1 or cache or dictionary is not None):
+            accumulator = getAccumulator(metrics, args.period, args.cycle_length, args.accuracy,
+                zoning, vehicle_sets)
+            if dictionary is not None:
+                addZoneDictionary(accumulator, dictionary)
+            if cache:
+                aggregateCached(accumulator, trips_filenames, changes_filenames, args.jobs,
+                    cache, settings, zoning=zoning, vehicle_sets=vehicle_sets, decoding=decoding)
+            else:
+                aggregateShards(accumulator, trips_filenames, changes_filenames, args.jobs,
+                    zoning=zoning, vehicle_sets=vehicle_sets, decoding=decoding)
+            metrics = accumulator.toMetrics(metrics)
+        else:
+            if trips_filenames:
+                logging.debug("Reading {}".format(trips_filenames[0]))
+                metrics = metricsFromJSON(trips_filenames[0], args.period, args.cycle_length,
+                    args.accuracy, zoning, decoding)
+            if changes_filenames:
+                metrics = parseChanges(metrics, changes_filenames[0], args.period, args.cycle_length,
+                    args.accuracy, zoning, vehicle_sets, decoding)
+    if dictionary is not None:
+        logging.debug("Saving {} zones to {}".format(len(accumulator.geo_ids), args.zone_dictionary))
+        zones.saveZoneDictionary(args.zone_dictionary, accumulator.geo_ids)
+        pruneZones(metrics)
+    # The output may replace the aggregate being added to, so it is written
+    # along with its vehicle state under temporary names and then renamed
+    writers = {}
+    if accumulator and (args.incremental or args.keep_state):
+        writers[vehicleStateFilename(args.output_filename)] = functools.partial(
+            saveVehicleState, accumulator)
+    writers[args.output_filename] = functools.partial(outputFile,
+        packed.packMetrics(metrics) if args.packed else metrics)
+    writeAtomically(writers)
     if args.suppress:
-        suppressed = suppress(metrics, args.privacy)
-        suppressed_filename = "{}-{}.pbf".format(args.suppress_prefix, args.privacy)
-        outputFile(suppressed, suppressed_filename)
+        outputSuppressedFiles(metrics, args.privacy, args.suppress_prefix, args.packed)
+    instrument.count('zones', len(metrics.geo_ids))
+    instrument.count('new_zones', len(metrics.geo_ids) - base_zones)
+    instrument.count('map_cells', mapCells(metrics))
+    return metrics
+
+def getConfigs(parser, args):
+    # Parses --configs into (period, cycle_length, gpsaccuracy) tuples
+    defaults = (args.period, args.cycle_length, args.accuracy)
+    configs = []
+    for spec in args.configs:
+        fields = spec.split(':')
+        try:
+            if len(fields) != 3:
+                raise ValueError(spec)
+            config = tuple(int(field) if field else default
+                for field, default in zip(fields, defaults))
+        except ValueError:
+            parser.error("--configs must be PERIOD:CYCLE_LENGTH:ACCURACY, not {}".format(spec))
+        if config in configs:
+            parser.error("Duplicate configuration {}".format(spec))
+        configs.append(config)
+    return configs
+
+def configFilename(filename, config):
+    # Inserts -[period]-[cycle_length]-[accuracy] before the extension
+    (root, extension) = os.path.splitext(filename)
+    return "{}-{}-{}-{}{}".format(root, *config, extension)
+
+def ingestConfigs(parser, args, vehicle_sets, decoding):
+    # Aggregates the inputs given by args once into each of --configs and
+    # writes the outputs of each
+    changes_filenames = args.changes_filename or []
+    if not args.input_trips:
+        parser.error("No input trips given")
+    for filename in args.input_trips + changes_filenames:
+        if not isJSONInput(filename):
+            parser.error("--configs requires JSON inputs, not {}".format(filename))
+    if (args.incremental or args.keep_state or args.window is not None or args.cache_dir
+            or args.jobs > 1 or args.zone_dictionary):
+        parser.error("--configs cannot be used with --incremental, --keep_state, --window, "
+            "--cache_dir, --jobs or --zone_dictionary")
+    configs = getConfigs(parser, args)
+    with instrument.stage('read'):
+        all_metrics = metricsFromConfigs(args.input_trips, changes_filenames, configs,
+            dict([(accuracy, getZoning(args, accuracy)) for (_, _, accuracy) in configs]),
+            vehicle_sets, decoding)
+    for config, metrics in zip(configs, all_metrics):
+        outputFile(packed.packMetrics(metrics) if args.packed else metrics,
+            configFilename(args.output_filename, config))
+        if args.suppress:
+            outputSuppressedFiles(metrics, args.privacy,
+                "{}-{}-{}-{}".format(args.suppress_prefix, *config), args.packed)
+        instrument.count('zones', len(metrics.geo_ids))
+        instrument.count('map_cells', mapCells(metrics))
+    return all_metrics
 
 if __name__ == "__main__":
     sys.exit(main())
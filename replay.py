@@ -0,0 +1,116 @@
+import ammsd
+import argparse
+import asyncio
+import json
+import readtrips
+import sys
+import time
+
+# Replays line-delimited MDS trips and vehicle changes, e.g. from sampledata/,
+# to the aggregation service in ammsd.py, optionally at a fixed rate, and then
+# prints the responses to any commands.
+
+# Records sent between waits for the socket buffer to drain
+DRAIN_EVERY = 1000
+
+async def sendCommand(reader, writer, request):
+    writer.write(json.dumps(request).encode() + b'\n')
+    await writer.drain()
+    return json.loads(await reader.readline())
+
+async def replay(filenames, commands=(), unix_socket=None, host=ammsd.HOST, port=0, rate=None):
+    # Sends the lines of each file in turn, at most rate lines per second if
+    # it is given, then each command. Returns the number of lines sent and
+    # the responses to the commands.
+    (reader, writer) = await ammsd.connect(unix_socket, host, port)
+    sent = 0
+    start = time.monotonic()
+    try:
+        for filename in filenames:
+            with readtrips.openInput(filename) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    writer.write(line.rstrip('\n').encode() + b'\n')
+                    sent += 1
+                    if rate:
+                        delay = start + sent / rate - time.monotonic()
+                        if delay > 0:
+                            await writer.drain()
+                            await asyncio.sleep(delay)
+                    if sent % DRAIN_EVERY == 0:
+                        await writer.drain()
+        await writer.drain()
+        responses = [await sendCommand(reader, writer, request) for request in commands]
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    return sent, responses
+
+def getCommands(args):
+    commands = []
+    if args.totals:
+        commands.append({'command': 'totals'})
+    for privacy_level in args.snapshot or []:
+        request = {'command': 'snapshot', 'privacy_level': privacy_level}
+        if args.snapshot_prefix:
+            request['output_filename'] = "{}-{}.pbf".format(args.snapshot_prefix, privacy_level)
+        commands.append(request)
+    if args.checkpoint:
+        commands.append({'command': 'checkpoint'})
+    if args.shutdown:
+        commands.append({'command': 'shutdown'})
+    return commands
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        description='Replay MDS trips and vehicle changes to the aggregation service')
+    parser.add_argument(
+        'input_filenames',
+        nargs='*',
+        help='Line-delimited JSON trips or changes files, sent in order. May '
+             'be gzip or zstd compressed or read from stdin with -.')
+    ammsd.addAddressArguments(parser)
+    parser.add_argument(
+        '-r', '--rate',
+        type=float,
+        help='Records per second. As fast as possible by default.')
+    parser.add_argument(
+        '-t', '--totals',
+        action='store_true',
+        default=False,
+        help='Print the totals of the service after replaying')
+    parser.add_argument(
+        '-s', '--snapshot',
+        nargs='+',
+        type=int,
+        metavar='PRIVACY_LEVEL',
+        help='Request a snapshot suppressed at each privacy level, 0 for none')
+    parser.add_argument(
+        '-sp', '--snapshot_prefix',
+        help='Have snapshots written to [prefix]-[k].pbf in the --snapshot_dir of '
+             'the service rather than printed')
+    parser.add_argument(
+        '-cp', '--checkpoint',
+        action='store_true',
+        default=False,
+        help='Ask the service to checkpoint after replaying')
+    parser.add_argument(
+        '--shutdown',
+        action='store_true',
+        default=False,
+        help='Stop the service after replaying')
+    return parser
+
+def main(argv=None):
+    args = getParser().parse_args(argv)
+    start = time.monotonic()
+    (sent, responses) = asyncio.run(replay(args.input_filenames, getCommands(args),
+        args.unix_socket, args.host, args.port, args.rate))
+    elapsed = time.monotonic() - start
+    print("Sent {} records in {:.2f}s".format(sent, elapsed), file=sys.stderr)
+    for response in responses:
+        print(json.dumps(response))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+import argparse
+import logging
+import os
+import packed
+import readtrips
+import sys
+import zones
+
+# Derives a coarser aggregate from an existing Metrics PBF file without
+# reading the MDS data again: periods are folded onto a longer period or a
+# shorter cycle, and zones are merged into coarser grid cells, summing the
+# trip counts, flows and totals. Rolling up repeatedly builds a
+# multi-resolution pyramid. on_street and availability are counts of distinct
+# vehicles, which cannot be summed, so they are rebuilt from the vehicle state
+# sidecar written with readtrips --keep_state, or dropped if asked to.
+
+# Decimal places of the names of square and hex grid zones, see zones.py
+GRID_NAME_ACCURACY = 6
+
+def periodMapping(period_seconds, cycle_length, new_period_seconds, new_cycle_length):
+    # Returns a function mapping the periods of an aggregate onto periods of
+    # new_period_seconds folded on new_cycle_length. Every record must land
+    # in the same period as if it had been aggregated with the new settings,
+    # so the new period must be a multiple of the old one, and a cycle can
+    # only be shortened to a length that divides it.
+    if new_period_seconds % period_seconds:
+        raise ValueError("The period must be a multiple of {} seconds".format(period_seconds))
+    factor = new_period_seconds // period_seconds
+    if cycle_length:
+        if cycle_length % factor:
+            raise ValueError("A cycle of {} periods is not a whole number of {} second "
+                "periods".format(cycle_length, new_period_seconds))
+        if not new_cycle_length or (cycle_length // factor) % new_cycle_length:
+            raise ValueError("The cycle length must divide {}".format(cycle_length // factor))
+    if new_cycle_length:
+        return lambda period: period // factor % new_cycle_length
+    return lambda period: period // factor
+
+def nameCoordinates(name):
+    # The coordinates of a grid zone name in the order they are written, the
+    # GeoJSON order of (long, lat) that zoning backends take, see zoneName
+    try:
+        (long, lat) = name.split(':')
+        return float(long), float(lat)
+    except ValueError:
+        raise ValueError("{} is not a grid zone".format(name))
+
+def gridZoneNames(names, accuracy):
+    # Maps rounded grid zone names onto the cells at a lower accuracy.
+    # Rounded cells do not nest: a cell whose name falls exactly half way
+    # between two coarser cells holds points of both, and goes to whichever
+    # its name rounds to. Returns the mapping and the number of such cells.
+    mapping = {}
+    straddling = 0
+    for name in names:
+        source_accuracy = zones.nameAccuracy(name)
+        if source_accuracy is None or source_accuracy <= accuracy:
+            raise ValueError("Zone {} is not finer than an accuracy of {}".format(name, accuracy))
+        mapping[name] = zones.zoneName(*nameCoordinates(name), accuracy)
+        digits = [part.split('.')[-1][accuracy:] for part in name.split(':')]
+        if any(digit.rstrip('0') == '5' for digit in digits):
+            straddling += 1
+    return mapping, straddling
+
+def hierarchicalZoneNames(names, grid, source_level, level):
+    # Maps square or hex grid zone names at source_level onto the cells
+    # containing them at a coarser level. Squares nest exactly, while a hex
+    # goes to the coarser hex containing its center, as in
+    # HexGridZones.parentCell.
+    if level >= source_level:
+        raise ValueError("Zone level {} is not coarser than {}".format(level, source_level))
+    grids = [grid(each, {}, {}) for each in range(source_level, level - 1, -1)]
+    mapping = {}
+    for name in names:
+        cell = grids[0].cellAt(*nameCoordinates(name))
+        for finer in grids[:-1]:
+            cell = finer.parentCell(cell)
+        mapping[name] = zones.zoneName(*grids[-1].cellCenter(cell),
+            gpsaccuracy=GRID_NAME_ACCURACY)
+    return mapping
+
+def rollUp(metrics, map_period, zone_names, period_seconds, cycle_length, vehicle_state=None):
+    # Returns a MetricsAccumulator holding metrics with its periods mapped by
+    # map_period and its zones renamed by zone_names, which keeps zones that
+    # it does not have. Distinct vehicle counts are rebuilt from
+    # vehicle_state, if it is given.
+    if metrics.privacy_level:
+        raise ValueError("Cannot roll up a suppressed aggregate")
+    # Zones are named by zone_names rather than looked up, so there is no
+    # zoning backend
+    accumulator = readtrips.MetricsAccumulator(period_seconds, cycle_length, None,
+        zoning=lambda geo_ids, inverse_geo_ids: None)
+    # Zones that are not renamed keep their coordinates, such as the
+    # centroids of polygon zones
+    centers = zones.zoneCenters(metrics)
+    named_centers = dict([(name, centers[geo_id]) for geo_id, name in metrics.geo_ids.items()])
+    accumulator.zone_center = lambda name: named_centers.get(name) or zones.zoneCenter(name)
+    accumulator.earliest_time = metrics.start_time
+    accumulator.latest_time = metrics.end_time
+    remap = {}
+    for geo_id, name in metrics.geo_ids.items():
+        remap[geo_id] = zones.addZone(accumulator.geo_ids, accumulator.inverse_geo_ids,
+            zone_names.get(name, name))
+    for period, total in metrics.total_trips.items():
+        period = map_period(period)
+        accumulator.total_trips[period] = accumulator.total_trips.get(period, 0) + total
+    for totals, field in (
+            (accumulator.total_duration, metrics.total_duration),
+            (accumulator.total_distance, metrics.total_distance)):
+        for period, total in field.items():
+            period = map_period(period)
+            totals[period] = readtrips.toFloat32(totals.get(period, 0.0) + total)
+    for counts, field in (
+            (accumulator.trip_volumes, metrics.trip_volumes),
+            (accumulator.pickups, metrics.pickups),
+            (accumulator.dropoffs, metrics.dropoffs)):
+        for period in field:
+            new_period = map_period(period)
+            for geo_id, count in field[period].data.items():
+                key = (new_period, remap[geo_id])
+                counts[key] = counts.get(key, 0) + count
+    flows = accumulator.flows
+    for period in metrics.flows:
+        new_period = map_period(period)
+        for pickup, dropoffs in metrics.flows[period].data.items():
+            for dropoff, count in dropoffs.data.items():
+                key = (new_period, remap[pickup], remap[dropoff])
+                flows[key] = flows.get(key, 0) + count
+    if vehicle_state:
+        for vehicle_sets, field in (
+                (accumulator.availability, 'availability'),
+                (accumulator.on_street, 'on_street')):
+            for (period, geo_id), vehicle_ids in vehicle_state[field].items():
+                vehicle_sets.addAll((map_period(period), remap[geo_id]), sorted(vehicle_ids))
+    return accumulator
+
+def getZoneNames(parser, args, metrics):
+    # Returns the mapping of zone names selected by args
+    names = list(metrics.geo_ids.values())
+    if args.zones == 'grid':
+        if args.accuracy is None:
+            return {}
+        (zone_names, straddling) = gridZoneNames(names, args.accuracy)
+        if straddling:
+            logging.warning("{} of {} zones lie half way between cells at an accuracy of {} "
+                "and were assigned by rounding their names".format(
+                    straddling, len(names), args.accuracy))
+        return zone_names
+    if args.zone_level is None:
+        return {}
+    if args.source_level is None:
+        parser.error("--zone_level requires --source_level")
+    if args.zones == 'hex':
+        logging.warning("Hexes do not nest, so each zone is rolled up into the coarser hex "
+            "containing its center")
+    grid = zones.SquareGridZones if args.zones == 'square' else zones.HexGridZones
+    return hierarchicalZoneNames(names, grid, args.source_level, args.zone_level)
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        description='Roll up a Metrics PBF file into coarser periods or zones')
+    parser.add_argument(
+        'input_filename',
+        help='Input PBF filename, in either encoding')
+    parser.add_argument(
+        '-o', '--output_filename',
+        default="rollup.pbf",
+        help='Output filename')
+    parser.add_argument(
+        '-per', '--period',
+        type=int,
+        help='Time period in seconds, a multiple of the input period. The '
+             'input period by default.')
+    parser.add_argument(
+        '-c', '--cycle_length',
+        type=int,
+        help='The number of periods in a cycle, which must divide the input '
+             'cycle in the new periods, e.g. 24 for an input of 168 hours. A '
+             'cycle may be given for an input with a cycle length of 0. The '
+             'input cycle, in the new periods, by default.')
+    parser.add_argument(
+        '-z', '--zones',
+        default='grid',
+        choices=['grid', 'square', 'hex'],
+        help='Zoning backend of the input. Rounded grid cells do not nest, so '
+             'cells on the boundary of a coarser cell go to the one their name '
+             'rounds to, and hexes go to the coarser hex containing their '
+             'center.')
+    parser.add_argument(
+        '-a', '--accuracy',
+        type=int,
+        help='Decimal digits of the coarser grid zones')
+    parser.add_argument(
+        '-zl', '--zone_level',
+        type=int,
+        help='Level of the coarser square or hex zones')
+    parser.add_argument(
+        '-sl', '--source_level',
+        type=int,
+        help='Level of the square or hex zones of the input')
+    parser.add_argument(
+        '-vs', '--vehicle_state',
+        help='Vehicle state sidecar of the input, used to roll up on street '
+             'and availability counts. [input].vehicles.json.gz by default, '
+             'if it exists.')
+    parser.add_argument(
+        '-dv', '--drop_vehicle_counts',
+        action='store_true',
+        default=False,
+        help='Drop on street and availability counts, which cannot be summed, '
+             'if there is no vehicle state')
+    parser.add_argument(
+        '-ks', '--keep_state',
+        action='store_true',
+        default=False,
+        help='Write the vehicle state sidecar of the output')
+    parser.add_argument(
+        '-sp', '--suppress_prefix',
+        help='Also write suppressed files, [prefix]-[k].pbf')
+    parser.add_argument(
+        '-p', '--privacy',
+        default=[5],
+        nargs='+',
+        type=readtrips.privacyLevel,
+        help='k-anonymity or l-diversity for suppressed output')
+    parser.add_argument(
+        '-pk', '--packed',
+        action='store_true',
+        default=False,
+        help='Write counts in the packed columnar encoding')
+    return parser
+
+def main(argv=None):
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    parser = getParser()
+    args = parser.parse_args(argv)
+    metrics = packed.loadMetrics(args.input_filename)
+    period_seconds = args.period or metrics.period_seconds
+    factor = max(period_seconds // metrics.period_seconds, 1)
+    cycle_length = args.cycle_length
+    if cycle_length is None:
+        cycle_length = metrics.cycle_length // factor
+    try:
+        map_period = periodMapping(metrics.period_seconds, metrics.cycle_length,
+            period_seconds, cycle_length)
+        zone_names = getZoneNames(parser, args, metrics)
+    except ValueError as e:
+        parser.error(str(e))
+
+    state_filename = args.vehicle_state or readtrips.vehicleStateFilename(args.input_filename)
+    vehicle_state = None
+    if os.path.exists(state_filename):
+        vehicle_state = readtrips.loadVehicleState(state_filename)
+        if (vehicle_state['period_seconds'], vehicle_state['cycle_length']) != (
+                metrics.period_seconds, metrics.cycle_length):
+            parser.error("Vehicle state does not match the period and cycle length of the input")
+    elif args.vehicle_state:
+        parser.error("No vehicle state at {}".format(args.vehicle_state))
+    if vehicle_state is None and (metrics.on_street or metrics.availability):
+        if not args.drop_vehicle_counts:
+            parser.error("On street and availability are counts of distinct vehicles and "
+                "cannot be summed. Roll them up with the vehicle state written by readtrips "
+                "--keep_state, or drop them with --drop_vehicle_counts.")
+        logging.warning("Dropping on street and availability counts")
+    if args.keep_state and vehicle_state is None:
+        parser.error("--keep_state requires the vehicle state of the input")
+
+    logging.debug("Rolling up {} periods of {}s and {} zones".format(
+        metrics.cycle_length, metrics.period_seconds, len(metrics.geo_ids)))
+    try:
+        accumulator = rollUp(metrics, map_period, zone_names, period_seconds, cycle_length,
+            vehicle_state)
+    except ValueError as e:
+        parser.error(str(e))
+    output = accumulator.toMetrics()
+    logging.debug("Rolled up into {} periods of {}s and {} zones".format(
+        cycle_length, period_seconds, len(output.geo_ids)))
+    if args.keep_state:
+        readtrips.saveVehicleState(accumulator, readtrips.vehicleStateFilename(args.output_filename))
+    readtrips.outputFile(packed.packMetrics(output) if args.packed else output,
+        args.output_filename)
+    if args.suppress_prefix:
+        readtrips.outputSuppressedFiles(output, args.privacy, args.suppress_prefix, args.packed)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+import argparse
+import contextlib
+import datetime as dt
+import demostats
+import io
+import json
+import logging
+import os
+import pbftocsv
+import platform
+import readtrips
+import sys
+import tempfile
+import time
+import tracemalloc
+from google.protobuf.internal import api_implementation
+from tests import synthetic_mds
+
+# Times the main stages of the pipeline on synthetic MDS data and writes the
+# results as JSON so that regressions can be tracked over time.
+# Run from the repository root: python -m tests.benchmark
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a list of values
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def measure(function, repeat):
+    # Runs function repeat times and then once more under tracemalloc to find
+    # the peak memory it allocates.
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return latencies, peak
+
+def getScenarios(trips_filename, changes_filename, config):
+    period, cycle_length, accuracy, privacy = (
+        config['period'], config['cycle_length'], config['accuracy'], config['privacy'])
+    metrics = readtrips.metricsFromJSON(trips_filename, period, cycle_length, accuracy)
+    metrics = readtrips.parseChanges(metrics, changes_filename, period, cycle_length, accuracy)
+    route_points = sum([sum(volumes.data.values()) for volumes in metrics.trip_volumes.values()])
+    cells = sum([len(volumes.data) for volumes in metrics.trip_volumes.values()])
+
+    def exportCSV():
+        output = io.StringIO()
+        pbftocsv.outputVolumes(metrics, output)
+        pbftocsv.outputFlows(metrics, output)
+
+    def reportStats():
+        with contextlib.redirect_stdout(io.StringIO()):
+            demostats.printSparkLines(metrics)
+            demostats.printTopTripVolumes(metrics)
+            demostats.printPrivacySuppressionStats(metrics, [1, 2, 3, 4, 5])
+
+    # Each scenario is a function to time and the number of records it handles
+    return [
+        ("metricsFromJSON",
+            lambda: readtrips.metricsFromJSON(trips_filename, period, cycle_length, accuracy),
+            config['trips']),
+        ("parseChanges",
+            lambda: readtrips.parseChanges(None, changes_filename, period, cycle_length, accuracy),
+            config['changes']),
+        ("suppress", lambda: readtrips.suppress(metrics, privacy), cells),
+        ("pbftocsv", exportCSV, cells),
+        ("demostats", reportStats, route_points),
+    ]
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark readtrips, pbftocsv and demostats on synthetic MDS data')
+    parser.add_argument('-o', '--output_filename', default='benchmark.json',
+        help='Output JSON filename')
+    parser.add_argument('-n', '--trips', default=5000, type=int, help='Number of trips')
+    parser.add_argument('-nc', '--changes', default=20000, type=int, help='Number of vehicle changes')
+    parser.add_argument('-r', '--route_length', default=20, type=int, help='Points per route')
+    parser.add_argument('-z', '--zones', default=2000, type=int, help='Number of zones')
+    parser.add_argument('-k', '--skew', default=1.0, type=float,
+        help='Zipf exponent of zone popularity. 0 is uniform.')
+    parser.add_argument('-v', '--vehicles', default=1000, type=int, help='Fleet size')
+    parser.add_argument('-s', '--seed', default=0, type=int, help='Random seed')
+    parser.add_argument('-c', '--cycle_length', default=168, type=int)
+    parser.add_argument('-per', '--period', default=3600, type=int)
+    parser.add_argument('-a', '--accuracy', default=3, type=int)
+    parser.add_argument('-p', '--privacy', default=5, type=int)
+    parser.add_argument('--repeat', default=5, type=int, help='Timed runs per scenario')
+    parser.add_argument('--scenarios', nargs='+', help='Only run these scenarios')
+    return parser
+
+def main():
+    args = getParser().parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    config = dict(vars(args))
+    del config['output_filename']
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trips_filename = os.path.join(tmpdir, "trips.json")
+        changes_filename = os.path.join(tmpdir, "changes.json")
+        with open(trips_filename, 'w') as f:
+            synthetic_mds.generateTrips(f, args.trips, args.route_length, args.zones,
+                args.skew, args.vehicles, seed=args.seed)
+        with open(changes_filename, 'w') as f:
+            synthetic_mds.generateChanges(f, args.changes, args.zones, args.skew,
+                args.vehicles, seed=args.seed)
+        for name, function, records in getScenarios(trips_filename, changes_filename, config):
+            if args.scenarios and name not in args.scenarios:
+                continue
+            (latencies, peak) = measure(function, args.repeat)
+            median = percentile(latencies, 0.5)
+            result = {
+                'scenario': name,
+                'records': records,
+                'records_per_second': records / median if median else None,
+                'latency_seconds': {
+                    'min': min(latencies),
+                    'p50': median,
+                    'p90': percentile(latencies, 0.9),
+                    'p99': percentile(latencies, 0.99),
+                    'max': max(latencies),
+                },
+                'peak_memory_bytes': peak,
+            }
+            results.append(result)
+            print("{:<16}{:>10.3f} s{:>14.0f} records/s{:>10.1f} MB".format(
+                name, median, result['records_per_second'] or 0, peak / 1e6))
+    report = {
+        'timestamp': dt.datetime.now(dt.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'protobuf_implementation': api_implementation.Type(),
+        'config': config,
+        'results': results,
+    }
+    with open(args.output_filename, 'w') as f:
+        json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Compares the time of running the amms commands on small sample files with
+# that of running them with the heavy dependencies they used to load eagerly
+# imported up front. Each measurement starts a new interpreter, as cron jobs
+# and serverless functions do, so the times include startup.
+# Run from the repository root: python -m tests.startup_benchmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that were imported when any of the tools started
+EAGER_MODULES = ('numpy', 'pandas', 'jsonschema')
+
+def getCommands(directory):
+    # The arguments of amms.py for a small run of each command, writing any
+    # output to directory. query indexes its input, so the commands read a copy
+    # of the sample metrics in directory.
+    output = lambda name: os.path.join(directory, name)
+    metrics = output('tiny-trips.pbf')
+    shutil.copy(os.path.join(ROOT, 'sampledata', 'tiny-trips.pbf'), metrics)
+    return [
+        ('ingest', ['ingest', 'sampledata/tiny-trips.json', '-cf', 'sampledata/tiny-changes.json',
+            '-o', output('ingest.pbf'), '-sp', output('ingest')]),
+        ('suppress', ['suppress', metrics, '-sp', output('suppress')]),
+        ('stats', ['stats', metrics]),
+        ('csv', ['csv', metrics, output('csv')]),
+        ('json', ['json', metrics, '--output_filename', output('json')]),
+        ('query', ['query', metrics, '-f', 'trip_volumes',
+            '--output_filename', output('query')]),
+    ]
+
+def timeCommand(command, runs):
+    # Median wall time in milliseconds of running command in a new interpreter
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def loadedModules(argv):
+    # The modules of EAGER_MODULES that were loaded by running amms with argv.
+    # Lazily imported modules are in sys.modules as _LazyModule until first
+    # used.
+    script = ("import amms, sys\n"
+        "try:\n    amms.main({!r})\nexcept SystemExit:\n    pass\n"
+        "print(*[m for m in {!r} if m in sys.modules and "
+        "type(sys.modules[m]).__name__ != '_LazyModule'], file=sys.stderr)").format(
+        argv, EAGER_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, check=True,
+        capture_output=True, text=True).stderr
+    return output.splitlines()[-1].split() if output.strip() else []
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the amms commands on small files')
+    parser.add_argument('-r', '--runs', default=11, type=int)
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    python = sys.executable
+    interpreter = timeCommand([python, '-c', 'pass'], args.runs)
+    print("{:<12}{:>12}{:>12}{:>10}  {}".format(
+        "Command", "Lazy ms", "Eager ms", "Speedup", "Heavy modules loaded"))
+    results = {'runs': args.runs, 'interpreter_ms': interpreter, 'commands': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for command, argv in getCommands(directory):
+            elapsed = timeCommand([python, 'amms.py'] + argv, args.runs)
+            # The command as it ran before, with its heavy imports up front
+            baseline = timeCommand([python, '-c', "import {}, amms, sys; sys.exit(amms.main({!r}))".format(
+                ', '.join(EAGER_MODULES), argv)], args.runs)
+            loaded = loadedModules(argv)
+            print("{:<12}{:>12.1f}{:>12.1f}{:>10.2f}  {}".format(
+                command, elapsed, baseline, baseline / elapsed, ' '.join(loaded) or '-'))
+            results['commands'][command] = {'argv': argv, 'lazy_ms': elapsed,
+                'eager_ms': baseline, 'heavy_modules_loaded': loaded}
+    print("Interpreter start {:.1f} ms".format(interpreter))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import argparse
+import json
+import math
+import random
+import sys
+
+# Generates deterministic synthetic MDS trips and vehicle status changes in the
+# line-delimited JSON format read by readtrips, for benchmarks at any scale.
+
+# Zones are laid out on a square grid of cells of this many degrees around the
+# center, which matches the default --accuracy of 3 digits.
+CELL_SIZE = 0.001
+CENTER = (-86.78, 36.16)
+# Seconds between route points
+POINT_INTERVAL = 60
+
+class ZoneSampler:
+    # Picks zones with a Zipf-like distribution, where zone i is chosen with
+    # weight 1 / (i + 1) ** skew. A skew of 0 is uniform. Zones are numbered
+    # outwards from the center, so a high skew concentrates trips downtown.
+    def __init__(self, zones, skew, rng):
+        self.rng = rng
+        side = int(math.ceil(math.sqrt(zones)))
+        cells = [(x, y) for x in range(side) for y in range(side)]
+        cells.sort(key=lambda c: (c[0] - side / 2) ** 2 + (c[1] - side / 2) ** 2)
+        self.cells = [(x - side // 2, y - side // 2) for x, y in cells[:zones]]
+        weights = [1.0 / (i + 1) ** skew for i in range(zones)]
+        total = sum(weights)
+        self.cumulative = []
+        running = 0.0
+        for weight in weights:
+            running += weight / total
+            self.cumulative.append(running)
+
+    def sample(self):
+        i = min(self.bisect(self.rng.random()), len(self.cells) - 1)
+        return self.cells[i]
+
+    def bisect(self, value):
+        lo, hi = 0, len(self.cumulative)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.cumulative[mid] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def point(self, cell):
+        # A uniformly random point within a cell
+        return (CENTER[0] + (cell[0] + self.rng.random()) * CELL_SIZE,
+                CENTER[1] + (cell[1] + self.rng.random()) * CELL_SIZE)
+
+def vehicleId(rng, vehicles):
+    n = rng.randrange(vehicles)
+    return "{}{}{}-{:04d}".format(
+        chr(65 + n % 26), chr(65 + n // 26 % 26), chr(65 + n // 676 % 26), n % 10000)
+
+def generateTrips(output, trips, route_length=20, zones=1000, skew=1.0,
+        vehicles=1000, start_time=0, days=7, seed=0):
+    # Writes trips whose routes move in a straight line from a pickup zone to
+    # a dropoff zone, with route_length points each.
+    rng = random.Random(seed)
+    sampler = ZoneSampler(zones, skew, rng)
+    for _ in range(trips):
+        trip_start = start_time + rng.randrange(days * 86400)
+        (start_long, start_lat) = sampler.point(sampler.sample())
+        (end_long, end_lat) = sampler.point(sampler.sample())
+        features = []
+        distance = 0.0
+        previous = None
+        for i in range(route_length):
+            fraction = i / max(route_length - 1, 1)
+            point = [start_long + (end_long - start_long) * fraction,
+                     start_lat + (end_lat - start_lat) * fraction]
+            if previous:
+                # Roughly 100km per degree at these latitudes
+                distance += 100000 * math.hypot(point[0] - previous[0], point[1] - previous[1])
+            previous = point
+            features.append({
+                "type": "Feature",
+                "properties": {"timestamp": trip_start + i * POINT_INTERVAL},
+                "geometry": {"type": "Point", "coordinates": point}})
+        duration = float(max(route_length - 1, 1) * POINT_INTERVAL)
+        trip = {
+            "vehicle_id": vehicleId(rng, vehicles),
+            "trip_duration": duration,
+            "trip_distance": distance,
+            "start_time": trip_start,
+            "end_time": trip_start + duration,
+            "route": {"type": "FeatureCollection", "features": features}}
+        output.write(json.dumps(trip))
+        output.write("\n")
+
+def generateChanges(output, changes, zones=1000, skew=1.0, vehicles=1000,
+        start_time=0, days=7, seed=0):
+    rng = random.Random(seed + 1)
+    sampler = ZoneSampler(zones, skew, rng)
+    event_types = ["available", "reserved", "unavailable", "removed"]
+    for i in range(changes):
+        event_time = start_time + int(i * days * 86400 / max(changes, 1))
+        (long, lat) = sampler.point(sampler.sample())
+        change = {
+            "vehicle_id": vehicleId(rng, vehicles),
+            "event_time": event_time,
+            "event_type": event_types[0] if rng.random() < 0.6 else rng.choice(event_types[1:]),
+            "event_type_reason": "service_start",
+            "event_location": {
+                "type": "Feature",
+                "properties": {},
+                "geometry": {"type": "Point", "coordinates": [long, lat]}}}
+        output.write(json.dumps(change))
+        output.write("\n")
+
+def getParser():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic MDS trips and vehicle changes')
+    parser.add_argument('trips_filename', help='Output trips filename')
+    parser.add_argument('-cf', '--changes_filename', help='Output changes filename')
+    parser.add_argument('-n', '--trips', default=10000, type=int, help='Number of trips')
+    parser.add_argument('-nc', '--changes', default=10000, type=int, help='Number of vehicle changes')
+    parser.add_argument('-r', '--route_length', default=20, type=int, help='Points per route')
+    parser.add_argument('-z', '--zones', default=1000, type=int, help='Number of zones')
+    parser.add_argument('-k', '--skew', default=1.0, type=float,
+        help='Zipf exponent of zone popularity. 0 is uniform.')
+    parser.add_argument('-v', '--vehicles', default=1000, type=int, help='Fleet size')
+    parser.add_argument('-d', '--days', default=7, type=int, help='Days spanned by the data')
+    parser.add_argument('-s', '--seed', default=0, type=int, help='Random seed')
+    return parser
+
+def main():
+    args = getParser().parse_args()
+    with open(args.trips_filename, 'w') as f:
+        generateTrips(f, args.trips, args.route_length, args.zones, args.skew,
+            args.vehicles, days=args.days, seed=args.seed)
+    if args.changes_filename:
+        with open(args.changes_filename, 'w') as f:
+            generateChanges(f, args.changes, args.zones, args.skew, args.vehicles,
+                days=args.days, seed=args.seed)
+
+if __name__ == "__main__":
+    sys.exit(main())
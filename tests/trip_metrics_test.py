@@ -1,5 +1,35 @@
+from google.protobuf import json_format
+from pb.amms_pb2 import Metrics
+
+import amms
+import ammsd
+import asyncio
+import contextlib
+import decoders
+import demostats
+import functools
+import gzip
+import instrument
+import io
+import json
+import math
+import os
+import packed
+import partials
+import pbfquery
+import pbftojson
+import pbftocsv
+import tempfile
 import unittest
+import random
 import readtrips
+import replay
+import rollup
+import subprocess
+import sys
+import synthetic_mds
+import vehicles
+import zones
 
 class TestPoint:
     def __init__(self, field, indices, value):
@@ -103,6 +133,74 @@ SUPPRESSED_BIG_TEST_VECTOR.extend([
     TestPoint("privacy_level", [], 5)
 ])
 
+# The list-based flow decomposition that decomposeTrips replaced, kept to check
+# that the bucket queue implementation gives identical results.
+def referenceDecompose(degree, source_graph, dest_graph):
+    to_remove = []
+    for source in source_graph:
+        if len(source_graph[source]) <= degree:
+            to_remove.append(source)
+            for dest in source_graph[source]:
+                dest_graph[dest].remove(source)
+    for source in to_remove:
+        del source_graph[source]
+    return len(to_remove)
+
+def referenceDecomposeTrips(pickups, privacy_level):
+    outbound = {}
+    inbound = {}
+    for pickup in pickups:
+        outbound[pickup] = []
+        for dropoff in pickups[pickup].data:
+            outbound[pickup].append(dropoff)
+            if dropoff not in inbound:
+                inbound[dropoff] = []
+            inbound[dropoff].append(pickup)
+    for degree in range(1, privacy_level):
+        out_removed = referenceDecompose(degree, outbound, inbound)
+        in_removed = referenceDecompose(degree, inbound, outbound)
+        if out_removed == 0 and in_removed == 0:
+            break
+    return set([(source, dest) for source in outbound for dest in outbound[source]])
+
+# The map-building aggregation that MetricsAccumulator replaced, which wrote
+# each count straight into the protobuf maps, kept to check that the
+# accumulator serializes to the same bytes.
+def referenceMetricsFromJSON(input_filename, period, cycle_length, gpsaccuracy):
+    metrics = Metrics()
+    metrics.period_seconds = period
+    metrics.cycle_length = cycle_length
+    earliest_time = sys.maxsize
+    latest_time = 0
+    inverse_geo_ids = {}
+    with open(input_filename) as f:
+        for trip in map(json.loads, f.readlines()):
+            timestamp = trip['start_time']
+            earliest_time = min(timestamp, earliest_time)
+            latest_time = max(timestamp, latest_time)
+            start_period = readtrips.getPeriod(timestamp, period, cycle_length)
+            metrics.total_trips[start_period] += 1
+            metrics.total_duration[start_period] += float(trip['trip_duration'])
+            metrics.total_distance[start_period] += float(trip['trip_distance'])
+            pickup = None
+            for route_point in trip['route']['features']:
+                timestamp = route_point['properties']['timestamp']
+                end_period = readtrips.getPeriod(timestamp, period, cycle_length)
+                earliest_time = min(timestamp, earliest_time)
+                latest_time = max(timestamp, latest_time)
+                (lat, long) = map(float, route_point['geometry']['coordinates'])
+                dropoff = readtrips.latLongToZone(metrics.geo_ids, lat, long, gpsaccuracy,
+                    inverse_geo_ids)
+                metrics.trip_volumes[end_period].data[dropoff] += 1
+                if pickup is None:
+                    pickup = dropoff
+            metrics.pickups[start_period].data[pickup] += 1
+            metrics.dropoffs[end_period].data[dropoff] += 1
+            metrics.flows[start_period].data[pickup].data[dropoff] += 1
+    metrics.start_time = earliest_time
+    metrics.end_time = latest_time
+    return metrics
+
 
 class TripMetricsTest(unittest.TestCase):
     def doTestFields(self, metrics, vector):
@@ -124,6 +222,41 @@ class TripMetricsTest(unittest.TestCase):
         )
         self.doTestFields(metrics, TEST_VECTOR_24)
 
+    def test_bad_records(self):
+        with open("sampledata/tiny-trips.json") as f:
+            lines = f.readlines()
+        trip = json.loads(lines[0])
+        del trip['route']
+        bad_lines = ['{"vehicle_id": \n', json.dumps(trip) + '\n', '\n',
+            lines[1].replace('"timestamp":', '"timestamp":"x","t":', 1)]
+        for decoder in ('json', 'orjson'):
+            try:
+                decoders.getLoads(decoder)
+            except ImportError:
+                # orjson is optional
+                continue
+            decoding = functools.partial(decoders.RecordDecoder, decoder=decoder, validate_every=2)
+            expected = readtrips.MetricsAccumulator(3600, 24, 3)
+            self.assertEqual(readtrips.addRecords(expected, 'trips', lines[2:], decoding), 0)
+            accumulator = readtrips.MetricsAccumulator(3600, 24, 3)
+            self.assertEqual(readtrips.addRecords(accumulator, 'trips', bad_lines + lines[2:], decoding), 3)
+            self.assertEqual(accumulator.bad_records, {'trips': 3, 'changes': 0})
+            self.assertEqual(accumulator.toMetrics(), expected.toMetrics())
+
+    def test_readjson_gzip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            gzfilename = os.path.join(tmpdir, "trips.json.gz")
+            with open("sampledata/trips.json", "rb") as f, gzip.open(gzfilename, "wb") as gz:
+                gz.write(f.read())
+            self.assertTrue(readtrips.isJSONInput(gzfilename))
+            metrics = readtrips.metricsFromJSON(
+                input_filename = gzfilename,
+                gpsaccuracy = 3,
+                period = 3600,
+                cycle_length = 24
+            )
+        self.doTestFields(metrics, TEST_VECTOR_24)
+
     def test_readpbf_24_hour_cycle(self):
         metrics = readtrips.metricsFromPBF(
             input_filename = "sampledata/trips-24.pbf",
@@ -138,6 +271,18 @@ class TripMetricsTest(unittest.TestCase):
         )
         self.doTestFields(metrics, TEST_VECTOR_168)
 
+    def test_accumulator_matches_map_building(self):
+        for cycle_length in (24, 168):
+            metrics = readtrips.metricsFromJSON("sampledata/trips.json", 3600, cycle_length, 3)
+            self.assertEqual(metrics.SerializeToString(), referenceMetricsFromJSON(
+                "sampledata/trips.json", 3600, cycle_length, 3).SerializeToString())
+            # The checked-in aggregates have their map entries in the order of
+            # the protobuf runtime that wrote them, so they are compared with
+            # the map keys sorted
+            expected = readtrips.metricsFromPBF("sampledata/trips-{}.pbf".format(cycle_length))
+            self.assertEqual(metrics.SerializeToString(deterministic=True),
+                expected.SerializeToString(deterministic=True))
+
     def test_vehicle_counts(self):
         metrics = readtrips.metricsFromPBF(
             input_filename = "sampledata/tiny-trips.pbf",
@@ -155,6 +300,677 @@ class TripMetricsTest(unittest.TestCase):
         suppressed = readtrips.suppress(metrics, 5)
         self.doTestFields(suppressed, SUPPRESSED_TEST_VECTOR)
 
+    def test_sharded_aggregation(self):
+        metrics = readtrips.metricsFromShards(
+            trips_filenames = ["sampledata/tiny-trips.json"],
+            changes_filenames = ["sampledata/tiny-changes.json"],
+            gpsaccuracy = 3,
+            period = 3600,
+            cycle_length = 24,
+            jobs = 2,
+            min_shard_bytes = 1024
+        )
+        self.doTestFields(metrics, TINY_TEST_VECTOR)
+        # Standard input is read by the parent process rather than a worker
+        with tempfile.TemporaryDirectory() as directory, \
+                open("sampledata/tiny-trips.json") as trips:
+            output = os.path.join(directory, "output.pbf")
+            subprocess.run([sys.executable, "readtrips.py", "-", "-cf",
+                "sampledata/tiny-changes.json", "-j", "2", "-o", output, "-sp", output],
+                stdin=trips, check=True, capture_output=True)
+            with open(output + ".stats.json") as f:
+                counters = json.load(f)['counters']
+        self.assertEqual((counters['trips'], counters['changes']), (7, 51))
+
+    def test_merge_counts_distinct_vehicles(self):
+        # Merging an aggregate with itself doubles counts but not vehicles
+        accumulator = readtrips.MetricsAccumulator(3600, 24, 3)
+        with open("sampledata/tiny-changes.json") as f:
+            for change in decoders.RecordDecoder('changes').decodeAll(f):
+                accumulator.addChange(change)
+        other = readtrips.MetricsAccumulator(3600, 24, 3)
+        with open("sampledata/tiny-trips.json") as f:
+            for trip in decoders.RecordDecoder('trips').decodeAll(f):
+                other.addTrip(trip)
+        other.merge(accumulator)
+        merged = readtrips.MetricsAccumulator(3600, 24, 3)
+        merged.merge(other).merge(other)
+        metrics = merged.toMetrics()
+        self.assertEqual(metrics.geo_ids, other.toMetrics().geo_ids)
+        self.assertEqual(metrics.trip_volumes[20].data[64], 4)
+        self.assertEqual(metrics.availability[0].data[78], 5)
+        self.assertEqual(metrics.on_street[0].data[79], 1)
+
+    def test_vehicle_sets(self):
+        rng = random.Random(0)
+        names = ["vehicle-{}".format(i) for i in range(5000)]
+        expected = {}
+        first, second = vehicles.VehicleSets(), vehicles.VehicleSets()
+        for _ in range(20000):
+            key = rng.randrange(8)
+            # Key 0 sees the whole fleet and becomes a bitmap
+            name = rng.choice(names if key == 0 else names[:key * 10])
+            expected.setdefault(key, set()).add(name)
+            rng.choice([first, second]).add(key, name)
+        first.merge(second, lambda key: key)
+        self.assertEqual(dict(first.counts()),
+            dict((key, len(names)) for key, names in expected.items()))
+        self.assertEqual(dict((key, set(names)) for key, names in first.items()), expected)
+        approximate = vehicles.ApproximateVehicleSets(precision=12)
+        approximate.addAll(0, expected[0])
+        approximate.addAll(1, expected[1])
+        counts = dict(approximate.counts())
+        self.assertAlmostEqual(counts[0], len(expected[0]), delta=0.05 * len(expected[0]))
+        self.assertEqual(counts[1], len(expected[1]))
+
+    def test_grid_zones_match_latlongtozone(self):
+        rng = random.Random(0)
+        points = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(2000)]
+        # Rounding boundaries, values that format as -0.000 and non-finite
+        points.extend([(0.0005, -0.0005), (-0.0004, 0.0004), (1.0625, -86.7225),
+            (36.1165, 2.675), (0.0, -0.0), (float('nan'), 1.0), (1.0, float('inf'))])
+        for gpsaccuracy in (0, 3, 4, 9):
+            expected_geo_ids, inverse_geo_ids = {}, {}
+            expected = [readtrips.latLongToZone(expected_geo_ids, lat, long, gpsaccuracy, inverse_geo_ids)
+                for lat, long in points]
+            grid = zones.GridZones(gpsaccuracy, {}, {})
+            self.assertEqual(grid.zones(points), expected)
+            self.assertEqual(grid.geo_ids, expected_geo_ids)
+            # Past the pure Python warm-up large batches are vectorized
+            grid = zones.GridZones(gpsaccuracy, {}, {})
+            grid.scalar_points = zones.SCALAR_POINTS
+            self.assertEqual(grid.zones(points), expected)
+            self.assertEqual(grid.geo_ids, expected_geo_ids)
+            grid = zones.GridZones(gpsaccuracy, {}, {})
+            self.assertEqual([grid.zone(lat, long) for lat, long in points], expected)
+
+    def test_incremental_aggregation(self):
+        with open("sampledata/tiny-changes.json") as f:
+            changes = list(decoders.RecordDecoder('changes').decodeAll(f))
+        first = readtrips.MetricsAccumulator(3600, 24, 3)
+        for change in changes[:25]:
+            first.addChange(change)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_filename = os.path.join(tmpdir, "state.json.gz")
+            readtrips.saveVehicleState(first, state_filename)
+            vehicle_state = readtrips.loadVehicleState(state_filename)
+        with self.assertRaises(ValueError):
+            readtrips.accumulatorFromMetrics(first.toMetrics(), 3)
+        accumulator = readtrips.accumulatorFromMetrics(first.toMetrics(), 3, vehicle_state)
+        for change in changes[25:]:
+            accumulator.addChange(change)
+        metrics = accumulator.toMetrics()
+        expected = readtrips.parseChanges(None, "sampledata/tiny-changes.json", 3600, 24, 3)
+        self.assertEqual(metrics, expected)
+        with self.assertRaises(ValueError):
+            readtrips.accumulatorFromMetrics(first.toMetrics(), 4, vehicle_state)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "output.pbf")
+            readtrips.main(["sampledata/tiny-trips.json", "-c", "24", "-ks", "-o", output,
+                "-sp", output])
+            with self.assertRaises(ValueError):
+                readtrips.main(["-cf", "sampledata/tiny-changes.json", "-inc", output,
+                    "-a", "4", "-o", output, "-sp", output])
+            # The aggregate may be replaced by the result of adding to it
+            readtrips.main(["-cf", "sampledata/tiny-changes.json", "-inc", output,
+                "-o", output, "-sp", output])
+            expected = readtrips.parseChanges(readtrips.metricsFromJSON(
+                "sampledata/tiny-trips.json", 3600, 24, 3), "sampledata/tiny-changes.json",
+                3600, 24, 3)
+            self.assertEqual(readtrips.metricsFromPBF(output), expected)
+            # A failed write leaves the existing files in place
+            with open(output, 'rb') as f:
+                written = f.read()
+            def fail(filename):
+                raise OSError("disk full")
+            with self.assertRaises(OSError):
+                readtrips.writeAtomically({output: functools.partial(
+                    readtrips.outputFile, metrics), output + ".other": fail})
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), written)
+            self.assertFalse([name for name in os.listdir(tmpdir) if name.endswith(".tmp")])
+
+    def test_synthetic_trips(self):
+        outputs = []
+        for _ in range(2):
+            output = io.StringIO()
+            synthetic_mds.generateTrips(output, 50, route_length=5, zones=20, seed=1)
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        accumulator = readtrips.MetricsAccumulator(3600, 24, 3)
+        for trip in decoders.RecordDecoder('trips').decodeAll(io.StringIO(outputs[0])):
+            accumulator.addTrip(trip)
+        self.assertEqual(accumulator.trip_count, 50)
+        self.assertEqual(sum(accumulator.trip_volumes.values()), 250)
+        self.assertLessEqual(len(accumulator.geo_ids), 20 * 5)
+
+    def test_polygon_zones(self):
+        square = [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]
+        hole = [[1, 1], [2, 1], [2, 2], [1, 2], [1, 1]]
+        right = [[4, 0], [8, 0], [8, 4], [4, 4], [4, 0]]
+        index = zones.PolygonIndex([[square, hole], [right]], ["a", "b"])
+        polygon_zones = zones.PolygonZones(index, {}, {})
+        geo_ids = polygon_zones.zones([(0.5, 0.5), (1.5, 1.5), (6, 2), (9, 9), (0.5, 0.5)])
+        self.assertEqual([polygon_zones.geo_ids[g] for g in geo_ids],
+            ["a", zones.OUTSIDE_ZONE, "b", zones.OUTSIDE_ZONE, "a"])
+        self.assertEqual(len(polygon_zones.point_geo_ids), 4)
+        # The zone table has the centroids of polygon zones, less their holes
+        accumulator = readtrips.MetricsAccumulator(3600, 24, None,
+            zoning=functools.partial(zones.PolygonZones, index))
+        accumulator.addTripFields(0, 10.0, 100.0, [(0.5, 0.5), (6, 2), (9, 9)], [0, 5, 10])
+        metrics = accumulator.toMetrics()
+        centers = zones.zoneCenters(metrics)
+        names = dict([(name, geo_id) for geo_id, name in metrics.geo_ids.items()])
+        self.assertAlmostEqual(centers[names["a"]][0], 30.5 / 15)
+        self.assertAlmostEqual(centers[names["a"]][1], 30.5 / 15)
+        self.assertEqual(centers[names["b"]], (2.0, 6.0))
+        self.assertTrue(all(math.isnan(value) for value in centers[names[zones.OUTSIDE_ZONE]]))
+        report = demostats.Report(metrics).toJSON([5])
+        outside = [volume for volume in report['top_trip_volumes']
+            if (volume['lat'], volume['long']) == (None, None)]
+        self.assertEqual(len(outside), 1)
+        self.assertEqual(outside[0]['zone'], zones.OUTSIDE_ZONE)
+        json.dumps(report, allow_nan=False)
+        # The table is only written when zone names are not coordinates
+        self.assertEqual(list(metrics.zone_table.geo_ids), sorted(metrics.geo_ids))
+
+    def test_hierarchical_grid_zones(self):
+        for grid in (zones.SquareGridZones(4, {}, {}), zones.HexGridZones(4, {}, {})):
+            cell = grid.cellAt(-86.777, 36.167)
+            self.assertEqual(grid.cellAt(*grid.cellCenter(cell)), cell)
+            self.assertEqual(grid.zone(-86.777, 36.167), grid.zone(*grid.cellCenter(cell)))
+        square = zones.SquareGridZones(4, {}, {})
+        coarser = zones.SquareGridZones(3, {}, {})
+        self.assertEqual(square.parentCell(square.cellAt(-86.777, 36.167)),
+            coarser.cellAt(-86.777, 36.167))
+        # Backends must say how to name the zone at a point
+        with self.assertRaises(TypeError):
+            zones.CachedZones({}, {})
+
+    def test_decompose_trips_matches_reference(self):
+        for filename in ["sampledata/trips-24.pbf", "sampledata/trips-168.pbf",
+                "sampledata/big-trips-24.pbf"]:
+            metrics = readtrips.metricsFromPBF(input_filename = filename)
+            for period in metrics.flows:
+                pickups = metrics.flows[period].data
+                for privacy_level in range(1, 8):
+                    self.assertEqual(
+                        readtrips.decomposeTrips(pickups, privacy_level),
+                        referenceDecomposeTrips(pickups, privacy_level))
+
+    def test_suppression_sweep(self):
+        metrics = readtrips.metricsFromPBF(input_filename = "sampledata/big-trips-24.pbf")
+        privacy_levels = [1, 2, 5, 10, 20]
+        sweep = readtrips.suppressionSweep(metrics, privacy_levels)
+        self.assertEqual(sweep[5], (15988, 54727))
+        peeled_flows = readtrips.peelAllFlows(metrics, privacy_levels)
+        for privacy_level in privacy_levels:
+            suppressed = readtrips.suppress(metrics, privacy_level, peeled_flows)
+            self.assertEqual(sweep[privacy_level],
+                (suppressed.trip_volume_suppressed, suppressed.flows_suppressed))
+
+    def test_write_suppressed_matches_suppress(self):
+        metrics = readtrips.metricsFromPBF(input_filename = "sampledata/tiny-trips.pbf")
+        for privacy_level in [1, 2, 5]:
+            output = io.BytesIO()
+            stats = instrument.reset()
+            readtrips.writeSuppressed(metrics, privacy_level, output)
+            # Serialization is timed apart from suppression
+            self.assertEqual(set(stats.seconds), {'suppress', 'write'})
+            self.assertEqual(output.getvalue(),
+                readtrips.suppress(metrics, privacy_level).SerializeToString())
+
+    def test_lazy_imports(self):
+        # The tools start without loading numpy, pandas or jsonschema
+        script = ("import amms, demostats, pbfquery, pbftocsv, pbftojson, readtrips, sys\n"
+            "print(*[m for m in ('numpy', 'pandas', 'jsonschema') if m in sys.modules and "
+            "type(sys.modules[m]).__name__ != '_LazyModule'])")
+        output = subprocess.run([sys.executable, '-c', script], check=True,
+            capture_output=True, text=True).stdout
+        self.assertEqual(output.split(), [])
+
+    def test_suppress_command(self):
+        metrics = readtrips.metricsFromPBF(input_filename = "sampledata/tiny-trips.pbf")
+        with tempfile.TemporaryDirectory() as directory:
+            prefix = os.path.join(directory, "suppress")
+            amms.main(['suppress', "sampledata/tiny-trips.pbf", '-sp', prefix, '-p', '2', '5'])
+            for privacy_level in [2, 5]:
+                with open("{}-{}.pbf".format(prefix, privacy_level), 'rb') as f:
+                    self.assertEqual(f.read(),
+                        readtrips.suppress(metrics, privacy_level).SerializeToString())
+
+    def test_aggregation_service(self):
+        trips, changes = "sampledata/tiny-trips.json", "sampledata/tiny-changes.json"
+        expected = readtrips.parseChanges(
+            readtrips.metricsFromJSON(trips, 3600, 168, 3), changes, 3600, 168, 3)
+        with tempfile.TemporaryDirectory() as directory:
+            unix_socket = os.path.join(directory, "amms.sock")
+            checkpoint = os.path.join(directory, "checkpoint.pbf")
+            aggregator = ammsd.Aggregator(readtrips.MetricsAccumulator(3600, 168, 3), checkpoint)
+            async def run():
+                ready = asyncio.Event()
+                server = asyncio.ensure_future(ammsd.serve(aggregator, unix_socket,
+                    checkpoint_interval=0, ready=lambda server: ready.set()))
+                await ready.wait()
+                (sent, responses) = await replay.replay([trips, changes], [
+                    {'command': 'totals'}, {'command': 'snapshot', 'privacy_level': 5},
+                    {'command': 'shutdown'}], unix_socket)
+                await server
+                return sent, responses
+            (sent, (totals, snapshot, shutdown)) = asyncio.run(run())
+            self.assertEqual(sent, 58)
+            self.assertEqual((totals['trips'], totals['changes']), (7, 51))
+            self.assertEqual(snapshot['metrics']['privacyLevel'], 5)
+            self.assertEqual(shutdown['checkpoint'], checkpoint)
+            with open(checkpoint, 'rb') as f:
+                self.assertEqual(f.read(), expected.SerializeToString())
+            # Snapshots are only written within the snapshot directory
+            unwritable = os.path.join(directory, "missing", "checkpoint.pbf")
+            aggregator = ammsd.Aggregator(readtrips.MetricsAccumulator(3600, 168, 3), unwritable,
+                snapshot_dir=directory)
+            snapshot = lambda output_filename: aggregator.handleLine(json.dumps(
+                {'command': 'snapshot', 'output_filename': output_filename}))
+            for output_filename in ("../escape.pbf", os.path.join(directory, "nested.pbf")):
+                self.assertIn('error', snapshot(output_filename))
+            self.assertEqual(snapshot("snapshot.pbf"),
+                {'output_filename': os.path.join(directory, "snapshot.pbf")})
+            self.assertIn('error', ammsd.Aggregator(readtrips.MetricsAccumulator(3600, 168, 3))
+                .handleLine(json.dumps({'command': 'snapshot', 'output_filename': "x.pbf"})))
+            # A checkpoint that fails to be written is retried
+            with open(trips) as f:
+                aggregator.handleLine(f.readline())
+            with self.assertRaises(OSError):
+                aggregator.checkpoint()
+            self.assertTrue(aggregator.changed)
+            self.assertIn('error', aggregator.handleLine(json.dumps({'command': 'checkpoint'})))
+            async def checkpointOnceWritable():
+                checkpoints = asyncio.ensure_future(ammsd.checkpointEvery(aggregator, 0.01))
+                await asyncio.sleep(0.05)
+                self.assertFalse(checkpoints.done())
+                os.mkdir(os.path.dirname(unwritable))
+                for _ in range(200):
+                    if not aggregator.changed:
+                        break
+                    await asyncio.sleep(0.01)
+                checkpoints.cancel()
+            with self.assertLogs(level='WARNING'):
+                asyncio.run(checkpointOnceWritable())
+            self.assertFalse(aggregator.changed)
+            self.assertTrue(os.path.exists(unwritable))
+
+    def test_sliding_window(self):
+        windows = []
+        accumulator = readtrips.WindowAccumulator(3600, 2, 3, emit=windows.append)
+        point = [(36.1, -86.7)]
+        for hour in (0, 1, 2):
+            accumulator.addTripFields(hour * 3600, 10.0, 100.0, point, [hour * 3600])
+        # Late records are skipped before their zones are looked up
+        accumulator.addTripFields(0, 10.0, 100.0, [(36.2, -86.8)], [0])
+        accumulator.addChangeFields(7200, "vehicle", "available", point[0])
+        self.assertEqual(accumulator.late_records, {'trips': 1, 'changes': 0})
+        self.assertEqual(len(accumulator.geo_ids), 1)
+        self.assertEqual([dict(window.total_trips) for window in windows], [{0: 1}, {0: 1, 1: 1}])
+        metrics = accumulator.toMetrics()
+        self.assertEqual(dict(metrics.total_trips), {1: 1, 2: 1})
+        self.assertEqual((metrics.start_time, metrics.end_time, metrics.cycle_length), (3600, 10800, 0))
+        self.assertEqual(dict(metrics.geo_ids), {0: "36.100:-86.700"})
+        self.assertEqual(dict(metrics.availability[2].data), {0: 1})
+        # A window longer than the input matches absolute periods
+        trips, changes = "sampledata/tiny-trips.json", "sampledata/tiny-changes.json"
+        window = readtrips.metricsFromWindow([trips], [changes], 3600, 1 << 20, 3)
+        absolute = readtrips.parseChanges(
+            readtrips.metricsFromJSON(trips, 3600, 0, 3), changes, 3600, 0, 3)
+        self.assertEqual(dict(window.total_trips), dict(absolute.total_trips))
+        for field_name in ('trip_volumes', 'dropoffs', 'on_street'):
+            counts = [dict([((period, metrics.geo_ids[geo_id]), count)
+                    for period in getattr(metrics, field_name)
+                    for geo_id, count in getattr(metrics, field_name)[period].data.items()])
+                for metrics in (window, absolute)]
+            self.assertEqual(counts[0], counts[1])
+
+    def test_emitted_windows(self):
+        def windowCounts(metrics, first, end):
+            counts = {}
+            for field_name in ('total_trips', 'total_distance', 'total_duration'):
+                for period, total in getattr(metrics, field_name).items():
+                    if first <= period <= end:
+                        counts[(field_name, period)] = total
+            for field_name in ('trip_volumes', 'pickups', 'dropoffs'):
+                field = getattr(metrics, field_name)
+                for period in field:
+                    if first <= period <= end:
+                        for geo_id, count in field[period].data.items():
+                            counts[(field_name, period, metrics.geo_ids[geo_id])] = count
+            for period in metrics.flows:
+                if first <= period <= end:
+                    for pickup, dropoffs in metrics.flows[period].data.items():
+                        for dropoff, count in dropoffs.data.items():
+                            counts[('flows', period, metrics.geo_ids[pickup],
+                                metrics.geo_ids[dropoff])] = count
+            return counts
+
+        with open("sampledata/trips.json") as f:
+            trips = [json.loads(line) for line in f]
+        trips.sort(key=lambda trip: trip['start_time'])
+        with tempfile.TemporaryDirectory() as directory:
+            trips_filename = os.path.join(directory, "sorted-trips.json")
+            with open(trips_filename, 'w') as f:
+                f.writelines([json.dumps(trip) + "\n" for trip in trips])
+            absolute = readtrips.metricsFromJSON(trips_filename, 3600, 0, 3)
+            for window_length, window_step in ((24, 24), (5, 2)):
+                windows = []
+                latest = readtrips.metricsFromWindow([trips_filename], [], 3600, window_length,
+                    3, window_step=window_step, emit=windows.append)
+                self.assertGreater(len(windows), 100)
+                # Every window, whether emitted on the way or the latest, has
+                # the counts of the absolute periods it covers
+                for window in windows + [latest]:
+                    first = window.start_time // 3600
+                    end = window.end_time // 3600 - 1
+                    self.assertEqual(windowCounts(window, first, end),
+                        windowCounts(absolute, first, end))
+
+    def test_run_stats(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "output.pbf")
+            prefix = os.path.join(directory, "suppress")
+            readtrips.main(["sampledata/tiny-trips.json", "-cf", "sampledata/tiny-changes.json",
+                "-o", output, "-sp", prefix, "-p", "2"])
+            with open(output + ".stats.json") as f:
+                stats = json.load(f)
+            metrics = packed.loadMetrics(output)
+            written = os.path.getsize(output) + os.path.getsize(prefix + "-2.pbf")
+        counters = stats['counters']
+        self.assertEqual((counters['trips'], counters['changes']), (7, 51))
+        self.assertEqual(counters['route_points'],
+            sum([sum(counts.data.values()) for counts in metrics.trip_volumes.values()]))
+        self.assertEqual(counters['zones'], len(metrics.geo_ids))
+        self.assertEqual(counters['bytes_written'], written)
+        self.assertEqual(counters['map_cells'], readtrips.mapCells(metrics))
+        for stage in ('read', 'to_metrics', 'write', 'peel', 'suppress'):
+            self.assertIn(stage, stats['stages'])
+        self.assertNotIn('decode', stats['stages'])
+
+    def test_partial_cache(self):
+        inputs = ["sampledata/tiny-trips.json", "sampledata/trips.json",
+            "-cf", "sampledata/tiny-changes.json"]
+        with tempfile.TemporaryDirectory() as directory:
+            cache_dir = os.path.join(directory, "cache")
+            outputs = []
+            for run in range(2):
+                output = os.path.join(directory, "output-{}.pbf".format(run))
+                readtrips.main(inputs + ["-o", output, "-sp", output, "-cd", cache_dir])
+                with open(output, 'rb') as f:
+                    outputs.append(f.read())
+                with open(output + ".stats.json") as f:
+                    counters = json.load(f)['counters']
+                self.assertEqual(counters.get('cache_hits', 0), 3 * run)
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertNotIn('trips', counters)
+            uncached = os.path.join(directory, "uncached.pbf")
+            readtrips.main(inputs + ["-o", uncached, "-sp", uncached])
+            self.assertEqual(readtrips.metricsFromPBF(output), readtrips.metricsFromPBF(uncached))
+            cache = partials.PartialCache(cache_dir)
+            entries = cache.entries()
+            self.assertEqual([entry['kind'] for entry in entries], ['changes', 'trips', 'trips'])
+            self.assertEqual(entries[0]['changes'], 51)
+            # Entries are evicted least recently used first
+            smallest = sum([entry['size'] for entry in entries[:2]])
+            self.assertEqual(len(cache.prune(smallest)), 1)
+            self.assertEqual([entry['key'] for entry in cache.entries()],
+                [entry['key'] for entry in entries[:2]])
+            self.assertEqual(len(cache.prune(0)), 2)
+            # A partial that cannot be read back from the cache is merged as parsed
+            class UnreadableCache(partials.PartialCache):
+                def get(self, key):
+                    return None
+            accumulator = readtrips.MetricsAccumulator(3600, 24, 3)
+            readtrips.aggregateCached(accumulator, ["sampledata/tiny-trips.json"], [], 1,
+                UnreadableCache(cache_dir), {})
+            self.assertEqual(accumulator.toMetrics(),
+                readtrips.metricsFromJSON("sampledata/tiny-trips.json", 3600, 24, 3))
+
+    def test_multiple_configs(self):
+        inputs = ["sampledata/tiny-trips.json", "-cf", "sampledata/tiny-changes.json"]
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "output.pbf")
+            prefix = os.path.join(directory, "suppress")
+            readtrips.main(inputs + ["-o", output, "-sp", prefix, "-p", "2",
+                "-cfg", ":24:", ":168:2", "1800:0:"])
+            with open(output + ".stats.json") as f:
+                self.assertEqual(json.load(f)['counters']['trips'], 7)
+            for config in ((3600, 24, 3), (3600, 168, 2), (1800, 0, 3)):
+                single = os.path.join(directory, "single.pbf")
+                readtrips.main(inputs + ["-o", single, "-sp", single, "-p", "2",
+                    "-per", str(config[0]), "-c", str(config[1]), "-a", str(config[2])])
+                for expected, actual in ((single, readtrips.configFilename(output, config)),
+                        (single + "-2.pbf", "{}-{}-{}-{}-2.pbf".format(prefix, *config))):
+                    with open(expected, 'rb') as f, open(actual, 'rb') as g:
+                        self.assertEqual(f.read(), g.read())
+
+    def test_rollup(self):
+        def namedCounts(metrics):
+            counts = {}
+            for field_name in ('trip_volumes', 'pickups', 'dropoffs', 'availability', 'on_street'):
+                field = getattr(metrics, field_name)
+                counts[field_name] = dict([((period, metrics.geo_ids[geo_id]), count)
+                    for period in field for geo_id, count in field[period].data.items()])
+            counts['flows'] = dict([
+                ((period, metrics.geo_ids[pickup], metrics.geo_ids[dropoff]), count)
+                for period in metrics.flows
+                for pickup, dropoffs in metrics.flows[period].data.items()
+                for dropoff, count in dropoffs.data.items()])
+            counts['total_trips'] = dict(metrics.total_trips)
+            return counts
+
+        inputs = ["sampledata/tiny-trips.json", "-cf", "sampledata/tiny-changes.json",
+            "-z", "square"]
+        with tempfile.TemporaryDirectory() as directory:
+            fine = os.path.join(directory, "fine.pbf")
+            coarse = os.path.join(directory, "coarse.pbf")
+            rolled = os.path.join(directory, "rolled.pbf")
+            readtrips.main(inputs + ["-zl", "12", "--keep_state", "-o", fine, "-sp", fine])
+            readtrips.main(inputs + ["-zl", "9", "-per", "7200", "-c", "12", "-o", coarse,
+                "-sp", coarse])
+            rollup.main([fine, "-z", "square", "-sl", "12", "-zl", "9", "-per", "7200",
+                "-c", "12", "-o", rolled])
+            expected = readtrips.metricsFromPBF(coarse)
+            actual = readtrips.metricsFromPBF(rolled)
+            self.assertEqual((actual.period_seconds, actual.cycle_length), (7200, 12))
+            self.assertEqual(namedCounts(actual), namedCounts(expected))
+            for period, total in expected.total_distance.items():
+                self.assertAlmostEqual(actual.total_distance[period], total, delta=total * 1e-6)
+            os.unlink(readtrips.vehicleStateFilename(fine))
+            with self.assertRaises(SystemExit):
+                rollup.main([fine, "-c", "24", "-o", rolled])
+        with self.assertRaises(ValueError):
+            rollup.periodMapping(3600, 168, 3600, 25)
+        with self.assertRaises(ValueError):
+            rollup.periodMapping(3600, 24, 5400, 0)
+        self.assertEqual(rollup.periodMapping(3600, 0, 3600 * 24, 7)(24 * 9 + 23), 2)
+        (names, straddling) = rollup.gridZoneNames(["1.2344:-0.0051", "1.2345:-0.0051"], 3)
+        self.assertEqual((names["1.2344:-0.0051"], straddling), ("1.234:-0.005", 1))
+
+    def test_streaming_json(self):
+        metrics = readtrips.metricsFromPBF("sampledata/trips-168.pbf")
+        expected = json_format.MessageToDict(metrics)
+        for indent, separators in ((2, (',', ': ')), (None, (',', ':'))):
+            output = io.StringIO()
+            pbftojson.writeJSON(metrics, output, indent)
+            self.assertEqual(output.getvalue(),
+                json.dumps(expected, indent=indent, separators=separators))
+        output = io.StringIO()
+        pbftojson.writeNDJSON(metrics, output)
+        merged = Metrics()
+        for line in output.getvalue().splitlines():
+            part = Metrics()
+            json_format.Parse(line, part)
+            merged.MergeFrom(part)
+        self.assertEqual(merged, metrics)
+        with tempfile.TemporaryDirectory() as directory:
+            input_filename = os.path.join(directory, "trips-168.pbf")
+            output_filename = os.path.join(directory, "flows.json")
+            readtrips.outputFile(metrics, input_filename)
+            pbftojson.main([input_filename, "-f", "flows", "-per", "3", "--compact",
+                "--output_filename", output_filename])
+            with open(output_filename) as f:
+                selected = json.load(f)
+        self.assertEqual(list(selected['flows']), ['3'])
+        self.assertEqual(selected['flows']['3'], expected['flows']['3'])
+        self.assertNotIn('tripVolumes', selected)
+        # Doubles that are not finite are strings, as in MessageToJson
+        metrics = Metrics()
+        metrics.geo_ids[0] = "-86.777:36.167"
+        metrics.geo_ids[1] = zones.OUTSIDE_ZONE
+        metrics.total_distance[0] = float('inf')
+        zones.fillZoneTable(metrics, lambda name: (math.nan, -math.inf))
+        output = io.StringIO()
+        pbftojson.writeJSON(metrics, output)
+        self.assertEqual(output.getvalue(), json_format.MessageToJson(metrics))
+        json.loads(output.getvalue(), parse_constant=self.fail)
+
+    def test_zone_dictionary(self):
+        with tempfile.TemporaryDirectory() as directory:
+            dictionary = os.path.join(directory, "zones.json")
+            first = os.path.join(directory, "first.pbf")
+            second = os.path.join(directory, "second.pbf")
+            again = os.path.join(directory, "again.pbf")
+            readtrips.main(["sampledata/tiny-trips.json", "-zd", dictionary, "-o", first,
+                "-sp", first])
+            readtrips.main(["sampledata/trips.json", "-cf", "sampledata/tiny-changes.json",
+                "-zd", dictionary, "-o", second, "-sp", second])
+            readtrips.main(["sampledata/tiny-trips.json", "-zd", dictionary, "-o", again,
+                "-sp", again])
+            geo_ids = zones.loadZoneDictionary(dictionary)
+            first_metrics = readtrips.metricsFromPBF(first)
+            second_metrics = readtrips.metricsFromPBF(second)
+            # Zones keep their geo_ids across runs and outputs only list their own zones
+            self.assertEqual(readtrips.metricsFromPBF(again), first_metrics)
+            for metrics in (first_metrics, second_metrics):
+                self.assertTrue(set(metrics.geo_ids.items()) <= set(geo_ids.items()))
+                self.assertEqual(set(metrics.geo_ids), pbfquery.referencedZones(
+                    metrics, pbfquery.ZONE_FIELDS + ('flows',)))
+            self.assertEqual(len(geo_ids),
+                len(set(first_metrics.geo_ids.values()) | set(second_metrics.geo_ids.values())))
+            # Grid zone coordinates are read from their names, so there is no table
+            self.assertFalse(second_metrics.HasField('zone_table'))
+            centers = zones.zoneCenters(second_metrics)
+            for geo_id, name in second_metrics.geo_ids.items():
+                (long, lat) = name.split(':')
+                self.assertEqual(centers[geo_id], (float(lat), float(long)))
+            with self.assertRaises(ValueError):
+                readtrips.main(["sampledata/tiny-trips.json", "-zd", dictionary, "-o", again,
+                    "--incremental", "sampledata/trips-168.pbf"])
+        geo_ids = {0: "a", 2: "b"}
+        self.assertEqual(zones.addZone(geo_ids, {"a": 0, "b": 2}, "c"), 3)
+        self.assertTrue(all(math.isnan(value) for value in zones.zoneCenter("outside")))
+
+    def test_packed_round_trip(self):
+        metrics = readtrips.metricsFromPBF(input_filename = "sampledata/trips-168.pbf")
+        packed_metrics = packed.packMetrics(metrics)
+        self.assertTrue(packed.isPacked(packed_metrics))
+        self.assertEqual(len(packed_metrics.flows), 0)
+        self.assertLess(packed_metrics.ByteSize(), metrics.ByteSize())
+        for field_name, _ in packed.PACKED_COUNTS:
+            expected = sorted(zip(*packed.countArrays(metrics, field_name)))
+            self.assertEqual(sorted(zip(*packed.countArrays(packed_metrics, field_name))), expected)
+        with self.assertRaises(ValueError):
+            readtrips.suppress(packed_metrics, 5)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "packed.pbf")
+            readtrips.outputFile(packed_metrics, filename)
+            self.assertEqual(packed.readMetrics(filename), packed_metrics)
+        unpacked = packed.unpackMetrics(packed_metrics)
+        self.assertFalse(packed.isPacked(unpacked))
+        self.doTestFields(unpacked, TEST_VECTOR_168)
+        self.assertEqual(readtrips.suppressionSweep(unpacked, [2, 5]),
+            readtrips.suppressionSweep(metrics, [2, 5]))
+
+    def test_export(self):
+        metrics = readtrips.metricsFromPBF(input_filename = "sampledata/trips-168.pbf")
+        for output, frame in ((pbftocsv.outputVolumes, pbftocsv.volumeFrame),
+                (pbftocsv.outputFlows, pbftocsv.flowFrame)):
+            maps, packed_maps = io.StringIO(), io.StringIO()
+            output(metrics, maps)
+            output(packed.packMetrics(metrics), packed_maps)
+            lines = maps.getvalue().splitlines()
+            self.assertEqual(sorted(packed_maps.getvalue().splitlines()), sorted(lines))
+            rows = frame(metrics)
+            self.assertEqual(len(rows), len(lines) - 1)
+            self.assertEqual(lines[1].split(',')[:-1],
+                [str(value) for value in rows.iloc[0].tolist()[:-1]])
+
+    def test_query(self):
+        metrics = readtrips.metricsFromPBF(input_filename = "sampledata/trips-168.pbf")
+        zone_names = [metrics.geo_ids[geo_id] for geo_id in list(metrics.geo_ids)[:20]]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for encoding, output in (("maps", metrics), ("packed", packed.packMetrics(metrics))):
+                filename = os.path.join(tmpdir, encoding + ".pbf")
+                readtrips.outputFile(output, filename)
+                self.assertEqual(pbfquery.query(filename), metrics)
+                self.assertTrue(os.path.exists(pbfquery.indexFilename(filename)))
+                result = pbfquery.query(filename, fields=['flows', 'pickups'],
+                    periods=range(7, 10), zones=zone_names)
+                self.assertEqual(list(result.trip_volumes), [])
+                flows = [(period, pickup, dropoff, count)
+                    for period in result.flows
+                    for pickup, dropoffs in result.flows[period].data.items()
+                    for dropoff, count in dropoffs.data.items()]
+                expected_flows = [(period, pickup, dropoff, count)
+                    for period in range(7, 10) if period in metrics.flows
+                    for pickup, dropoffs in metrics.flows[period].data.items()
+                    for dropoff, count in dropoffs.data.items()
+                    if metrics.geo_ids[pickup] in zone_names or metrics.geo_ids[dropoff] in zone_names]
+                self.assertEqual(sorted(flows), sorted(expected_flows))
+                for period in set(metrics.pickups) & set(range(7, 10)):
+                    expected = dict((geo_id, count)
+                        for geo_id, count in metrics.pickups[period].data.items()
+                        if metrics.geo_ids[geo_id] in zone_names)
+                    self.assertEqual(dict(result.pickups[period].data), expected)
+                    for geo_id in expected:
+                        self.assertEqual(result.geo_ids[geo_id], metrics.geo_ids[geo_id])
+            # Numeric zone names, as of polygon zones, are not taken for geo_ids
+            numbered = Metrics()
+            numbered.geo_ids[0] = "1"
+            numbered.geo_ids[1] = "0"
+            numbered.trip_volumes[0].data[0] = 5
+            numbered.trip_volumes[0].data[1] = 7
+            filename = os.path.join(tmpdir, "numbered.pbf")
+            readtrips.outputFile(numbered, filename)
+            for arguments, expected in ((["-z", "1"], {0: 5}), (["-g", "1"], {1: 7}),
+                    (["-z", "1", "-g", "1"], {0: 5, 1: 7})):
+                output = os.path.join(tmpdir, "numbered.json")
+                pbfquery.main([filename, "-f", "trip_volumes", "--output_filename", output]
+                    + arguments)
+                with open(output) as f:
+                    result = json_format.Parse(f.read(), Metrics())
+                self.assertEqual(dict(result.trip_volumes[0].data), expected)
+
+    def test_report(self):
+        metrics = readtrips.metricsFromPBF(input_filename = "sampledata/big-trips-24.pbf")
+        report = demostats.Report(metrics)
+        volumes = [((period, geo_id), count)
+            for period in metrics.trip_volumes
+            for geo_id, count in metrics.trip_volumes[period].data.items()]
+        self.assertEqual(report.top_trip_volumes,
+            sorted(volumes, key=lambda volume: volume[1], reverse=True)[:10])
+        self.assertEqual(demostats.top_n(metrics.trip_volumes, 10, reverse=False),
+            sorted(volumes, key=lambda volume: volume[1])[:10])
+        self.assertEqual(report.totals['trip_volumes'],
+            demostats.getTotalByPeriod(metrics, 'trip_volumes'))
+        self.assertEqual(report.total_flows, 104321)
+        output = json.loads(json.dumps(report.toJSON([2, 5])))
+        self.assertEqual(output['total_trip_volume'], 2860121)
+        self.assertEqual(len(output['series']['trip_volume']), 24)
+        self.assertEqual([(level['volume_suppressed'], level['flows_suppressed'])
+            for level in output['privacy_suppression']], [(3094, 13135), (15988, 54727)])
+        # Privacy levels below 1 are rejected before any suppression is done
+        for arguments in (['-mp', '0'], ['-p', '2', '0']):
+            with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                demostats.main(["sampledata/tiny-trips.pbf"] + arguments)
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            readtrips.suppressMain(["sampledata/tiny-trips.pbf", "-p", "-1"])
+
     def test_big_trips(self):
         metrics = readtrips.metricsFromPBF(
             input_filename = "sampledata/big-trips-24.pbf",
@@ -0,0 +1,74 @@
+import argparse
+import decoders
+import json
+import random
+import readtrips
+import sys
+import time
+import zones
+
+# Compares the throughput of per-point latLongToZone with GridZones.
+# Run from the repository root: python -m tests.zones_benchmark
+
+def readRoutes(filename):
+    routes = []
+    with open(filename) as f:
+        for trip in decoders.RecordDecoder('trips').decodeAll(f):
+            routes.append([route_point['geometry']['coordinates']
+                for route_point in trip['route']['features']])
+    return routes
+
+def jitterRoutes(routes, count, seed=0):
+    # Repeats the sample routes with small offsets to reach count points
+    rng = random.Random(seed)
+    output, total = [], 0
+    while total < count:
+        route = routes[rng.randrange(len(routes))]
+        dlat, dlong = rng.uniform(-0.01, 0.01), rng.uniform(-0.01, 0.01)
+        output.append([(lat + dlat, long + dlong) for lat, long in route])
+        total += len(route)
+    return output
+
+def timeLatLongToZone(routes, gpsaccuracy):
+    geo_ids, inverse_geo_ids, output = {}, {}, []
+    start = time.perf_counter()
+    for route in routes:
+        for lat, long in route:
+            output.append(readtrips.latLongToZone(geo_ids, lat, long, gpsaccuracy, inverse_geo_ids))
+    return time.perf_counter() - start, output, geo_ids
+
+def timeGridZones(routes, gpsaccuracy, batched):
+    geo_ids, inverse_geo_ids, output = {}, {}, []
+    grid = zones.GridZones(gpsaccuracy, geo_ids, inverse_geo_ids)
+    start = time.perf_counter()
+    for route in routes:
+        if batched:
+            output.extend(grid.zones(route))
+        else:
+            for lat, long in route:
+                output.append(grid.zone(lat, long))
+    return time.perf_counter() - start, output, geo_ids
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark zone assignment throughput')
+    parser.add_argument('-i', '--input', default='sampledata/trips.json')
+    parser.add_argument('-n', '--points', default=1000000, type=int)
+    parser.add_argument('-a', '--accuracy', default=3, type=int)
+    args = parser.parse_args()
+
+    routes = jitterRoutes(readRoutes(args.input), args.points)
+    points = sum(map(len, routes))
+    baseline, expected, expected_geo_ids = timeLatLongToZone(routes, args.accuracy)
+    print("{:<24}{:>12}{:>16}{:>10}".format("Method", "Seconds", "Points/sec", "Speedup"))
+    print("{:<24}{:>12.3f}{:>16.0f}{:>10.2f}".format(
+        "latLongToZone", baseline, points / baseline, 1.0))
+    for name, batched in (("GridZones.zone", False), ("GridZones.zones", True)):
+        elapsed, output, geo_ids = timeGridZones(routes, args.accuracy, batched)
+        if output != expected or geo_ids != expected_geo_ids:
+            sys.exit("{} does not match latLongToZone".format(name))
+        print("{:<24}{:>12.3f}{:>16.0f}{:>10.2f}".format(
+            name, elapsed, points / elapsed, baseline / elapsed))
+
+if __name__ == "__main__":
+    sys.exit(main())
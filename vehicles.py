@@ -0,0 +1,229 @@
+from array import array
+import bisect
+import hashlib
+import math
+
+# Distinct vehicle counting for the availability and on street counts.
+#
+# Vehicle IDs are interned to small integers by a VehicleIndex that is shared
+# by all the sets of an aggregate. VehicleSets keeps the exact set of vehicles
+# for each key, e.g. (period, geo_id), as a sorted array of indexes while it is
+# sparse and as a bitmap once that is smaller. ApproximateVehicleSets keeps a
+# HyperLogLog sketch per key instead, whose size does not grow with the fleet.
+
+INDEX_TYPECODE = 'I'
+# Bits per entry of a sorted index array
+INDEX_BITS = array(INDEX_TYPECODE).itemsize * 8
+
+class VehicleIndex:
+    # Interns vehicle IDs to consecutive integers in order of appearance
+    def __init__(self):
+        self.indexes = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, vehicle_id):
+        index = self.indexes.get(vehicle_id)
+        if index is None:
+            index = self.indexes[vehicle_id] = len(self.names)
+            self.names.append(vehicle_id)
+        return index
+
+def isBitmap(members):
+    return isinstance(members, bytearray)
+
+def addMember(members, index):
+    # Adds an index to a set, which may be a sorted array or a bitmap, and
+    # returns the set. Arrays become bitmaps once those are smaller.
+    if isBitmap(members):
+        byte = index >> 3
+        if byte >= len(members):
+            members.extend(bytes(byte + 1 - len(members)))
+        members[byte] |= 1 << (index & 7)
+        return members
+    position = bisect.bisect_left(members, index)
+    if position < len(members) and members[position] == index:
+        return members
+    members.insert(position, index)
+    if len(members) * INDEX_BITS > members[-1]:
+        return toBitmap(members)
+    return members
+
+def toBitmap(indexes):
+    bitmap = bytearray((indexes[-1] >> 3) + 1 if indexes else 0)
+    for index in indexes:
+        bitmap[index >> 3] |= 1 << (index & 7)
+    return bitmap
+
+def bitmapInt(bitmap):
+    return int.from_bytes(bitmap, 'little')
+
+def memberIndexes(members):
+    # Yields the indexes of a set in increasing order
+    if not isBitmap(members):
+        yield from members
+        return
+    bits = bin(bitmapInt(members))[:1:-1]
+    index = bits.find('1')
+    while index >= 0:
+        yield index
+        index = bits.find('1', index + 1)
+
+def memberCount(members):
+    if isBitmap(members):
+        return bin(bitmapInt(members)).count('1')
+    return len(members)
+
+def unionMembers(members, other):
+    # Returns the union of two sets, either of which may be modified
+    if not isBitmap(members) and not isBitmap(other):
+        union = array(INDEX_TYPECODE, sorted(set(members).union(other)))
+        if not union or len(union) * INDEX_BITS <= union[-1]:
+            return union
+        return toBitmap(union)
+    if not isBitmap(members):
+        members = toBitmap(members)
+    if not isBitmap(other):
+        other = toBitmap(other)
+    union = bitmapInt(members) | bitmapInt(other)
+    return bytearray(union.to_bytes(max(len(members), len(other)), 'little'))
+
+class VehicleSets:
+    # Exact sets of distinct vehicles by key
+    def __init__(self, index=None):
+        self.index = index if index is not None else VehicleIndex()
+        self.sets = {}
+
+    def __len__(self):
+        return len(self.sets)
+
+    def add(self, key, vehicle_id):
+        index = self.index.index(vehicle_id)
+        members = self.sets.get(key)
+        if members is None:
+            self.sets[key] = array(INDEX_TYPECODE, [index])
+        else:
+            self.sets[key] = addMember(members, index)
+
+    def addAll(self, key, vehicle_ids):
+        for vehicle_id in vehicle_ids:
+            self.add(key, vehicle_id)
+
+    def merge(self, other, remap_key):
+        # Unions the sets of other into these, with the keys of other
+        # translated by remap_key
+        if not isinstance(other, VehicleSets):
+            raise ValueError("Cannot merge exact and approximate vehicle counts")
+        remap = [self.index.index(name) for name in other.index.names]
+        for key, members in other.sets.items():
+            remapped = array(INDEX_TYPECODE, sorted(remap[index] for index in memberIndexes(members)))
+            key = remap_key(key)
+            if key in self.sets:
+                self.sets[key] = unionMembers(self.sets[key], remapped)
+            else:
+                self.sets[key] = unionMembers(array(INDEX_TYPECODE), remapped)
+        return self
+
+    def counts(self):
+        # Yields (key, number of distinct vehicles) in insertion order
+        for key, members in self.sets.items():
+            yield key, memberCount(members)
+
+    def items(self):
+        # Yields (key, vehicle IDs) in insertion order
+        names = self.index.names
+        for key, members in self.sets.items():
+            yield key, [names[index] for index in memberIndexes(members)]
+
+class ApproximateVehicleSets:
+    # HyperLogLog estimates of the number of distinct vehicles by key, using
+    # 2 ** precision one byte registers per key. The relative standard error is
+    # about 1.04 / sqrt(2 ** precision). Most keys see few vehicles, so their
+    # registers are kept sparsely in a dict until a sixteenth of them are set.
+    # Vehicle IDs are hashed rather than interned, so the index is unused and
+    # memory does not grow with the fleet.
+    def __init__(self, index=None, precision=10):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = 1 << precision
+        self.sets = {}
+
+    def __len__(self):
+        return len(self.sets)
+
+    def position(self, vehicle_id):
+        # The register and rank of a vehicle, from a 64 bit hash of its ID
+        # that is the same in every process, unlike hash()
+        hashed = int.from_bytes(hashlib.blake2b(
+            vehicle_id.encode(), digest_size=8).digest(), 'little')
+        remaining_bits = 64 - self.precision
+        rest = hashed & ((1 << remaining_bits) - 1)
+        return hashed >> remaining_bits, remaining_bits - rest.bit_length() + 1
+
+    def add(self, key, vehicle_id):
+        (register, rank) = self.position(vehicle_id)
+        registers = self.sets.get(key)
+        if registers is None:
+            self.sets[key] = {register: rank}
+        elif isinstance(registers, dict):
+            if registers.get(register, 0) < rank:
+                registers[register] = rank
+                if len(registers) * 16 > self.registers:
+                    self.sets[key] = self.toDense(registers)
+        elif registers[register] < rank:
+            registers[register] = rank
+
+    def addAll(self, key, vehicle_ids):
+        for vehicle_id in vehicle_ids:
+            self.add(key, vehicle_id)
+
+    def toDense(self, registers):
+        dense = bytearray(self.registers)
+        for register, rank in registers.items():
+            dense[register] = rank
+        return dense
+
+    def merge(self, other, remap_key):
+        if not isinstance(other, ApproximateVehicleSets) or other.precision != self.precision:
+            raise ValueError("Cannot merge vehicle counts of different precisions")
+        for key, registers in other.sets.items():
+            key = remap_key(key)
+            merged = self.sets.get(key)
+            if merged is None:
+                self.sets[key] = registers.copy()
+            elif isinstance(merged, dict) and isinstance(registers, dict):
+                for register, rank in registers.items():
+                    if merged.get(register, 0) < rank:
+                        merged[register] = rank
+                if len(merged) * 16 > self.registers:
+                    self.sets[key] = self.toDense(merged)
+            else:
+                if isinstance(merged, dict):
+                    merged = self.toDense(merged)
+                if isinstance(registers, dict):
+                    registers = self.toDense(registers)
+                self.sets[key] = bytearray(map(max, merged, registers))
+        return self
+
+    def counts(self):
+        for key, registers in self.sets.items():
+            yield key, estimateCount(registers, self.registers)
+
+    def items(self):
+        raise ValueError("Approximate vehicle counts do not keep vehicle IDs")
+
+def estimateCount(registers, m):
+    # The HyperLogLog estimate of m registers, with linear counting for small
+    # cardinalities. Sparse registers are always in the linear counting range.
+    if isinstance(registers, dict):
+        return int(round(m * math.log(m / (m - len(registers)))))
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum([registers.count(rank) * 2.0 ** -rank
+        for rank in range(max(registers) + 1)])
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
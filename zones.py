@@ -0,0 +1,434 @@
+import abc
+import json
+import lazy
+import math
+import os
+import sys
+
+np = lazy.lazyImport('numpy')
+
+# Coordinates are quantized to integer grid keys which must fit in 32 bits so
+# that a (lat, long) pair can be packed into a single int64 key.
+MAX_GRID_KEY = 1 << 31
+# Accuracies above this cannot be quantized exactly with doubles, so every
+# point takes the string formatting path.
+MAX_GRID_ACCURACY = 7
+# Batches of fewer points than this are assigned one point at a time, which
+# is faster than numpy for short routes
+MIN_VECTOR_POINTS = 32
+# Importing numpy takes about as long as assigning this many points one at a
+# time saves, so the first points are assigned without it and small jobs
+# never import it
+SCALAR_POINTS = 1 << 16
+
+def zoneName(lat, long, gpsaccuracy):
+    # The name stored in geo_ids for a rounded grid cell. Backends are given
+    # coordinates in the order of the MDS GeoJSON points, so lat and long are
+    # the longitude and latitude and names are "long:lat".
+    return "{lat:03.{gpsaccuracy}f}:{long:03.{gpsaccuracy}f}".format(
+        lat=lat, long=long, gpsaccuracy=gpsaccuracy)
+
+def addZone(geo_ids, inverse_geo_ids, name):
+    # Returns the geo_id for a zone name, assigning the next ID if it is new.
+    # geo_ids may have gaps, e.g. when loaded from a zone dictionary, so the
+    # next ID is the first one after the count of zones that is not taken.
+    if name not in inverse_geo_ids:
+        geo_id = len(geo_ids)
+        while geo_id in geo_ids:
+            geo_id += 1
+        inverse_geo_ids[name] = geo_id
+        geo_ids[geo_id] = name
+    return inverse_geo_ids[name]
+
+def zoneCenter(name):
+    # The (latitude, longitude) of a grid zone name, which is written from
+    # GeoJSON coordinates with the longitude first, or NaNs if the name is not
+    # coordinates
+    try:
+        (long, lat) = name.split(':')
+        return float(lat), float(long)
+    except ValueError:
+        return math.nan, math.nan
+
+def nameAccuracy(name):
+    # The decimal places of a "long:lat" grid zone name, or None if the name
+    # is not finite coordinates
+    if not all(math.isfinite(coordinate) for coordinate in zoneCenter(name)):
+        return None
+    long = name.split(':')[0]
+    return len(long) - long.index('.') - 1 if '.' in long else 0
+
+def sameCenter(center, other):
+    # Whether two (lat, long) pairs are equal, taking NaNs as equal
+    return all(a == b or (math.isnan(a) and math.isnan(b)) for a, b in zip(center, other))
+
+def fillZoneTable(metrics, center=zoneCenter):
+    # Fills the zone table of metrics with the coordinates of the zones in
+    # geo_ids, as given by center for each zone name. There is no table when
+    # every zone's coordinates are those of its name, as for grid zones, since
+    # readers then take them from the names, see zoneCenters.
+    metrics.ClearField('zone_table')
+    if center is zoneCenter:
+        return
+    geo_ids = metrics.geo_ids
+    ordered = sorted(geo_ids)
+    centers = [center(geo_ids[geo_id]) for geo_id in ordered]
+    if all(sameCenter(zone_center, zoneCenter(geo_ids[geo_id]))
+            for geo_id, zone_center in zip(ordered, centers)):
+        return
+    metrics.zone_table.geo_ids.extend(ordered)
+    metrics.zone_table.latitudes.extend([lat for lat, _ in centers])
+    metrics.zone_table.longitudes.extend([long for _, long in centers])
+
+def backendCenter(backend):
+    # The function giving the coordinates of a zone name for the table, the
+    # backend's own for zones whose names are not coordinates
+    return getattr(backend, 'center', zoneCenter)
+
+def zoneCenters(metrics):
+    # Returns {geo_id: (latitude, longitude)} from the zone table of metrics,
+    # or from its zone names if it has no table
+    table = metrics.zone_table
+    if table.geo_ids:
+        return dict(zip(table.geo_ids, zip(table.latitudes, table.longitudes)))
+    return dict([(geo_id, zoneCenter(name)) for geo_id, name in metrics.geo_ids.items()])
+
+# A zone dictionary file keeps the geo_ids of zones across runs, so that the
+# same zone has the same geo_id in every output and outputs can be joined or
+# merged without remapping zones. It is JSON of {"version": 1, "zones":
+# [[geo_id, name], ...]}.
+ZONE_DICTIONARY_VERSION = 1
+
+def loadZoneDictionary(filename):
+    # Returns the {geo_id: name} of a zone dictionary, which is empty if the
+    # file does not exist yet
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        dictionary = json.load(f)
+    if dictionary.get('version') != ZONE_DICTIONARY_VERSION:
+        raise ValueError("Unsupported zone dictionary version in {}".format(filename))
+    geo_ids = dict([(geo_id, name) for geo_id, name in dictionary['zones']])
+    if len(geo_ids) != len(dictionary['zones']) or len(set(geo_ids.values())) != len(geo_ids):
+        raise ValueError("Zones or geo_ids are repeated in {}".format(filename))
+    return geo_ids
+
+def saveZoneDictionary(filename, geo_ids):
+    # Writes geo_ids as a zone dictionary, replacing the file only once it is
+    # complete
+    temporary = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump({
+            'version': ZONE_DICTIONARY_VERSION,
+            'zones': [[geo_id, geo_ids[geo_id]] for geo_id in sorted(geo_ids)],
+        }, f)
+    os.replace(temporary, filename)
+
+# Zoning backends assign geo_ids to points and add new zones to the geo_ids
+# and inverse_geo_ids maps they are given. They provide zone(lat, long) for a
+# single point and zones(coordinates) for a sequence of (lat, long) pairs.
+# Coordinates are in the order of the MDS GeoJSON points.
+
+class GridZones:
+    # Assigns geo_ids to rounded-decimal grid cells. Coordinates are quantized
+    # to integer keys, so the "lat:long" name is only formatted the first time
+    # a cell is seen. Keys are only trusted where rounding the scaled double
+    # is guaranteed to agree with string formatting; points near a rounding
+    # boundary, and cells that would format as "-0.000", fall back to
+    # formatting the name.
+    def __init__(self, gpsaccuracy, geo_ids, inverse_geo_ids):
+        self.gpsaccuracy = gpsaccuracy
+        self.geo_ids = geo_ids
+        self.inverse_geo_ids = inverse_geo_ids
+        self.scale = 10.0 ** gpsaccuracy
+        # Relative error of the scaled double, with plenty of headroom
+        self.tolerance = 4 * sys.float_info.epsilon
+        self.key_geo_ids = {}
+        self.scalar_points = 0
+
+    def nameToZone(self, lat, long):
+        return addZone(self.geo_ids, self.inverse_geo_ids,
+            zoneName(lat, long, self.gpsaccuracy))
+
+    def quantize(self, value):
+        scaled = value * self.scale
+        key = round(scaled)
+        if (abs(abs(scaled - key) - 0.5) <= abs(scaled) * self.tolerance
+                or key == 0 or not abs(key) < MAX_GRID_KEY):
+            return None
+        return key
+
+    def zone(self, lat, long):
+        if self.gpsaccuracy > MAX_GRID_ACCURACY or not (
+                math.isfinite(lat) and math.isfinite(long)):
+            return self.nameToZone(lat, long)
+        lat_key = self.quantize(lat)
+        long_key = self.quantize(long)
+        if lat_key is None or long_key is None:
+            return self.nameToZone(lat, long)
+        key = (lat_key << 32) | (long_key & 0xFFFFFFFF)
+        if key not in self.key_geo_ids:
+            self.key_geo_ids[key] = self.nameToZone(lat, long)
+        return self.key_geo_ids[key]
+
+    def zones(self, coordinates):
+        # Vectorized zone assignment for a sequence of (lat, long) pairs.
+        # Returns a list of geo_ids in the same order, assigning new geo_ids in
+        # order of first appearance just like calling zone() for each point.
+        if len(coordinates) < MIN_VECTOR_POINTS or self.scalar_points < SCALAR_POINTS:
+            self.scalar_points += len(coordinates)
+            zone = self.zone
+            return [zone(float(lat), float(long)) for lat, long in coordinates]
+        points = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        if self.gpsaccuracy > MAX_GRID_ACCURACY:
+            return [self.nameToZone(lat, long) for lat, long in points.tolist()]
+        with np.errstate(invalid='ignore', over='ignore'):
+            scaled = points * self.scale
+            keys = np.rint(scaled)
+            exact = np.all(
+                (np.abs(np.abs(scaled - keys) - 0.5) > np.abs(scaled) * self.tolerance)
+                & (keys != 0) & (np.abs(keys) < MAX_GRID_KEY), axis=1)
+        keys = np.where(exact[:, None], keys, 0).astype(np.int64)
+        packed = ((keys[:, 0] << 32) | (keys[:, 1] & 0xFFFFFFFF)).tolist()
+        key_geo_ids = self.key_geo_ids
+        geo_ids = []
+        for i, (key, is_exact) in enumerate(zip(packed, exact.tolist())):
+            geo_id = key_geo_ids.get(key) if is_exact else None
+            if geo_id is None:
+                lat, long = points[i].tolist()
+                geo_id = self.nameToZone(lat, long)
+                if is_exact:
+                    key_geo_ids[key] = geo_id
+            geo_ids.append(geo_id)
+        return geo_ids
+
+# Name of the zone for points that fall outside of every polygon
+OUTSIDE_ZONE = "outside"
+# Cached points are discarded once the cache holds this many entries
+POINT_CACHE_SIZE = 1 << 20
+# Cell size in degrees of level 0 of the square and hex grids. Each level
+# halves the cell size.
+GRID_BASE_SIZE = 1.0
+
+class CachedZones(abc.ABC):
+    # Base class for zoning backends that find the name of the zone containing
+    # a point with zoneNameAt(lat, long). Results are cached by the exact
+    # coordinates, so repeated points, e.g. parked vehicles, skip the lookup.
+    def __init__(self, geo_ids, inverse_geo_ids, cache_size=POINT_CACHE_SIZE):
+        self.geo_ids = geo_ids
+        self.inverse_geo_ids = inverse_geo_ids
+        self.cache_size = cache_size
+        self.point_geo_ids = {}
+
+    @abc.abstractmethod
+    def zoneNameAt(self, lat, long):
+        pass
+
+    def zone(self, lat, long):
+        key = (lat, long)
+        geo_id = self.point_geo_ids.get(key)
+        if geo_id is None:
+            if len(self.point_geo_ids) >= self.cache_size:
+                self.point_geo_ids.clear()
+            geo_id = addZone(self.geo_ids, self.inverse_geo_ids, self.zoneNameAt(lat, long))
+            self.point_geo_ids[key] = geo_id
+        return geo_id
+
+    def zones(self, coordinates):
+        zone = self.zone
+        return [zone(float(lat), float(long)) for lat, long in coordinates]
+
+class SquareGridZones(CachedZones):
+    # A hierarchical square grid. Each cell at a level is split into four
+    # cells at the next level. Zones are named by the "lat:long" of their
+    # center so they can be used wherever grid zones are.
+    def __init__(self, level, geo_ids, inverse_geo_ids, cache_size=POINT_CACHE_SIZE):
+        CachedZones.__init__(self, geo_ids, inverse_geo_ids, cache_size)
+        self.level = level
+        self.size = GRID_BASE_SIZE / (1 << level)
+
+    def cellAt(self, lat, long):
+        return (math.floor(lat / self.size), math.floor(long / self.size))
+
+    def parentCell(self, cell):
+        return (cell[0] >> 1, cell[1] >> 1)
+
+    def cellCenter(self, cell):
+        return ((cell[0] + 0.5) * self.size, (cell[1] + 0.5) * self.size)
+
+    def zoneNameAt(self, lat, long):
+        return zoneName(*self.cellCenter(self.cellAt(lat, long)), gpsaccuracy=6)
+
+class HexGridZones(CachedZones):
+    # A pointy-top hexagonal grid in axial (q, r) coordinates, whose cell size
+    # halves at each level. Unlike squares, hexes do not nest exactly, so a
+    # parent is the coarser cell containing the center of its child. Zones are
+    # named by the "lat:long" of their center.
+    def __init__(self, level, geo_ids, inverse_geo_ids, cache_size=POINT_CACHE_SIZE):
+        CachedZones.__init__(self, geo_ids, inverse_geo_ids, cache_size)
+        self.level = level
+        self.size = GRID_BASE_SIZE / (1 << level)
+
+    def cellAt(self, lat, long, size=None):
+        size = size or self.size
+        q = (math.sqrt(3) / 3 * lat - long / 3) / size
+        r = (2 * long / 3) / size
+        # Round the fractional cube coordinates to the nearest hex
+        x, z = q, r
+        y = -x - z
+        rx, ry, rz = round(x), round(y), round(z)
+        dx, dy, dz = abs(rx - x), abs(ry - y), abs(rz - z)
+        if dx > dy and dx > dz:
+            rx = -ry - rz
+        elif dy <= dz:
+            rz = -rx - ry
+        return (rx, rz)
+
+    def cellCenter(self, cell, size=None):
+        size = size or self.size
+        q, r = cell
+        return (size * math.sqrt(3) * (q + r / 2), size * 1.5 * r)
+
+    def parentCell(self, cell):
+        return self.cellAt(*self.cellCenter(cell), size=self.size * 2)
+
+    def zoneNameAt(self, lat, long):
+        return zoneName(*self.cellCenter(self.cellAt(lat, long)), gpsaccuracy=6)
+
+def ringCentroid(xs, ys):
+    # The area and centroid of a ring by the shoelace formula
+    xs_next, ys_next = np.roll(xs, -1), np.roll(ys, -1)
+    cross = xs * ys_next - xs_next * ys
+    area = cross.sum() / 2.0
+    if not area:
+        return 0.0, xs.mean(), ys.mean()
+    return (abs(area), ((xs + xs_next) * cross).sum() / (6.0 * area),
+        ((ys + ys_next) * cross).sum() / (6.0 * area))
+
+def pointInRing(x, y, xs, ys):
+    # Even-odd ray casting against the edges of a closed ring
+    xs_next, ys_next = np.roll(xs, -1), np.roll(ys, -1)
+    straddles = (ys > y) != (ys_next > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = xs + (y - ys) * (xs_next - xs) / (ys_next - ys)
+    return np.count_nonzero(straddles & (x < crossings)) % 2 == 1
+
+class PolygonIndex:
+    # A uniform grid spatial index over polygons. Each bucket lists the
+    # polygons whose bounding box overlaps it, so a lookup only tests the
+    # polygons in one bucket, and only those whose bounding box contains the
+    # point. Polygons are lists of rings of (x, y) vertices in GeoJSON order,
+    # the same order as MDS route coordinates. Holes are handled by testing
+    # all rings of a polygon with the even-odd rule.
+    def __init__(self, polygons, names, buckets_per_side=None):
+        self.names = names
+        self.rings = [[(np.array([v[0] for v in ring], dtype=float),
+                        np.array([v[1] for v in ring], dtype=float)) for ring in polygon]
+                      for polygon in polygons]
+        self.bounds = [(min(xs.min() for xs, ys in rings), min(ys.min() for xs, ys in rings),
+                        max(xs.max() for xs, ys in rings), max(ys.max() for xs, ys in rings))
+                       for rings in self.rings]
+        if buckets_per_side is None:
+            buckets_per_side = max(1, 2 * int(math.sqrt(len(polygons))))
+        self.buckets_per_side = buckets_per_side
+        if self.bounds:
+            self.min_x = min(b[0] for b in self.bounds)
+            self.min_y = min(b[1] for b in self.bounds)
+            self.max_x = max(b[2] for b in self.bounds)
+            self.max_y = max(b[3] for b in self.bounds)
+        else:
+            self.min_x = self.min_y = self.max_x = self.max_y = 0.0
+        self.bucket_width = (self.max_x - self.min_x) / buckets_per_side or 1.0
+        self.bucket_height = (self.max_y - self.min_y) / buckets_per_side or 1.0
+        self.buckets = {}
+        for i, (min_x, min_y, max_x, max_y) in enumerate(self.bounds):
+            (first_column, first_row) = self.bucketAt(min_x, min_y)
+            (last_column, last_row) = self.bucketAt(max_x, max_y)
+            for column in range(first_column, last_column + 1):
+                for row in range(first_row, last_row + 1):
+                    self.buckets.setdefault((column, row), []).append(i)
+
+    def centroids(self):
+        # Returns {name: (lat, long)} of the centroid of each zone, weighting
+        # the parts of a zone by area and subtracting holes
+        sums = {}
+        for name, rings in zip(self.names, self.rings):
+            total = sums.setdefault(name, [0.0, 0.0, 0.0, []])
+            for i, (xs, ys) in enumerate(rings):
+                (area, x, y) = ringCentroid(xs, ys)
+                weight = area if i == 0 else -area
+                total[0] += weight
+                total[1] += weight * x
+                total[2] += weight * y
+                total[3].append((x, y))
+        centroids = {}
+        for name, (area, x, y, points) in sums.items():
+            if area > 0:
+                centroids[name] = (y / area, x / area)
+            else:
+                centroids[name] = (sum([y for _, y in points]) / len(points),
+                    sum([x for x, _ in points]) / len(points))
+        return centroids
+
+    def bucketAt(self, x, y):
+        column = int((x - self.min_x) / self.bucket_width)
+        row = int((y - self.min_y) / self.bucket_height)
+        return (min(column, self.buckets_per_side - 1), min(row, self.buckets_per_side - 1))
+
+    def lookup(self, x, y):
+        # Returns the name of the first polygon containing the point, or None
+        if not (self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y):
+            return None
+        for i in self.buckets.get(self.bucketAt(x, y), ()):
+            (min_x, min_y, max_x, max_y) = self.bounds[i]
+            if not (min_x <= x <= max_x and min_y <= y <= max_y):
+                continue
+            inside = False
+            for xs, ys in self.rings[i]:
+                inside ^= pointInRing(x, y, xs, ys)
+            if inside:
+                return self.names[i]
+        return None
+
+def loadPolygonIndex(filename, name_property=None):
+    # Loads Polygon and MultiPolygon features from a GeoJSON file. Zones are
+    # named by the given feature property, or by the feature's position in
+    # the file if it is not given.
+    with open(filename) as f:
+        geojson = json.load(f)
+    features = geojson['features'] if geojson.get('type') == 'FeatureCollection' else [geojson]
+    polygons, names = [], []
+    for i, feature in enumerate(features):
+        geometry = feature['geometry']
+        if name_property:
+            name = str(feature['properties'][name_property])
+        else:
+            name = str(i)
+        if geometry['type'] == 'Polygon':
+            parts = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            parts = geometry['coordinates']
+        else:
+            raise ValueError("Unsupported zone geometry {} in {}".format(geometry['type'], filename))
+        for rings in parts:
+            polygons.append(rings)
+            names.append(name)
+    return PolygonIndex(polygons, names)
+
+class PolygonZones(CachedZones):
+    # Assigns points to the polygon zones in a PolygonIndex. Points outside
+    # every polygon are assigned to OUTSIDE_ZONE.
+    def __init__(self, index, geo_ids, inverse_geo_ids, cache_size=POINT_CACHE_SIZE):
+        CachedZones.__init__(self, geo_ids, inverse_geo_ids, cache_size)
+        self.index = index
+        self.centroids = None
+
+    def center(self, name):
+        # The (lat, long) of the centroid of a zone, NaNs for OUTSIDE_ZONE
+        if self.centroids is None:
+            self.centroids = self.index.centroids()
+        return self.centroids.get(name, (math.nan, math.nan))
+
+    def zoneNameAt(self, lat, long):
+        name = self.index.lookup(lat, long)
+        return OUTSIDE_ZONE if name is None else name